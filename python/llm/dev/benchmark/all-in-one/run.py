@@ -22,6 +22,7 @@ import gc
 import traceback
 import threading
 import csv
+import json
 import warnings
 
 import numpy as np
@@ -32,7 +33,7 @@ current_dir = os.path.dirname(os.path.realpath(__file__))
 import sys
 sys.stdout.reconfigure(encoding='utf-8')
 
-from ipex_llm.utils import BenchmarkWrapper
+from ipex_llm.utils import BenchmarkWrapper, GenerationProfiler
 from ipex_llm.utils.common.log4Error import invalidInputError
 from ipex_llm.utils.common import invalidInputError
 
@@ -60,6 +61,18 @@ DUMMY_IDS = ['dummy/dummy-1.5B', 'dummy/dummy-4B']
 results = []
 excludes = []
 
+# the class wrapping the model to collect the latency, GenerationProfiler
+# is selected by `use_generation_profiler` in config.yaml
+wrapper_class = BenchmarkWrapper
+generation_profilers = []
+
+
+def wrap_model(model, do_print=False, verbose=False):
+    model = wrapper_class(model, do_print=do_print, verbose=verbose)
+    if isinstance(model, GenerationProfiler):
+        generation_profilers.append(model)
+    return model
+
 def run_model_in_thread(model, in_out, tokenizer, result, warm_up, num_beams, input_ids, out_len, actual_in_len, num_trials, load_time, lookahead):
     for i in range(num_trials + warm_up):
         st = time.perf_counter()
@@ -305,7 +318,7 @@ def run_transformer_int4(repo_id,
     load_time = end - st
     print(">> loading of model costs {}s".format(load_time))
 
-    model = BenchmarkWrapper(model)
+    model = wrap_model(model)
 
     result = {}
     with torch.inference_mode():
@@ -365,7 +378,7 @@ def run_pytorch_autocast_bf16(repo_id,
     load_time = end - st
     print(">> loading of model costs {}s".format(load_time))
 
-    model = BenchmarkWrapper(model)
+    model = wrap_model(model)
     result = {}
     with torch.inference_mode(), torch.autocast("cpu"):
         for in_out in in_out_pairs:
@@ -429,7 +442,7 @@ def run_optimize_model(repo_id,
     load_time = end - st
     print(">> loading of model costs {}s".format(load_time))
 
-    model = BenchmarkWrapper(model)
+    model = wrap_model(model)
 
     result = {}
     with torch.inference_mode():
@@ -547,7 +560,7 @@ def run_transformer_int4_gpu(repo_id,
     print(">> loading of model costs {}s and {}GB".format(load_time, torch.xpu.memory.memory_reserved()/(1024**3)))
 
     if not lookahead and os.environ.get("IPEX_LLM_PERFORMANCE_MODE", None) != "1":
-        model = BenchmarkWrapper(model)
+        model = wrap_model(model)
 
     result = {}
     with torch.inference_mode():
@@ -648,7 +661,7 @@ def transformers_int4_npu_win(repo_id,
     print(">> loading of model costs {}s".format(load_time))
 
     if not hasattr(model, "model_ptr") or repo_id in MINICPM_V_IDS:
-        model = BenchmarkWrapper(model)
+        model = wrap_model(model)
 
     result = {}
     with torch.inference_mode():
@@ -790,7 +803,7 @@ def run_transformer_int4_loadlowbit_npu_win(repo_id,
     print(">> loading of model costs {}s".format(load_time))
 
     if not hasattr(model, "model_ptr"):
-        model = BenchmarkWrapper(model)
+        model = wrap_model(model)
 
     result = {}
     with torch.inference_mode():
@@ -863,7 +876,7 @@ def run_transformers_openvino(repo_id,
     load_time = end - st
     print(">> loading of model costs {}s".format(load_time))
 
-    model = BenchmarkWrapper(model)
+    model = wrap_model(model)
 
     result = {}
     with torch.inference_mode():
@@ -941,7 +954,7 @@ def run_optimize_model_gpu(repo_id,
     load_time = end - st
     print(">> loading of model costs {}s".format(load_time))
 
-    model = BenchmarkWrapper(model)
+    model = wrap_model(model)
 
     result = {}
     with torch.inference_mode():
@@ -1006,7 +1019,7 @@ def run_ipex_fp16_gpu(repo_id,
     load_time = end - st
     print(">> loading of model costs {}s".format(load_time))
 
-    model = BenchmarkWrapper(model)
+    model = wrap_model(model)
 
     result = {}
     with torch.inference_mode():
@@ -1077,7 +1090,7 @@ def run_bigdl_fp16_gpu(repo_id,
     load_time = end - st
     print(">> loading of model costs {}s".format(load_time))
 
-    model = BenchmarkWrapper(model)
+    model = wrap_model(model)
 
     result = {}
     with torch.inference_mode():
@@ -1163,7 +1176,7 @@ def run_deepspeed_transformer_int4_cpu(repo_id,
     load_time = end - st
     print(">> loading of model costs {}s".format(load_time))
 
-    model = BenchmarkWrapper(model)
+    model = wrap_model(model)
 
     result = {}
     with torch.inference_mode():
@@ -1265,7 +1278,7 @@ def run_transformer_int4_gpu_win(repo_id,
     load_time = end - st
     print(">> loading of model costs {}s and {}GB".format(load_time, torch.xpu.memory.memory_reserved()/(1024**3)))
 
-    model = BenchmarkWrapper(model)
+    model = wrap_model(model)
     if repo_id not in DUMMY_IDS:
         streamer = TextStreamer(tokenizer, skip_prompt=True)
     else:
@@ -1402,7 +1415,7 @@ def run_transformer_int4_fp16_gpu_win(repo_id,
     load_time = end - st
     print(">> loading of model costs {}s and {}GB".format(load_time, torch.xpu.memory.memory_reserved()/(1024**3)))
 
-    model = BenchmarkWrapper(model)
+    model = wrap_model(model)
     if repo_id not in DUMMY_IDS:
         streamer = TextStreamer(tokenizer, skip_prompt=True)
     else:
@@ -1519,7 +1532,7 @@ def run_transformer_int4_loadlowbit_gpu_win(repo_id,
     load_time = end - st
     print(">> loading of model costs {}s and {}GB".format(load_time, torch.xpu.memory.memory_reserved()/(1024**3)))
 
-    model = BenchmarkWrapper(model)
+    model = wrap_model(model)
     streamer = TextStreamer(tokenizer, skip_prompt=True)
 
     result = {}
@@ -1633,7 +1646,7 @@ def run_transformer_int4_fp16_loadlowbit_gpu_win(repo_id,
     load_time = end - st
     print(">> loading of model costs {}s and {}GB".format(load_time, torch.xpu.memory.memory_reserved()/(1024**3)))
 
-    model = BenchmarkWrapper(model)
+    model = wrap_model(model)
     if repo_id not in DUMMY_IDS:
         streamer = TextStreamer(tokenizer, skip_prompt=True)
     else:
@@ -1725,7 +1738,7 @@ def run_transformer_autocast_bf16( repo_id,
     load_time = end - st
     print(">> loading of model costs {}s".format(load_time))
 
-    model = BenchmarkWrapper(model)
+    model = wrap_model(model)
 
     result = {}
     with torch.inference_mode(), torch.autocast("cpu"):
@@ -2022,7 +2035,7 @@ def run_deepspeed_optimize_model_gpu(repo_id,
     from deepspeed.comm.comm import init_distributed
     init_distributed()
 
-    model = BenchmarkWrapper(model, do_print=True)
+    model = wrap_model(model, do_print=True)
 
     result = {}
     with torch.inference_mode():
@@ -2312,6 +2325,10 @@ if __name__ == '__main__':
     if 'transpose_value_cache' in conf:
         transpose_value_cache = conf['transpose_value_cache']
 
+    if conf.get('use_generation_profiler', False):
+        # collect the timing through hooks instead of the copied `generate` of BenchmarkWrapper
+        wrapper_class = GenerationProfiler
+
     import pandas as pd
     for api in conf.test_api:
         global csv_name
@@ -2357,3 +2374,9 @@ if __name__ == '__main__':
                     df.to_csv(csv_name, mode='a', header=None, encoding='utf-8')
             line_counter += len(df.index)
         results = []
+        if generation_profilers:
+            # raw records of every generate call, including warm up and per-token percentiles
+            records = [record for profiler in generation_profilers for record in profiler.records]
+            with open(f'{current_dir}/{api}-generation-records-{today}.json', 'w') as f:
+                json.dump(records, f, indent=2)
+            generation_profilers.clear()
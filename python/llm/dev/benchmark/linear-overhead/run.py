@@ -0,0 +1,112 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Measure the per-token Python and allocator overhead of the CPU `LowBitLinear` forward in
+# a decode step, by comparing all linears of a Llama-2-7B shaped model called through
+# `LowBitLinear.forward` against the bare low-bit kernel on preallocated buffers.
+
+import argparse
+import ctypes
+import time
+
+import torch
+
+from ipex_llm.ggml.quantize import ggml_tensor_qtype
+from ipex_llm.transformers.low_bit_linear import LowBitLinear, ggml
+import ipex_llm.transformers.low_bit_linear as low_bit_linear
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--precision", type=str, default="sym_int4")
+parser.add_argument("--dtype", type=str, default="bf16", choices=["bf16", "fp32"])
+parser.add_argument("--num-layers", type=int, default=32)
+parser.add_argument("--hidden-size", type=int, default=4096)
+parser.add_argument("--intermediate-size", type=int, default=11008)
+parser.add_argument("--vocab-size", type=int, default=32000)
+parser.add_argument("--bias", action="store_true")
+parser.add_argument("--warmup", type=int, default=3)
+parser.add_argument("--num-tokens", type=int, default=20)
+args = parser.parse_args()
+
+qtype = ggml_tensor_qtype[args.precision]
+dtype = torch.bfloat16 if args.dtype == "bf16" else torch.float32
+hidden, intermediate = args.hidden_size, args.intermediate_size
+
+
+def make_linear(in_features, out_features):
+    linear = LowBitLinear(in_features, out_features, qtype, bias=args.bias)
+    linear.weight = linear.weight.to("cpu")  # quantize
+    linear.eval()
+    return linear
+
+
+print("Quantizing weights...")
+shapes = [(hidden, hidden)] * 4 + [(hidden, intermediate)] * 2 + [(intermediate, hidden)]
+linears = [make_linear(in_features, out_features)
+           for _ in range(args.num_layers) for in_features, out_features in shapes]
+linears.append(make_linear(hidden, args.vocab_size))
+inputs = {size: torch.randn(1, 1, size).to(dtype) for size in [hidden, intermediate]}
+
+
+def step_forward():
+    for linear in linears:
+        linear(inputs[linear.in_len])
+
+
+# the bare kernel on preallocated fp32 buffers and descriptors
+kernel_args = []
+for linear in linears:
+    src1 = inputs[linear.in_len].float().view(1, -1)
+    result = torch.empty(1, linear.out_len, dtype=torch.float32)
+    kernel_args.append(dict(
+        src_0_ne=(ctypes.c_int64 * 2)(linear.in_len, linear.out_len),
+        src_0_data=ctypes.c_void_p(linear.weight.data.data_ptr()),
+        src_0_qtype=qtype,
+        src_1_ne=(ctypes.c_int64 * 2)(linear.in_len, 1),
+        src_1_data=ctypes.c_void_p(src1.data_ptr()),
+        result=ctypes.c_void_p(result.data_ptr()),
+        _keep=(src1, result),
+    ))
+
+
+def step_kernel():
+    for kwargs in kernel_args:
+        ggml.ggml_compute_forward_mul_mat_q_fp32(
+            **{key: value for key, value in kwargs.items() if key != "_keep"})
+
+
+def measure(step):
+    for _ in range(args.warmup):
+        step()
+    times = []
+    for _ in range(args.num_tokens):
+        tic = time.perf_counter()
+        step()
+        times.append(time.perf_counter() - tic)
+    times.sort()
+    return times[len(times) // 2]
+
+
+with torch.inference_mode():
+    forward_time = measure(step_forward)
+    kernel_time = measure(step_kernel)
+    low_bit_linear._workspace.clear()
+
+overhead = forward_time - kernel_time
+print(f"{len(linears)} linears, {args.precision}, activation {args.dtype}")
+print(f"LowBitLinear.forward: {forward_time * 1000:8.2f} ms/token")
+print(f"low-bit kernel only : {kernel_time * 1000:8.2f} ms/token")
+print(f"overhead            : {overhead * 1000:8.2f} ms/token "
+      f"({overhead / forward_time * 100:.1f}%), {overhead / len(linears) * 1e6:.1f} us/linear")
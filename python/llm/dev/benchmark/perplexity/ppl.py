@@ -19,11 +19,89 @@
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 from torch.nn import CrossEntropyLoss
 from tqdm import tqdm
+from collections import defaultdict
+from contextlib import contextmanager
 import gc
 
 from ipex_llm.transformers import AutoModelForCausalLM, AutoModel
+from ipex_llm.utils.common import invalidInputError
+
+
+@contextmanager
+def _full_lm_head(lm_head):
+    # `optimize_lm_head` makes LowBitLinear only keep the last position of a long input,
+    # which is what generation wants but not what a loss over every position needs.
+    optimize_lm_head = getattr(lm_head, "optimize_lm_head", False)
+    if optimize_lm_head:
+        lm_head.optimize_lm_head = False
+    try:
+        yield lm_head
+    finally:
+        if optimize_lm_head:
+            lm_head.optimize_lm_head = True
+
+
+def chunked_nll(hidden_states, lm_head, labels, chunk_size=512, softcap=None):
+    """
+    Compute the token-level negative log-likelihood of `labels` without materializing
+    the full `[batch, seq, vocab]` logits.
+
+    :param hidden_states: final hidden states of shape [batch, seq, hidden]. Position `i`
+           predicts `labels[:, i]`, i.e. the caller is responsible for the shift.
+    :param lm_head: output projection, e.g. a `LowBitLinear`.
+    :param labels: target ids of shape [batch, seq], positions set to -100 are ignored.
+    :param chunk_size: number of positions projected through `lm_head` at a time,
+           peak logits memory is `batch * chunk_size * vocab_size` floats.
+    :param softcap: optional final logit softcapping (e.g. gemma2).
+
+    :return: a tuple of per-row nll sum and per-row number of scored tokens.
+    """
+    bsz, seq_len = labels.shape
+    nll_sum = torch.zeros(bsz, dtype=torch.float64)
+    n_tokens = (labels != -100).sum(dim=1).cpu()
+    with _full_lm_head(lm_head):
+        for start in range(0, seq_len, chunk_size):
+            end = min(start + chunk_size, seq_len)
+            target = labels[:, start:end]
+            if not (target != -100).any():
+                continue
+            # hidden_states[:, start:end] is a view, only the logits chunk is allocated
+            logits = lm_head(hidden_states[:, start:end]).float()
+            if softcap is not None:
+                logits = torch.tanh(logits / softcap) * softcap
+            loss = F.cross_entropy(logits.flatten(0, 1), target.flatten().to(logits.device),
+                                   ignore_index=-100, reduction="none")
+            nll_sum += loss.view(bsz, -1).sum(dim=1).double().cpu()
+            del logits, loss
+    return nll_sum, n_tokens
+
+
+def split_lm_head(model):
+    """
+    Split a causal LM into the decoder which outputs the final hidden states
+    and the lm_head applied on them.
+    """
+    lm_head = model.get_output_embeddings()
+    if lm_head is None and hasattr(model, "transformer"):
+        lm_head = getattr(model.transformer, "output_layer", None)  # chatglm
+    body = model.base_model
+    invalidInputError(lm_head is not None and body is not model,
+                      f"Cannot split {type(model).__name__} into decoder and lm_head, "
+                      "please evaluate it with full logits instead.")
+    return body, lm_head
+
+
+def final_hidden_states(body, input_ids):
+    hidden_states = body(input_ids, use_cache=False)[0]
+    bsz, seq_len = input_ids.shape
+    if hidden_states.shape[:2] == (seq_len, bsz) and seq_len != bsz:
+        # chatglm2/3 return [seq, batch, hidden]
+        hidden_states = hidden_states.transpose(0, 1)
+    return hidden_states
+
 
 class BigDLPPL:
     def __init__(self, model_path, device, **model_kwargs) -> None:
@@ -83,4 +161,83 @@ class BigDLPPL:
             del self.model
             gc.collect()
         
-        return ppl_mean
\ No newline at end of file
+        return ppl_mean
+
+    def perplexity_chunked(self, encoded_texts, chunk_size=512, batch_size=1):
+        """
+        Same metric as `perplexity_hf`, but the loss is computed from the final hidden states
+        `chunk_size` positions at a time, so the full logits are never materialized.
+        Samples with equal length are stacked into batches of up to `batch_size`.
+        """
+        self.model.eval()
+        softcap = getattr(self.model.config, "final_logit_softcapping", None)
+        texts = [t["input_ids"] if isinstance(t, dict) else t for t in encoded_texts]
+        texts = [t[0] if isinstance(t, list) else t for t in texts]
+
+        groups = defaultdict(list)
+        for text in texts:
+            groups[text.size(-1)].append(text.view(1, -1))
+        batches = []
+        for same_len in groups.values():
+            for i in range(0, len(same_len), batch_size):
+                batches.append(torch.cat(same_len[i:i + batch_size], dim=0))
+
+        ppls = []
+        try:
+            body, lm_head = split_lm_head(self.model)
+            pbar = tqdm(batches)
+            with torch.no_grad():
+                for bid, encoded_batch in enumerate(pbar):
+                    encoded_batch = encoded_batch.to(self.device)
+                    hidden_states = final_hidden_states(body, encoded_batch)
+                    nll_sum, n_tokens = chunked_nll(hidden_states[:, :-1], lm_head,
+                                                    encoded_batch[:, 1:], chunk_size, softcap)
+                    # keep exp2 to stay comparable with the numbers of `perplexity_hf`
+                    ppls += torch.exp2(nll_sum / n_tokens).tolist()
+                    pbar.set_description(f"[{bid:<4}/{len(batches)}] "
+                                         f"avg_ppls: {np.nanmean(np.array(ppls)):.4f}")
+                    del hidden_states, encoded_batch
+            ppl_mean = np.nanmean(np.array(ppls))
+        finally:
+            if self.device == "xpu":
+                torch.xpu.synchronize()
+                torch.xpu.empty_cache()
+            del self.model
+            gc.collect()
+
+        return ppl_mean
+
+    def perplexity_sliding_window(self, input_ids, max_length, stride, chunk_size=512):
+        """
+        Sliding-window perplexity of one long token sequence, see
+        https://huggingface.co/docs/transformers/perplexity#perplexity-of-fixed-length-models.
+        Each window of `max_length` tokens moves forward by `stride` tokens and only scores
+        the tokens not scored by the previous window.
+
+        :return: exp of the mean nll over all scored tokens.
+        """
+        self.model.eval()
+        softcap = getattr(self.model.config, "final_logit_softcapping", None)
+        body, lm_head = split_lm_head(self.model)
+        seq_len = input_ids.size(1)
+        total_nll, total_tokens = 0.0, 0
+        prev_end_loc = 0
+        with torch.no_grad():
+            for begin_loc in tqdm(range(0, seq_len, stride)):
+                end_loc = min(begin_loc + max_length, seq_len)
+                trg_len = end_loc - prev_end_loc
+                window = input_ids[:, begin_loc:end_loc].to(self.device)
+                target_ids = window.clone()
+                target_ids[:, :-trg_len] = -100
+                hidden_states = final_hidden_states(body, window)
+                nll_sum, n_tokens = chunked_nll(hidden_states[:, :-1], lm_head,
+                                                target_ids[:, 1:], chunk_size, softcap)
+                total_nll += nll_sum.sum().item()
+                total_tokens += n_tokens.sum().item()
+                del hidden_states, window
+                if "xpu" in str(self.device):
+                    torch.xpu.empty_cache()
+                prev_end_loc = end_loc
+                if end_loc == seq_len:
+                    break
+        return float(np.exp(total_nll / total_tokens))
@@ -40,6 +40,11 @@ def get_arguments():
     parser.add_argument("--mixed_precision", action="store_true") 
     parser.add_argument("--device", type=str, default="xpu")
     parser.add_argument("--output_path", default=None)
+    parser.add_argument("--loss_chunk_size", type=int, default=0,
+                        help="compute the loss from hidden states this many positions at a time, "
+                             "0 means using the full logits")
+    parser.add_argument("--batch_size", type=int, default=1,
+                        help="batch equal-length samples, only used with --loss_chunk_size")
     return parser.parse_args()
     
 
@@ -97,7 +102,12 @@ def main():
         os.makedirs(log_dir, exist_ok=True)
         results = {}
         ppl_evaluator = BigDLPPL(model_path=args.model_path, device=args.device, mixed_precision=args.mixed_precision, **model_kwargs)
-        ppl = ppl_evaluator.perplexity_hf(encoded_texts)
+        if args.loss_chunk_size > 0:
+            ppl = ppl_evaluator.perplexity_chunked(encoded_texts,
+                                                   chunk_size=args.loss_chunk_size,
+                                                   batch_size=args.batch_size)
+        else:
+            ppl = ppl_evaluator.perplexity_hf(encoded_texts)
         summary[precision] = ppl
         results['results'] = ppl
         results['config'] = {"model": model_name, "precision": precision, "mixed_precision": args.mixed_precision, "device": args.device, "seq_len": args.seq_len, "language": args.language }
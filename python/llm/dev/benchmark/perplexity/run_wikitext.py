@@ -34,6 +34,9 @@ parser.add_argument("--precision", type=str, default="sym_int4")
 parser.add_argument("--use-cache", action="store_true")
 parser.add_argument("--max_length", type=int, default=None)
 parser.add_argument("--mixed_precision", action="store_true") 
+parser.add_argument("--loss_chunk_size", type=int, default=0,
+                    help="compute the loss from hidden states this many positions at a time, "
+                         "0 means using the full logits")
 args = parser.parse_args()
 
 if args.precision == "fp16":  # ipex fp16
@@ -85,6 +88,10 @@ if not args.max_length:
 else:
     max_length = args.max_length
 stride = args.chunk_size if args.stride <= 0 else args.stride
+if args.loss_chunk_size > 0:
+    from ppl import split_lm_head, final_hidden_states, chunked_nll
+    body, lm_head = split_lm_head(model)
+    softcap = getattr(model.config, "final_logit_softcapping", None)
 seq_len = encodings.input_ids.size(1)
 num_chunks = seq_len // stride
 
@@ -104,12 +111,20 @@ for i in tqdm(range(num_chunks)):
     target_ids[:, :-trg_len] = -100
 
     with torch.no_grad():
-        outputs = model(input_ids, labels=target_ids)
+        if args.loss_chunk_size > 0:
+            # never materialize the [seq, vocab] logits, see ppl.chunked_nll
+            hidden_states = final_hidden_states(body, input_ids)
+            nll_sum, n_tokens = chunked_nll(hidden_states[:, :-1], lm_head, target_ids[:, 1:],
+                                            args.loss_chunk_size, softcap)
+            neg_log_likelihood = nll_sum.sum() / n_tokens.sum()
+            del hidden_states
+        else:
+            outputs = model(input_ids, labels=target_ids)
 
-        # loss is calculated using CrossEntropyLoss which averages over valid labels
-        # N.B. the model only calculates loss over trg_len - 1 labels, because it internally shifts the labels
-        # to the left by 1.
-        neg_log_likelihood = outputs.loss
+            # loss is calculated using CrossEntropyLoss which averages over valid labels
+            # N.B. the model only calculates loss over trg_len - 1 labels, because it internally shifts the labels
+            # to the left by 1.
+            neg_log_likelihood = outputs.loss
 
     nlls.append(neg_log_likelihood)
     if "xpu" in args.device:
@@ -34,14 +34,22 @@ async def main():
                         help='The quantization type the model will convert to.')
     parser.add_argument('--port', type=int, default=8000,
                         help='The port number on which the server will run.')
+    parser.add_argument('--lora-adapters', type=str, nargs='*', default=None,
+                        help='LoRA adapters to serve over the model, as NAME=PATH.')
+    parser.add_argument('--max-loaded-adapters', type=int, default=4,
+                        help='The number of LoRA adapters kept loaded.')
     
     args = parser.parse_args()
     model_path = args.repo_id_or_model_path
     low_bit = args.low_bit
+    lora_adapters = None
+    if args.lora_adapters is not None:
+        lora_adapters = dict(adapter.split("=", 1) for adapter in args.lora_adapters)
 
     processor = None
     if "whisper" not in model_path.lower():
-        local_model = ModelWorker(model_path, low_bit)
+        local_model = ModelWorker(model_path, low_bit, lora_adapters=lora_adapters,
+                                  max_loaded_adapters=args.max_loaded_adapters)
         # Load tokenizer
         tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True, padding_side='left')
         if tokenizer.pad_token is None:
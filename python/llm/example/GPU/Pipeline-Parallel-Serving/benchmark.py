@@ -88,6 +88,7 @@ def benchmark(
     max_concurrent_requests,
     max_tokens,
     prompt_length,
+    system_prompt=None,
 ):
 
     headers = {"Content-Type": "application/json"}
@@ -109,25 +110,32 @@ def benchmark(
             cur_llm_urls = extend_list_to_length(llm_urls, max_concurrent_requests)
             cur_len = len(cur_llm_urls)
 
-            payload = {
-                "model": "Meta-Llama-3-8B-Instruct",
-                "prompt": prompt,
-                "max_tokens": max_tokens,
-                "stream": True,
-                # for vllm openai api server
-                "ignore_eos": True,
-                "n": 1,
-                "best_of": 1,
-                "use_beam_search": False,
-                "temperature": 0.0,
-                "top_p": 1.0,
-            }
+            def make_payload(index):
+                cur_prompt = prompt
+                if system_prompt is not None:
+                    # a long system prompt shared by all requests, followed by a distinct
+                    # question, to measure the prefix cache (IPEX_LLM_PREFIX_CACHE_GB)
+                    cur_prompt = f"{system_prompt}\nQuestion {index}: {prompt}"
+                return {
+                    "model": "Meta-Llama-3-8B-Instruct",
+                    "prompt": cur_prompt,
+                    "max_tokens": max_tokens,
+                    "stream": True,
+                    # for vllm openai api server
+                    "ignore_eos": True,
+                    "n": 1,
+                    "best_of": 1,
+                    "use_beam_search": False,
+                    "temperature": 0.0,
+                    "top_p": 1.0,
+                }
+
             futures = [
                 executor.submit(
                     perform_request,
                     session,
                     cur_llm_urls[index % cur_len],
-                    payload,
+                    make_payload(index),
                     headers,
                 )
                 for index in range(num_requests)
@@ -184,6 +192,9 @@ def benchmark(
                     f"Total token throughput: {(max_tokens + prompt_length) * num_requests / total_time}",
                     file=file,
                 )
+                if system_prompt is not None:
+                    stats_url = llm_urls[0].rsplit("/v1/", 1)[0] + "/prefix_cache/stats"
+                    print(f"Prefix cache stats: {session.get(stats_url).json()}", file=file)
                 print(file=file)
 
                 if first_token_latencies:
@@ -250,9 +261,20 @@ parser.add_argument(
     default=128,
     help="Maximum number of new tokens that the model will generate per request.",
 )
+parser.add_argument(
+    "--system_prompt_length",
+    type=int,
+    choices=[0, 1024, 2048],
+    default=0,
+    help="Length of the system prompt shared by all requests, 0 means no system prompt.",
+)
 args = parser.parse_args()
 PROMPT_LENGTH = args.prompt_length
 PROMPT = open(f"prompt/{PROMPT_LENGTH}.txt", "r").read()
+SYSTEM_PROMPT = None
+if args.system_prompt_length > 0:
+    SYSTEM_PROMPT = open(f"prompt/{args.system_prompt_length}.txt", "r").read()
+    PROMPT_LENGTH += args.system_prompt_length
 MAX_TOKENS = args.max_new_tokens
 
 
@@ -260,4 +282,5 @@ for MAX_CONCURRENT_REQUESTS in args.max_concurrent_requests:
     NUM_WARMUP = 5 * MAX_CONCURRENT_REQUESTS
     NUM_REQUESTS = 30 * MAX_CONCURRENT_REQUESTS
 
-    benchmark(LLM_URLS, PROMPT, NUM_WARMUP, NUM_REQUESTS, MAX_CONCURRENT_REQUESTS, MAX_TOKENS, PROMPT_LENGTH)
+    benchmark(LLM_URLS, PROMPT, NUM_WARMUP, NUM_REQUESTS, MAX_CONCURRENT_REQUESTS, MAX_TOKENS, PROMPT_LENGTH,
+              SYSTEM_PROMPT)
@@ -271,6 +271,9 @@ def stream_chat_with_history(model, tokenizer):
     stopping_criteria = StoppingCriteriaList([StopSequenceCriteria(HUMAN_ID, tokenizer)])
 
     chat_history = []
+    # keep the kv cache of previous turns, so only the new input is prefilled
+    from ipex_llm.transformers.session_cache import SessionKVCache
+    session_cache = SessionKVCache()
 
     while True:
         with torch.inference_mode():
@@ -281,12 +284,12 @@ def stream_chat_with_history(model, tokenizer):
             # print(prompt)
             input_ids = tokenizer([prompt], return_tensors="pt")
             streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
-            generate_kwargs = dict(input_ids, streamer=streamer, max_new_tokens=512,
-                                   stopping_criteria=stopping_criteria)
+            generate_kwargs = dict(input_ids, model=model, session_id="chat", streamer=streamer,
+                                   max_new_tokens=512, stopping_criteria=stopping_criteria)
 
             from threading import Thread
             # to ensure non-blocking access to the generated text, generation process should be ran in a separate thread
-            thread = Thread(target=model.generate, kwargs=generate_kwargs)
+            thread = Thread(target=session_cache.generate, kwargs=generate_kwargs)
             thread.start()
 
             output_str = []
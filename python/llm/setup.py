@@ -359,7 +359,8 @@ def setup_package():
         include_package_data=True,
         entry_points={
             "console_scripts": [
-                'llm-convert=ipex_llm.convert_model:main'
+                'llm-convert=ipex_llm.convert_model:main',
+                'llm-cache=ipex_llm.transformers.low_bit_cache:main'
             ]
         },
         extras_require={"all": all_requires,
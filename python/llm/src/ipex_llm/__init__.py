@@ -19,12 +19,21 @@
 # Otherwise there would be module not found error in non-pip's setting as Python would
 # only search the first bigdl package and end up finding only one sub-package.
 
-from .convert_model import llm_convert
-from .optimize import optimize_model
 import os
-from .llm_patching import llm_patch, llm_unpatch
 import sys
 import types
+from .utils.common.lazyimport import lazy_module_getattr, lazy_module_dir
+
+# `llm_convert`, `optimize_model`, `llm_patch` and `llm_unpatch` depend on torch and
+# transformers, they are only imported on first access to keep `import ipex_llm` fast.
+__getattr__ = lazy_module_getattr(__name__, {
+    "llm_convert": "ipex_llm.convert_model",
+    "optimize_model": "ipex_llm.optimize",
+    "llm_patch": "ipex_llm.llm_patching",
+    "llm_unpatch": "ipex_llm.llm_patching",
+})
+__all__ = ["llm_convert", "optimize_model", "llm_patch", "llm_unpatch"]
+__dir__ = lazy_module_dir(__name__, __all__)
 
 # Default is True, set to False to disable auto importing Intel Extension for PyTorch.
 USE_NPU = os.getenv("BIGDL_USE_NPU", 'False').lower() in ('true', '1', 't')
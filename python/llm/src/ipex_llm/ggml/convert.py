@@ -46,18 +46,21 @@ from pathlib import Path
 import os
 
 
-def _convert_llama(model_path, outfile_dir, outtype):
-    model_path = Path(model_path)
-    outfile_dir = Path(outfile_dir)
-    model_plus = load_some_model(model_path)
+def _load_llama(model_path):
+    model_plus = load_some_model(Path(model_path))
     if model_plus.vocab is not None:
         vocab = model_plus.vocab
     else:
         vocab_dir = model_plus.paths[0].parent
         vocab = load_vocab(vocab_dir, vocabtype='spm')
     params = Params.load(model_plus)
-    model = model_plus.model
-    model = do_necessary_conversions(model, params)
+    model = do_necessary_conversions(model_plus.model, params)
+    return model, params, vocab
+
+
+def _convert_llama(model_path, outfile_dir, outtype):
+    outfile_dir = Path(outfile_dir)
+    model, params, vocab = _load_llama(model_path)
     output_type = pick_output_type(model, outtype)
     model = convert_to_output_type(model, output_type)
     outfile_path = default_outfile([outfile_dir], output_type)
@@ -114,3 +117,32 @@ def _convert_to_ggml(model_path: str, outfile_dir: str,
         _convert_bloom(model_path, outfile_dir, outtype)
     if model_family == 'starcoder':
         _convert_starcoder(model_path, outfile_dir, outtype)
+
+
+def _convert_to_quantized_ggml(model_path: str, outfile_path: str,
+                               model_family: str = 'llama', dtype: str = 'q4_0',
+                               concurrency: int = 8):
+    """
+    Convert Hugging Face llama-like model to a quantized ggml file in a single pass,
+    tensors are loaded lazily and quantized in-process without an fp16 intermediate file.
+
+    :param model_path: Path to a *directory* for huggingface checkpoint.
+    :param outfile_path: str, the path of the output quantized ggml file.
+    :param model_family: Which model family your input model belongs to. Default to `llama`.
+            Now only `llama` is supported.
+    :param dtype: Quantization method, now `q4_0`/`q8_0` are supported. Default to `q4_0`.
+    :param concurrency: int value, the number of threads quantizing tensors.
+    """
+    invalidInputError(model_family == 'llama',
+                      "Now we only support single pass quantization of model family 'llama'",
+                      "{} is not supported.".format(model_family))
+    invalidInputError(os.path.exists(model_path),
+                      "The file {} was not found".format(model_path))
+    invalidInputError(dtype in ['q4_0', 'q8_0'],
+                      "Now we only support quantizing to 'q4_0'/'q8_0' format",
+                      "{} is not in the list.".format(dtype))
+
+    print("It may takes several minutes to load the original model, please wait...")
+    model, params, vocab = _load_llama(model_path)
+    OutputFile.write_all_quantized(Path(outfile_path), params, dtype, model, vocab,
+                                   concurrency=concurrency)
@@ -16,12 +16,15 @@
 import os
 import time
 from pathlib import Path
-from ipex_llm.ggml.convert import _convert_to_ggml
+from ipex_llm.ggml.convert import _convert_to_ggml, _convert_to_quantized_ggml
 from ipex_llm.ggml.quantize import quantize
 from ipex_llm.utils.common import invalidInputError
 import argparse
+import logging
 import tempfile
 
+logger = logging.getLogger(__name__)
+
 
 def convert_model(input_path: str,
                   output_path: str,
@@ -45,7 +48,8 @@ def convert_model(input_path: str,
             Now only `int4` and `int8` are supported, and `int8` only works for `llama`
             and `gptneox`.
     :param tmp_path: Which path to store the intermediate model during the conversion process.
-            Default to `None` so that intermediate model will not be saved.
+            Default to `None` so that intermediate model will not be saved. `llama` models
+            are quantized in a single pass without intermediate model.
 
     :return: the path string to the converted lower precision checkpoint.
     """
@@ -78,6 +82,18 @@ def convert_model(input_path: str,
                           family('llama', 'gptneox', 'starcoder')",
                           "{} is not in the list.".format(model_family))
 
+    if model_family == 'llama':
+        if tmp_path is not None:
+            logger.warning(f"tmp_path {tmp_path} is unused, llama models are quantized in a "
+                           "single pass without intermediate model.")
+        output_filename = os.path.join(output_path,
+                                       "bigdl_llm_{}_{}.bin".format(model_family, dtype))
+        _convert_to_quantized_ggml(model_path=input_path,
+                                   outfile_path=output_filename,
+                                   model_family=model_family,
+                                   dtype=dtype)
+        return output_filename
+
     if tmp_path is not None:
         model_name = Path(input_path).stem
         tmp_ggml_file_path = os.path.join(tmp_path, f'{model_name}_{int(time.time())}')
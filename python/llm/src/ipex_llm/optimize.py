@@ -264,4 +264,6 @@ def optimize_model(model, low_bit='sym_int4', optimize_llm=True, modules_to_not_
     model._bigdl_config = dict()
     model._bigdl_config["bigdl_transformers_low_bit"] = low_bit
     model.save_low_bit = types.MethodType(_save_low_bit, model)
+    from ipex_llm.transformers.dequant_cache import calibrate_model
+    calibrate_model(model)
     return model
@@ -55,6 +55,14 @@ class InputsRequest(BaseModel):
     stream: Optional[bool] = False
     req_type: str = 'completion'
     transcription_request:  Optional[TranscriptionRequest] = None
+    session_id: Optional[str] = None
+    # name of a LoRA adapter registered to the model worker, see `LoraAdapterPool`
+    adapter_name: Optional[str] = None
+
+
+class LoraAdapterRequest(BaseModel):
+    name: str
+    path: str
 
 
 class ChatCompletionRequest(BaseModel):
@@ -71,7 +79,10 @@ class ChatCompletionRequest(BaseModel):
     top_k: Optional[int] = None
     repetition_penalty: Optional[float] = None
     presence_penalty: Optional[float] = None
+    frequency_penalty: Optional[float] = None
     temperature: Optional[float] = None
+    # reuse the kv cache of the previous turns, see `ipex_llm.transformers.session_cache`
+    session_id: Optional[str] = None
 
 
 class CompletionRequest(BaseModel):
@@ -84,6 +95,7 @@ class CompletionRequest(BaseModel):
     top_k: Optional[int] = None
     repetition_penalty: Optional[float] = None
     presence_penalty: Optional[float] = None
+    frequency_penalty: Optional[float] = None
     temperature: Optional[float] = None
 
 
@@ -345,9 +357,18 @@ def set_parameters(req):
         do_sample = False
     return Parameters(max_new_tokens=n_predict, do_sample=do_sample, min_new_tokens=req.min_tokens,
                       top_p=req.top_p, repetition_penalty=repetition_penalty,
+                      frequency_penalty=req.frequency_penalty,
                       temperature=req.temperature, top_k=req.top_k)
 
 
+def get_adapter_name(model):
+    # like other OpenAI compatible servers, a LoRA adapter is requested by its name as model
+    lora_pool = getattr(local_model, "lora_pool", None)
+    if lora_pool is not None and model in lora_pool.registry:
+        return model
+    return None
+
+
 @app.post("/v1/chat/completions")
 async def create_chat_completion(request: ChatCompletionRequest):
     model_name = local_model.model_name
@@ -357,7 +378,9 @@ async def create_chat_completion(request: ChatCompletionRequest):
         parameters=set_parameters(request),
         image_list=image_list if len(image_list) >= 1 else None,
         stream=request.stream,
-        req_type="chat"
+        req_type="chat",
+        session_id=request.session_id,
+        adapter_name=get_adapter_name(request.model),
     )
     if request.stream:
         request_id, result = await generate_stream(inputs_request)
@@ -382,7 +405,8 @@ async def create_completion(request: CompletionRequest):
         inputs=request.prompt,
         parameters=set_parameters(request),
         stream=request.stream,
-        req_type="completion"
+        req_type="completion",
+        adapter_name=get_adapter_name(request.model),
     )
     if request.stream:
         request_id, result = await generate_stream(inputs_request)
@@ -400,6 +424,37 @@ async def create_completion(request: CompletionRequest):
     return result
 
 
+@app.get("/prefix_cache/stats")
+async def prefix_cache_stats():
+    # hit rate of `ipex_llm.transformers.prefix_cache`, enabled by IPEX_LLM_PREFIX_CACHE_GB
+    prefix_cache = getattr(local_model, "prefix_cache", None)
+    return prefix_cache.stats() if prefix_cache is not None else {}
+
+
+@app.get("/v1/lora_adapters")
+async def show_lora_adapters():
+    # registered and loaded adapters, their memory and load latency
+    lora_pool = getattr(local_model, "lora_pool", None)
+    invalidInputError(lora_pool is not None, "LoRA adapters are not enabled for this model.")
+    return lora_pool.stats()
+
+
+@app.post("/v1/lora_adapters")
+async def register_lora_adapter(request: LoraAdapterRequest):
+    lora_pool = getattr(local_model, "lora_pool", None)
+    invalidInputError(lora_pool is not None, "LoRA adapters are not enabled for this model.")
+    lora_pool.register(request.name, request.path)
+    return lora_pool.stats()
+
+
+@app.delete("/v1/lora_adapters/{name}")
+async def unregister_lora_adapter(name: str):
+    lora_pool = getattr(local_model, "lora_pool", None)
+    invalidInputError(lora_pool is not None, "LoRA adapters are not enabled for this model.")
+    lora_pool.unregister(name)
+    return lora_pool.stats()
+
+
 @app.post("/v1/audio/transcriptions")
 async def transcriptions(
     file: UploadFile=File(...),
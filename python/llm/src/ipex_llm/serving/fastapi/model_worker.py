@@ -21,18 +21,25 @@ import time
 import asyncio
 from PIL import Image
 import requests
-from transformers import TextIteratorStreamer
+from transformers import TextIteratorStreamer, LogitsProcessorList
+from ipex_llm.utils.common import invalidInputError
 logger = logging.get_logger(__name__)
 
 
 class ModelWorker:
-    def __init__(self, checkpoint, low_bit, model_type="normal", torch_dtype=torch.float16):
+    def __init__(self, checkpoint, low_bit, model_type="normal", torch_dtype=torch.float16,
+                 lora_adapters=None, max_loaded_adapters=4):
         self.dtype = torch_dtype
+        self.lora_pool = None
         start = time.perf_counter()
         if model_type == "audio":
             self.model = self.load_model(checkpoint, low_bit, "audio")
         else:
             model = self.load_model(checkpoint, low_bit)
+            if lora_adapters is not None:
+                # LoRA adapters served over the shared low-bit model, selected per request
+                from ipex_llm.transformers.lora_pool import LoraAdapterPool
+                self.lora_pool = LoraAdapterPool(model, lora_adapters, max_loaded_adapters)
             if "glm-4v" not in checkpoint.lower():
                 from ipex_llm.utils import BenchmarkWrapper
                 self.model = BenchmarkWrapper(model, do_print=True)
@@ -44,6 +51,10 @@ class ModelWorker:
         self.waiting_requests = asyncio.Queue()
         self.streamer = {}
         self.model_name = checkpoint
+        from ipex_llm.transformers.session_cache import get_session_cache
+        self.session_cache = get_session_cache()
+        from ipex_llm.transformers.prefix_cache import get_prefix_cache
+        self.prefix_cache = get_prefix_cache()
 
     def load_model(self, model_path, low_bit='sym_int4', model_type="normal"):
         if model_type == "audio":
@@ -163,7 +174,8 @@ class ModelWorker:
             inputs = tokenizer(plain_texts, return_tensors="pt", padding=True)
             input_ids = inputs.input_ids.to('xpu')
         parameters = prompt_request.parameters
-        return input_ids, parameters, request_id, inputs_embeds, inputs
+        return input_ids, parameters, request_id, inputs_embeds, inputs, \
+            prompt_request.session_id, prompt_request.adapter_name
 
     @torch.no_grad()
     async def process_step(self, tokenizer, result_dict, processor=None):
@@ -177,12 +189,18 @@ class ModelWorker:
                                         streamer=self.streamer[request_id],
                                         forced_decoder_ids=decoder_ids)
             else:
-                input_ids, parameters, request_id, inputs_embeds, inputs = \
-                    await self.add_request(tokenizer)
+                input_ids, parameters, request_id, inputs_embeds, inputs, session_id, \
+                    adapter_name = await self.add_request(tokenizer)
                 self.streamer[request_id] = TextIteratorStreamer(tokenizer, skip_prompt=True)
 
                 def model_generate():
                     generate_kwargs = {k: v for k, v in parameters.dict().items() if v is not None}
+                    frequency_penalty = generate_kwargs.pop("frequency_penalty", None)
+                    if frequency_penalty:
+                        from ipex_llm.transformers.logits_process import BatchedLogitsProcessor
+                        generate_kwargs["logits_processor"] = LogitsProcessorList([
+                            BatchedLogitsProcessor(frequency_penalty=frequency_penalty)
+                        ])
                     if "codegeex" in self.model_name.lower():
                         eos_token_id = [tokenizer.eos_token_id,
                                         tokenizer.convert_tokens_to_ids("<|user|>"),
@@ -194,7 +212,23 @@ class ModelWorker:
                             tokenizer.convert_tokens_to_ids(['[UNUSED_TOKEN_145]'])[0]
                         ]
                         generate_kwargs["eos_token_id"] = eos_token_id
-                    if input_ids is not None:
+                    if adapter_name is not None:
+                        # the kv caches of the base model are not reused with an adapter
+                        invalidInputError(self.lora_pool is not None and input_ids is not None,
+                                          "LoRA adapters are not enabled for this model.")
+                        self.lora_pool.generate(self.model, input_ids,
+                                                [adapter_name] * input_ids.size(0),
+                                                streamer=self.streamer[request_id],
+                                                **generate_kwargs)
+                    elif input_ids is not None and self.session_cache is not None:
+                        self.session_cache.generate(self.model, input_ids, session_id,
+                                                    streamer=self.streamer[request_id],
+                                                    **generate_kwargs)
+                    elif input_ids is not None and self.prefix_cache is not None:
+                        self.prefix_cache.generate(self.model, input_ids,
+                                                   streamer=self.streamer[request_id],
+                                                   **generate_kwargs)
+                    elif input_ids is not None:
                         self.model.generate(input_ids,
                                             streamer=self.streamer[request_id], **generate_kwargs)
                     elif inputs_embeds is not None:
@@ -27,6 +27,7 @@ class Parameters(BaseModel):
     do_sample: Optional[bool] = None
     min_new_tokens: Optional[int] = None
     repetition_penalty: Optional[float] = None
+    frequency_penalty: Optional[float] = None
     temperature: Optional[float] = None
     top_k: Optional[int] = None
     top_p: Optional[float] = None
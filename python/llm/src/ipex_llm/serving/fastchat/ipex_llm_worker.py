@@ -73,6 +73,8 @@ class BigDLLLMWorker(BaseModelWorker):
         load_low_bit_model: bool = False,
         stream_interval: int = 4,
         benchmark: str = "true",
+        session_cache_gb: float = 0,
+        session_idle_timeout: float = 600,
     ):
         super().__init__(
             controller_addr,
@@ -112,6 +114,11 @@ class BigDLLLMWorker(BaseModelWorker):
         self.stream_interval = stream_interval
         self.context_len = get_context_length(self.model.config)
         self.embed_in_truncate = embed_in_truncate
+        self.session_cache = None
+        if session_cache_gb > 0 and not self.model.config.is_encoder_decoder:
+            from ipex_llm.transformers.session_cache import SessionKVCache
+            self.session_cache = SessionKVCache(session_cache_gb, session_idle_timeout)
+            logger.info(f"Keep the kv cache of chat sessions within {session_cache_gb} GB")
         if not no_register:
             self.init_heart_beat()
 
@@ -342,7 +349,11 @@ class BigDLLLMWorker(BaseModelWorker):
         )
 
         def model_generate():
-            self.model.generate(input_ids, **generated_kwargs)
+            if self.session_cache is not None:
+                self.session_cache.generate(self.model, input_ids, params.get("session_id"),
+                                            **generated_kwargs)
+            else:
+                self.model.generate(input_ids, **generated_kwargs)
 
         t1 = Thread(target=model_generate)
         t1.start()
@@ -518,6 +529,19 @@ if __name__ == "__main__":
         help="Load models that have been converted/saved using ipex-llm's save_low_bit interface",
     )
     parser.add_argument("--embed-in-truncate", action="store_true")
+    parser.add_argument(
+        "--session-cache-gb",
+        type=float,
+        default=0,
+        help="Memory budget in GB to keep the kv cache of chat sessions between turns, "
+        "0 to disable",
+    )
+    parser.add_argument(
+        "--session-idle-timeout",
+        type=float,
+        default=600,
+        help="Seconds after which the kv cache of an idle chat session is dropped",
+    )
 
     args = parser.parse_args()
     worker = BigDLLLMWorker(
@@ -537,5 +561,7 @@ if __name__ == "__main__":
         args.load_low_bit_model,
         args.stream_interval,
         args.benchmark,
+        args.session_cache_gb,
+        args.session_idle_timeout,
     )
     uvicorn.run(app, host=args.host, port=args.port, log_level="info")
@@ -31,6 +31,8 @@ import asyncio
 import argparse
 import json
 import os
+import time
+from functools import lru_cache
 from typing import Generator, Optional, Union, Dict, List, Any
 
 import aiohttp
@@ -40,7 +42,6 @@ from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse, JSONResponse
 from fastapi.security.http import HTTPAuthorizationCredentials, HTTPBearer
-import httpx
 
 try:
     from pydantic.v1 import BaseSettings
@@ -95,12 +96,82 @@ logger = build_logger("tgi_api_server", "tgi_api_server.log")
 conv_template_map = {}
 
 fetch_timeout = aiohttp.ClientTimeout(total=3 * 3600)
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    Return the shared session, whose keep-alive connections to the controller and the
+    workers are reused by all requests.
+    """
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=0, keepalive_timeout=60)
+        _session = aiohttp.ClientSession(timeout=fetch_timeout, connector=connector)
+    return _session
+
+
+class WorkerCache:
+    """
+    TTL cache of the model list, the worker addresses and the context lengths, so that a
+    request does not ask the controller and the worker for them again. All entries are
+    dropped when the model list reported by the controller changes, and the entries of
+    a worker are dropped when a request to it fails.
+
+    The worker addresses have their own `address_ttl`, 0 by default, because the
+    controller dispatches every request among the workers of a model, while a cached
+    address sends all requests to one worker until it expires.
+    """
+
+    def __init__(self, ttl: float = 30, address_ttl: float = 0):
+        self.ttl = ttl
+        self.address_ttl = address_ttl
+        self.entries = {}
+        self.models = None
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expire_time, value = entry
+        if time.monotonic() > expire_time:
+            del self.entries[key]
+            return None
+        return value
+
+    def put(self, key, value, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl > 0:
+            self.entries[key] = (time.monotonic() + ttl, value)
+
+    def update_models(self, models):
+        if self.models is not None and sorted(models) != sorted(self.models):
+            logger.info(f"Models changed from {self.models} to {models}, clear worker cache")
+            self.entries.clear()
+        self.models = models
+        self.put(("models",), models)
+
+    def invalidate_worker(self, url):
+        for key, (_, value) in list(self.entries.items()):
+            if key[0] == "address":
+                worker_addr = value
+            elif key[0] == "context_length":
+                worker_addr = key[1]
+            else:
+                continue
+            if url.startswith(worker_addr):
+                del self.entries[key]
+
+
+worker_cache = WorkerCache()
+
 
 async def fetch_remote(url, pload=None, name=None):
-    async with aiohttp.ClientSession(timeout=fetch_timeout) as session:
-        async with session.post(url, json=pload) as response:
+    try:
+        async with get_session().post(url, json=pload) as response:
             chunks = []
             if response.status != 200:
+                worker_cache.invalidate_worker(url)
                 ret = {
                     "text": f"{response.reason}",
                     "error_code": ErrorCode.INTERNAL_ERROR,
@@ -109,7 +180,10 @@ async def fetch_remote(url, pload=None, name=None):
 
             async for chunk, _ in response.content.iter_chunks():
                 chunks.append(chunk)
-        output = b"".join(chunks)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        worker_cache.invalidate_worker(url)
+        raise
+    output = b"".join(chunks)
 
     if name is not None:
         res = json.loads(output)
@@ -124,10 +198,19 @@ class AppSettings(BaseSettings):
     # The address of the model controller.
     controller_address: str = "http://localhost:21001"
     api_keys: Optional[List[str]] = None
+    # The tokenizer paths by model name, to count prompt tokens locally instead of
+    # asking the worker.
+    tokenizers: Dict[str, str] = {}
 
 
 app_settings = AppSettings()
 app = fastapi.FastAPI()
+
+
+@app.on_event("shutdown")
+async def close_session():
+    if _session is not None:
+        await _session.close()
 headers = {"User-Agent": "FastChat API Server"}
 get_bearer_token = HTTPBearer(auto_error=False)
 
@@ -183,14 +266,13 @@ async def check_length(request, prompt, max_tokens, worker_addr):
     ):  # model worker not support max_tokens=None
         max_tokens = 1024 * 1024
 
-    context_len = await fetch_remote(
-        worker_addr + "/model_details", {"model": request.model}, "context_length"
-    )
-    token_num = await fetch_remote(
-        worker_addr + "/count_token",
-        {"model": request.model, "prompt": prompt},
-        "count",
-    )
+    context_len = worker_cache.get(("context_length", worker_addr, request.model))
+    if context_len is None:
+        context_len = await fetch_remote(
+            worker_addr + "/model_details", {"model": request.model}, "context_length"
+        )
+        worker_cache.put(("context_length", worker_addr, request.model), context_len)
+    token_num = await count_token(request.model, prompt, worker_addr)
     length = min(max_tokens, context_len - token_num)
 
     if length <= 0:
@@ -202,6 +284,32 @@ async def check_length(request, prompt, max_tokens, worker_addr):
     return length, None
 
 
+@lru_cache(maxsize=None)
+def get_tokenizer(path: str):
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(path, trust_remote_code=True)
+
+
+def _count_token_locally(model_name, prompt):
+    tokenizer = get_tokenizer(app_settings.tokenizers[model_name])
+    # same as `count_token` of the worker
+    try:
+        return len(tokenizer(prompt).input_ids)
+    except TypeError:
+        return tokenizer.num_tokens(prompt)
+
+
+async def count_token(model_name, prompt, worker_addr):
+    if model_name in app_settings.tokenizers:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, _count_token_locally, model_name, prompt)
+    return await fetch_remote(
+        worker_addr + "/count_token",
+        {"model": model_name, "prompt": prompt},
+        "count",
+    )
+
+
 def check_requests(request) -> Optional[JSONResponse]:
     # Check all params
     if request.parameters.max_new_tokens is not None and request.parameters.max_new_tokens <= 0:
@@ -395,6 +503,10 @@ async def get_worker_address(model_name: str) -> str:
     :return: Worker address from the controller
     :raises: :class:`ValueError`: No available worker for requested model
     """
+    worker_addr = worker_cache.get(("address", model_name))
+    if worker_addr is not None:
+        return worker_addr
+
     controller_address = app_settings.controller_address
     worker_addr = await fetch_remote(
         controller_address + "/get_worker_address", {"model": model_name}, "address"
@@ -403,6 +515,7 @@ async def get_worker_address(model_name: str) -> str:
     # No available worker
     if worker_addr == "":
         raise ValueError(f"No available worker for {model_name}")
+    worker_cache.put(("address", model_name), worker_addr, worker_cache.address_ttl)
     logger.debug(f"model_name: {model_name}, worker_addr: {worker_addr}")
     return worker_addr
 
@@ -416,13 +529,19 @@ async def get_conv(model_name: str, worker_addr: str):
         conv_template_map[(worker_addr, model_name)] = conv_template
     return conv_template
 
+async def get_models(refresh: bool = False) -> List[str]:
+    models = None if refresh else worker_cache.get(("models",))
+    if models is None:
+        controller_address = app_settings.controller_address
+        ret = await fetch_remote(controller_address + "/refresh_all_workers")
+        models = await fetch_remote(controller_address + "/list_models", None, "models")
+        worker_cache.update_models(models)
+    return sorted(models)
+
+
 @app.get("/v1/models", dependencies=[Depends(check_api_key)])
 async def show_available_models():
-    controller_address = app_settings.controller_address
-    ret = await fetch_remote(controller_address + "/refresh_all_workers")
-    models = await fetch_remote(controller_address + "/list_models", None, "models")
- 
-    models.sort()
+    models = await get_models(refresh=True)
     # TODO: return real model permission details
     model_cards = []
     for m in models:
@@ -430,8 +549,8 @@ async def show_available_models():
     return ModelList(data=model_cards)
 
 async def get_last_model_name_from_list():
-    models = await show_available_models()
-    return models.data[-1].id
+    models = await get_models()
+    return models[-1]
 
 @app.post("/generate", dependencies=[Depends(check_api_key)])
 async def create_chat_completion(request: ChatCompletionRequest):
@@ -608,25 +727,27 @@ async def chat_completion_stream_generator(
     yield "data: [DONE]\n\n"
 
 async def generate_completion_stream(payload: Dict[str, Any], worker_addr: str):
-    controller_address = app_settings.controller_address
-    async with httpx.AsyncClient() as client:
-        delimiter = b"\0"
-        async with client.stream(
-            "POST",
+    delimiter = b"\0"
+    try:
+        async with get_session().post(
             worker_addr + "/worker_generate_stream",
             headers=headers,
             json=payload,
-            timeout=WORKER_API_TIMEOUT,
+            # bound each connect and read, not the whole stream of a long generation
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=WORKER_API_TIMEOUT,
+                                          sock_read=WORKER_API_TIMEOUT),
         ) as response:
-            # content = await response.aread()
             buffer = b""
-            async for raw_chunk in response.aiter_raw():
+            async for raw_chunk in response.content.iter_any():
                 buffer += raw_chunk
                 while (chunk_end := buffer.find(delimiter)) >= 0:
                     chunk, buffer = buffer[:chunk_end], buffer[chunk_end + 1 :]
                     if not chunk:
                         continue
                     yield json.loads(chunk.decode())
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        worker_cache.invalidate_worker(worker_addr)
+        raise
 
 
 async def generate_completion(payload: Dict[str, Any], worker_addr: str):
@@ -661,6 +782,28 @@ def create_openai_api_server():
         type=lambda s: s.split(","),
         help="Optional list of comma separated API keys",
     )
+    parser.add_argument(
+        "--tokenizer",
+        type=str,
+        action="append",
+        default=[],
+        metavar="MODEL_NAME=PATH",
+        help="Tokenizer path of a model to count its prompt tokens locally, "
+        "can be repeated for several models",
+    )
+    parser.add_argument(
+        "--worker-cache-ttl",
+        type=float,
+        default=30,
+        help="Seconds to cache the model list and context lengths, 0 to disable",
+    )
+    parser.add_argument(
+        "--worker-address-ttl",
+        type=float,
+        default=0,
+        help="Seconds to cache the worker address of a model, which sends all its "
+        "requests to one worker instead of the one chosen by the controller",
+    )
     parser.add_argument(
         "--ssl",
         action="store_true",
@@ -679,6 +822,15 @@ def create_openai_api_server():
     )
     app_settings.controller_address = args.controller_address
     app_settings.api_keys = args.api_keys
+    tokenizers = {}
+    for item in args.tokenizer:
+        model_name, sep, path = item.partition("=")
+        if not sep or not model_name or not path:
+            parser.error(f"--tokenizer expects MODEL_NAME=PATH, got {item}")
+        tokenizers[model_name] = path
+    app_settings.tokenizers = tokenizers
+    worker_cache.ttl = args.worker_cache_ttl
+    worker_cache.address_ttl = args.worker_address_ttl
 
     logger.info(f"args: {args}")
     return args
@@ -15,16 +15,54 @@
 #
 
 
-from .convert import ggml_convert_low_bit, get_enable_ipex, convert_model_hybrid
-from .model import AutoModelForCausalLM, AutoModel, AutoModelForSeq2SeqLM, \
-        AutoModelForSpeechSeq2Seq, AutoModelForQuestionAnswering, \
-        AutoModelForSequenceClassification, AutoModelForMaskedLM, \
-        AutoModelForNextSentencePrediction, AutoModelForMultipleChoice, \
-        AutoModelForTokenClassification
+from importlib.metadata import version, PackageNotFoundError
+from ipex_llm.utils.common.lazyimport import lazy_module_getattr, lazy_module_dir
 
-import transformers
-if transformers.__version__ >= '4.45.0':
-    from .model import Qwen2VLForConditionalGeneration
+# The public API is imported on first access, since `pipeline_parallel` (pydantic,
+# torch.distributed) and `model` are expensive to import and most processes only
+# need a few of them.
+__getattr__ = lazy_module_getattr(__name__, {
+    "ggml_convert_low_bit": "ipex_llm.transformers.convert",
+    "get_enable_ipex": "ipex_llm.transformers.convert",
+    "convert_model_hybrid": "ipex_llm.transformers.convert",
+    "AutoModelForCausalLM": "ipex_llm.transformers.model",
+    "AutoModel": "ipex_llm.transformers.model",
+    "AutoModelForSeq2SeqLM": "ipex_llm.transformers.model",
+    "AutoModelForSpeechSeq2Seq": "ipex_llm.transformers.model",
+    "AutoModelForQuestionAnswering": "ipex_llm.transformers.model",
+    "AutoModelForSequenceClassification": "ipex_llm.transformers.model",
+    "AutoModelForMaskedLM": "ipex_llm.transformers.model",
+    "AutoModelForNextSentencePrediction": "ipex_llm.transformers.model",
+    "AutoModelForMultipleChoice": "ipex_llm.transformers.model",
+    "AutoModelForTokenClassification": "ipex_llm.transformers.model",
+    # only defined with transformers >= 4.45.0
+    "Qwen2VLForConditionalGeneration": "ipex_llm.transformers.model",
+    "BigdlNativeForCausalLM": "ipex_llm.transformers.modelling_bigdl",
+    "LlamaForCausalLM": "ipex_llm.transformers.modelling_bigdl",
+    "ChatGLMForCausalLM": "ipex_llm.transformers.modelling_bigdl",
+    "GptneoxForCausalLM": "ipex_llm.transformers.modelling_bigdl",
+    "BloomForCausalLM": "ipex_llm.transformers.modelling_bigdl",
+    "StarcoderForCausalLM": "ipex_llm.transformers.modelling_bigdl",
+    "init_pipeline_parallel": "ipex_llm.transformers.pipeline_parallel",
+    "PPModelWorker": "ipex_llm.transformers.pipeline_parallel",
+}, fallback_modules=("ipex_llm.transformers.modelling_bigdl",))
 
-from .modelling_bigdl import *
-from .pipeline_parallel import init_pipeline_parallel, PPModelWorker
+__all__ = [
+    "ggml_convert_low_bit", "get_enable_ipex", "convert_model_hybrid",
+    "AutoModelForCausalLM", "AutoModel", "AutoModelForSeq2SeqLM",
+    "AutoModelForSpeechSeq2Seq", "AutoModelForQuestionAnswering",
+    "AutoModelForSequenceClassification", "AutoModelForMaskedLM",
+    "AutoModelForNextSentencePrediction", "AutoModelForMultipleChoice",
+    "AutoModelForTokenClassification",
+    "BigdlNativeForCausalLM", "LlamaForCausalLM", "ChatGLMForCausalLM",
+    "GptneoxForCausalLM", "BloomForCausalLM", "StarcoderForCausalLM",
+    "init_pipeline_parallel", "PPModelWorker",
+]
+try:
+    # read the installed version without importing transformers
+    if version("transformers") >= "4.45.0":
+        __all__.append("Qwen2VLForConditionalGeneration")
+except PackageNotFoundError:
+    pass
+
+__dir__ = lazy_module_dir(__name__, __all__)
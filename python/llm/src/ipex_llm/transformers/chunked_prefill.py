@@ -0,0 +1,94 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Chunked prefill bounds the activation memory of very long prompts: the prompt goes
+# through the model in chunks of `prefill_chunk_size` tokens appended to the kv cache,
+# so MLP activations and attention scores are `[chunk, ...]` instead of `[seq, ...]`.
+# Only the last position of each chunk reaches the lm_head (`reshape_lm_head_input`),
+# and the last chunk is left to the normal `generate`, which computes the first logits.
+#
+# Usage:
+#   output = model.generate(input_ids, max_new_tokens=32, prefill_chunk_size=2048)
+# or set IPEX_LLM_PREFILL_CHUNK_SIZE=2048 to apply it to all `generate` calls.
+
+import inspect
+import os
+
+import torch
+
+from ipex_llm.transformers.utils import logger
+
+PREFILL_CHUNK_SIZE_ENV = "IPEX_LLM_PREFILL_CHUNK_SIZE"
+
+
+def get_prefill_chunk_size(prefill_chunk_size=None):
+    if prefill_chunk_size is None and os.environ.get(PREFILL_CHUNK_SIZE_ENV, None):
+        prefill_chunk_size = int(os.environ[PREFILL_CHUNK_SIZE_ENV])
+    return prefill_chunk_size
+
+
+@torch.no_grad()
+def chunked_prefill(model, input_ids: torch.Tensor, attention_mask=None,
+                    chunk_size: int = 2048):
+    """
+    Run all but the last chunk of `input_ids` through `model`, chunk by chunk.
+
+    :param model: a decoder-only model whose forward uses `DynamicNormalCache`.
+    :param input_ids: `[batch, seq_len]` token ids of the prompt.
+    :param attention_mask: `[batch, seq_len]` attention mask of the prompt, or None.
+    :param chunk_size: int value, number of tokens in each chunk.
+
+    :return: the `DynamicNormalCache` of the prefilled tokens, to be passed to `generate`
+        as `past_key_values` with the full `input_ids`, or None if nothing is prefilled
+        because the prompt is short or the model does not use `DynamicNormalCache`
+    """
+    from ipex_llm.transformers.kv import DynamicNormalCache
+
+    seq_len = input_ids.size(1)
+    # leave at least one token to `generate`, it computes the logits of the last one
+    prefill_len = (seq_len - 1) // chunk_size * chunk_size
+    if prefill_len == 0:
+        return None
+
+    parameters = inspect.signature(model.forward).parameters
+    if attention_mask is not None:
+        position_ids = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)
+    else:
+        position_ids = torch.arange(seq_len, device=input_ids.device).unsqueeze(0)
+
+    past_key_values = DynamicNormalCache()
+    for start in range(0, prefill_len, chunk_size):
+        end = start + chunk_size
+        kwargs = {}
+        if attention_mask is not None:
+            kwargs["attention_mask"] = attention_mask[:, :end]
+        if "position_ids" in parameters:
+            kwargs["position_ids"] = position_ids[:, start:end]
+        if "cache_position" in parameters:
+            kwargs["cache_position"] = torch.arange(start, end, device=input_ids.device)
+        outputs = model(input_ids=input_ids[:, start:end],
+                        past_key_values=past_key_values,
+                        use_cache=True,
+                        return_dict=True,
+                        **kwargs)
+        past_key_values = outputs.past_key_values
+        del outputs
+        if not isinstance(past_key_values, DynamicNormalCache):
+            logger.warning(f"Chunked prefill is only supported for models using "
+                           f"DynamicNormalCache, but {type(model).__name__} uses "
+                           f"{type(past_key_values).__name__}, fallback to normal prefill.")
+            return None
+    return past_key_values
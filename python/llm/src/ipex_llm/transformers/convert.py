@@ -619,8 +619,12 @@ def _replace_with_low_bit_linear(model, qtype, modules_to_not_convert=None,
                                                                        full_module_name,
                                                                        imatrix_data,
                                                                        model_config)
+                    if isinstance(mixed_precision, dict):
+                        # per module qtype of a mixed precision plan
+                        from ipex_llm.transformers.mixed_precision import get_plan_qtype
+                        cur_qtype = get_plan_qtype(mixed_precision, full_module_name, cur_qtype)
                     # mixed precison for lm_head
-                    if mixed_precision and is_lm_head(name, model_config, out_features):
+                    elif mixed_precision and is_lm_head(name, model_config, out_features):
                         if cur_qtype in [ggml_tensor_qtype["sym_int4"],
                                          ggml_tensor_qtype["asym_int4"]]:
                             cur_qtype = ggml_tensor_qtype["q6_k"]
@@ -1086,6 +1090,19 @@ def _optimize_pre(model, qtype=None):
     elif model.config.model_type == "qwen3_moe":
         from ipex_llm.transformers.models.qwen3_moe import merge_qkv
         model.apply(merge_qkv)
+
+    # for all models, record q/k/v and gate/up projections which are still separate linears
+    # sharing one input, to run them as one `MultiLowBitLinear` on CPU after conversion
+    if os.environ.get("IPEX_LLM_MULTI_LINEAR", "1") == "1":
+        from functools import partial
+        from ipex_llm.transformers.models.common import mark_multi_linear, \
+            MULTI_LINEAR_GROUPS, QKV_LINEAR_GROUP
+        groups = MULTI_LINEAR_GROUPS
+        if getattr(model.config, "is_encoder_decoder", False):
+            # decoder attention modules of encoder-decoder models (e.g. BART) are also
+            # used for cross attention, only decoder-only models group q/k/v
+            groups = [names for names in groups if names != QKV_LINEAR_GROUP]
+        model.apply(partial(mark_multi_linear, groups=groups))
     return model
 
 
@@ -1097,7 +1114,8 @@ def ggml_convert_low_bit(model, qtype, optimize_model=True,
                          imatrix_data=None,
                          embedding_qtype=None,
                          mixed_precision=False,
-                         disable_optimize_pre=False):
+                         disable_optimize_pre=False,
+                         disable_optimize_post=False):
     if qtype == ggml_tensor_qtype["sym_int4"] and torch.__version__ >= "2.6":
         logger.warning("sym_int4 is deprecated, use woq_int4 instead, "
                        "if you are loading saved sym_int4 low bit model, "
@@ -1169,10 +1187,23 @@ def ggml_convert_low_bit(model, qtype, optimize_model=True,
         elif device == "meta":
             # Do nothing here for weights are empty.
             pass
+        if has_been_replaced and optimize_model and not disable_optimize_pre:
+            from ipex_llm.transformers.models.common import apply_multi_low_bit_linear
+            model.apply(apply_multi_low_bit_linear)
+
+    if disable_optimize_post:
+        # only a part of the model is converted, the caller runs the model level
+        # replacements once the whole model is assembled
+        return model
 
     if optimize_model:
         model = _optimize_post(model)
 
+    _convert_qwen_vl_visual(model)
+    return model
+
+
+def _convert_qwen_vl_visual(model):
     if hasattr(model, "config") and hasattr(model.config, "model_type") and \
             model.config.model_type == "qwen" and hasattr(model.config, "visual"):
         # for Qwen-VL-Chat
@@ -1190,7 +1221,6 @@ def ggml_convert_low_bit(model, qtype, optimize_model=True,
                         visual_module.Resampler,
                         qwen_vl_resampler_forward
                         )
-    return model
 
 
 def convert_bigdl_other_module(model, dtype):
@@ -0,0 +1,268 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Dequantized weights for CPU prefill of `LowBitLinear`.
+#
+# With a large number of rows (long prompt prefill), a dense GEMM on the dequantized weight
+# is faster than the low-bit kernel on CPU, as long as the dequantization is not redone on
+# every call. Dequantized weights are kept in a process wide LRU cache with a memory budget:
+#   IPEX_LLM_DEQUANT_CACHE_GB     memory budget of the cache in GB, 0 (default) disables it
+#   IPEX_LLM_DEQUANT_CACHE_DTYPE  "bf16" or "fp32", default to bf16 on SPR and fp32 otherwise
+#
+# The number of rows from which the dense path is used is calibrated once per qtype at model
+# load by `calibrate_model`, both for a cached weight and for a weight to be dequantized on
+# the fly. BIGDL_LLM_LINEAR_THRESHOLD overrides the calibration.
+#
+# When the cache is disabled, only SYM_INT4 weights are dequantized on the fly on non-SPR
+# servers from BIGDL_LLM_LINEAR_THRESHOLD (default 512) rows, as without the cache.
+
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+import torch
+import torch.nn.functional as F
+
+from ipex_llm.transformers.utils import logger
+
+CACHE_GB_ENV = "IPEX_LLM_DEQUANT_CACHE_GB"
+CACHE_DTYPE_ENV = "IPEX_LLM_DEQUANT_CACHE_DTYPE"
+THRESHOLD_ENV = "BIGDL_LLM_LINEAR_THRESHOLD"
+# number of rows tried by the calibration, smaller inputs always use the low-bit kernel
+CALIBRATION_ROWS = [16, 32, 64, 128, 256, 512, 1024, 2048]
+
+
+class DequantizedWeightCache:
+    """
+    LRU cache of dequantized `LowBitLinear` weights within a memory budget.
+
+    :param max_bytes: int value, memory budget of the cache in bytes.
+    :param dtype: dtype of the dequantized weights, `torch.bfloat16` or `torch.float32`.
+    """
+
+    def __init__(self, max_bytes, dtype):
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+        self.entries = OrderedDict()
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # id of a layer -> finalizer removing its entry once the layer is freed
+        self.finalizers = {}
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, layer):
+        with self.lock:
+            entry = self.entries.get(id(layer), None)
+            # the weight may have been replaced since it was cached
+            if entry is None or entry[0] != layer.weight.data.data_ptr():
+                self.misses += 1
+                return None
+            self.entries.move_to_end(id(layer))
+            self.hits += 1
+            return entry[1]
+
+    def fits(self, nbytes):
+        return self.used_bytes + nbytes <= self.max_bytes
+
+    def put(self, layer, weight, evict=True):
+        """
+        Cache the dequantized `weight` of `layer`, least recently used entries are evicted
+        if `evict` is True, otherwise it is only cached if it fits in the budget.
+
+        :return: whether the weight is cached
+        """
+        nbytes = weight.numel() * weight.element_size()
+        with self.lock:
+            self._remove(id(layer))
+            if nbytes > self.max_bytes or (not evict and not self.fits(nbytes)):
+                return False
+            while not self.fits(nbytes):
+                self._remove(next(iter(self.entries)))
+            self.entries[id(layer)] = (layer.weight.data.data_ptr(), weight, nbytes)
+            self.used_bytes += nbytes
+            if id(layer) not in self.finalizers:
+                self.finalizers[id(layer)] = weakref.finalize(layer, self._forget, id(layer))
+        return True
+
+    def remove(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def _forget(self, key):
+        with self.lock:
+            self._remove(key)
+            self.finalizers.pop(key, None)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.used_bytes -= entry[2]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.used_bytes = 0
+
+
+_cache = None
+# qtype -> (rows from which a cached weight is used, rows from which dequantizing is used)
+_thresholds = {}
+_init_lock = threading.Lock()
+
+
+def get_dequant_cache():
+    global _cache
+    if _cache is None:
+        with _init_lock:
+            if _cache is None:
+                from ipex_llm.utils.isa_checker import is_spr
+                dtype = os.environ.get(CACHE_DTYPE_ENV, None)
+                if dtype is None:
+                    dtype = "bf16" if is_spr() else "fp32"
+                max_bytes = int(float(os.environ.get(CACHE_GB_ENV, "0")) * (1024 ** 3))
+                _cache = DequantizedWeightCache(
+                    max_bytes, torch.bfloat16 if dtype == "bf16" else torch.float32)
+    return _cache
+
+
+def dequantize_weight(layer, dtype):
+    from ipex_llm.transformers.low_bit_linear import ggml_convert_fp32
+    weight = ggml_convert_fp32(layer.weight.data, layer.weight_shape,
+                               layer.weight_length, layer.qtype)
+    return weight.to(dtype)
+
+
+def _best_time(func, repeat=2):
+    func()
+    best = float("inf")
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - tic)
+    return best
+
+
+def calibrate_thresholds(layer, dtype):
+    """
+    Time the low-bit kernel against a dense GEMM on the dequantized weight of `layer`.
+
+    :return: the smallest number of rows from which the dense GEMM is faster with a cached
+        weight, and with the dequantization included, `inf` if it is never faster
+    """
+    from ipex_llm.transformers.low_bit_linear import ggml_matmul_src1_x_src0_t
+    x = torch.randn(CALIBRATION_ROWS[-1], layer.in_len)
+    dense_weight = dequantize_weight(layer, dtype)
+    dequant_time = _best_time(lambda: dequantize_weight(layer, dtype))
+    cached, uncached = float("inf"), float("inf")
+    with torch.no_grad():
+        for rows in CALIBRATION_ROWS:
+            x_2d = x[:rows]
+            low_bit_time = _best_time(lambda: ggml_matmul_src1_x_src0_t(
+                layer.weight.data, x_2d, layer.weight_shape, layer.qtype))
+            dense_time = _best_time(lambda: F.linear(x_2d.to(dtype), dense_weight))
+            if cached == float("inf") and dense_time < low_bit_time:
+                cached = rows
+            if dense_time + dequant_time < low_bit_time:
+                uncached = rows
+                break
+    logger.info(f"Calibrated dense prefill thresholds of qtype {layer.qtype}: "
+                f"{cached} rows with cached weights, {uncached} rows without.")
+    return cached, uncached
+
+
+def get_thresholds(layer, dtype):
+    if layer.qtype not in _thresholds:
+        with _init_lock:
+            if layer.qtype not in _thresholds:
+                if os.environ.get(THRESHOLD_ENV, None) is not None:
+                    threshold = int(os.environ[THRESHOLD_ENV])
+                    _thresholds[layer.qtype] = (threshold, threshold)
+                else:
+                    _thresholds[layer.qtype] = calibrate_thresholds(layer, dtype)
+    return _thresholds[layer.qtype]
+
+
+def calibrate_model(model):
+    """
+    Calibrate the dense prefill thresholds of every qtype of the CPU `LowBitLinear` layers
+    of `model`, so that no calibration happens in a request. Does nothing if the cache is
+    disabled.
+    """
+    from ipex_llm.transformers.low_bit_linear import LowBitLinear, DEQUANT_UNSUPPORTED_QTYPES
+    cache = get_dequant_cache()
+    if not cache.enabled:
+        return
+    for module in model.modules():
+        if (
+            isinstance(module, LowBitLinear)
+            and module.qtype not in DEQUANT_UNSUPPORTED_QTYPES
+            and module.qtype not in _thresholds
+            and module.weight.device.type == "cpu"
+        ):
+            get_thresholds(module, cache.dtype)
+
+
+def _dequantize_on_the_fly(layer, rows):
+    # the behavior without cache: SYM_INT4 on non-SPR servers, from a fixed threshold
+    from ipex_llm.transformers.low_bit_linear import SYM_INT4, TORCH_LINEAR_THRESHOLD
+    from ipex_llm.utils.isa_checker import is_server, is_spr
+    if layer.qtype == SYM_INT4 and rows >= TORCH_LINEAR_THRESHOLD and \
+            is_server() and not is_spr():
+        return dequantize_weight(layer, torch.float32)
+    return None
+
+
+def get_dequantized_weight(layer, rows):
+    """
+    Return the dequantized weight of a CPU `LowBitLinear` if a dense GEMM is faster for an
+    input of `rows` rows, from the cache if possible, otherwise None.
+    """
+    cache = get_dequant_cache()
+    if not cache.enabled:
+        return _dequantize_on_the_fly(layer, rows)
+    if rows < CALIBRATION_ROWS[0]:
+        return None
+    thresholds = _thresholds.get(layer.qtype, None)
+    if thresholds is None:
+        # not calibrated at load, e.g. a model not loaded by ipex-llm, never calibrate
+        # in the middle of a request
+        return None
+    cached_threshold, uncached_threshold = thresholds
+    if rows < cached_threshold:
+        return None
+    weight = cache.get(layer)
+    if weight is not None:
+        return weight
+    if rows >= uncached_threshold:
+        # faster even with the dequantization, evict others to keep it for next time
+        weight = dequantize_weight(layer, cache.dtype)
+        cache.put(layer, weight, evict=True)
+        return weight
+    nbytes = layer.weight_length * torch.tensor([], dtype=cache.dtype).element_size()
+    if cache.fits(nbytes):
+        # slower this time but paid back by later calls, only worth it if
+        # nothing is evicted, otherwise sequential layers would evict each other
+        weight = dequantize_weight(layer, cache.dtype)
+        cache.put(layer, weight, evict=False)
+        return weight
+    return None
@@ -18,6 +18,9 @@
 # and https://github.com/ggerganov/llama.cpp/blob/master/ggml-quants.c
 # and https://github.com/ggerganov/llama.cpp/blob/master/llama.cpp
 
+import io
+import mmap
+import os
 import struct
 import functools
 import torch
@@ -28,9 +31,29 @@ from tqdm import tqdm
 from ipex_llm.utils.common import invalidInputError
 
 
+# numpy dtype of the numeric gguf value types, arrays of them are read in one go
+GGUF_NUMPY_TYPES = {
+    0: numpy.dtype("<u1"),
+    1: numpy.dtype("<i1"),
+    2: numpy.dtype("<u2"),
+    3: numpy.dtype("<i2"),
+    4: numpy.dtype("<u4"),
+    5: numpy.dtype("<i4"),
+    6: numpy.dtype("<f4"),
+    7: numpy.dtype("?"),
+    10: numpy.dtype("<u8"),
+    11: numpy.dtype("<i8"),
+    12: numpy.dtype("<f8"),
+}
+
+GGUF_VOCAB_CACHE_ENV = "IPEX_LLM_GGUF_VOCAB_CACHE"
+GGUF_VOCAB_KEYS = ['tokenizer.ggml.tokens', 'tokenizer.ggml.scores', 'tokenizer.ggml.token_type']
+
+
 class GGUFReader:
     def __init__(self, f: BufferedReader):
         self.f = f
+        self.mm = None
         self.funcs = {
             0: self.read_u8,
             1: self.read_i8,
@@ -104,12 +127,66 @@ class GGUFReader:
     def read_array(self):
         item_type = self.read_i32()
         item_num = self.read_u64()
+        if item_type in GGUF_NUMPY_TYPES:
+            dtype = GGUF_NUMPY_TYPES[item_type]
+            data = self.f.read(item_num * dtype.itemsize)
+            return numpy.frombuffer(data, dtype=dtype)
+        if item_type == 8:
+            return self.read_str_array(item_num)
         arr = [
             self.funcs[item_type]()
             for i in range(item_num)
         ]
         return arr
 
+    def _mmap(self):
+        if self.mm is None:
+            try:
+                self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+                return None
+        return self.mm
+
+    def str_array_offsets(self, item_num):
+        # offset table of a string array starting at the current position, the length
+        # prefixes are walked on the memory-mapped file instead of reading each string
+        mm = self._mmap()
+        if mm is None:
+            return None, None
+        pos = self.f.tell()
+        unpack_from = struct.unpack_from
+        offsets = []
+        for i in range(item_num):
+            length = unpack_from("<Q", mm, pos)[0]
+            pos += 8
+            offsets.append((pos, pos + length))
+            pos += length
+        self.f.seek(pos)
+        return mm, offsets
+
+    def read_str_array(self, item_num):
+        mm, offsets = self.str_array_offsets(item_num)
+        if mm is None:
+            return [self.read_str() for i in range(item_num)]
+        return [mm[start:end].decode() for start, end in offsets]
+
+    def skip_value(self):
+        value_type = self.read_i32()
+        if value_type == 8:
+            self.f.seek(self.read_u64(), os.SEEK_CUR)
+        elif value_type == 9:
+            item_type = self.read_i32()
+            item_num = self.read_u64()
+            if item_type in GGUF_NUMPY_TYPES:
+                self.f.seek(item_num * GGUF_NUMPY_TYPES[item_type].itemsize, os.SEEK_CUR)
+            elif item_type == 8 and self._mmap() is not None:
+                self.str_array_offsets(item_num)
+            else:
+                for i in range(item_num):
+                    self.funcs[item_type]()
+        else:
+            self.funcs[value_type]()
+
 
 class GGUFHeader:
     size = 4 + 4 + 8 + 8
@@ -130,12 +207,15 @@ class GGUFHeader:
 
 
 class GGUFConfig:
-    def __init__(self, f: BufferedReader, header: GGUFHeader):
+    def __init__(self, f: BufferedReader, header: GGUFHeader, skip_keys=()):
         self.config = {}
 
         reader = GGUFReader(f)
         for i in range(header.n_kv):
             key = reader.read_str()
+            if key in skip_keys:
+                reader.skip_value()
+                continue
             value = reader.read_value()
             self.config[key] = value
 
@@ -370,17 +450,107 @@ class GGUFTensorLoader:
         invalidInputError(False, "Unsupported qtype")
 
 
+def _varint(value: int):
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def serialize_pieces(tokens, scores, token_types):
+    """
+    Serialize the vocab into the `pieces` field of a sentencepiece `ModelProto` directly,
+    instead of building a protobuf `SentencePiece` message per token.
+    """
+    # see https://github.com/google/sentencepiece/blob/master/src/sentencepiece_model.proto
+    pack_score = struct.Struct("<f").pack
+    out = []
+    for token, score, token_type in zip(tokens, scores, token_types):
+        piece = token.encode()
+        body = b"".join([b"\x0a", _varint(len(piece)), piece,     # piece = 1
+                         b"\x15", pack_score(score),               # score = 2
+                         b"\x18", _varint(token_type)])            # type = 3
+        out.append(b"\x0a" + _varint(len(body)) + body)            # pieces = 1
+    return b"".join(out)
+
+
 class GGUFFileLoader:
-    def __init__(self, fpath: str):
+    """
+    Loader of the config, tensors and tokenizer in a gguf file.
+
+    :param fpath: path of the gguf file.
+    :param vocab_cache: whether to cache the parsed vocab next to the gguf file in
+        `<fpath>.vocab.npz`, the cache is used while the gguf file is not modified.
+        Defaults to the `IPEX_LLM_GGUF_VOCAB_CACHE` environment variable.
+    """
+
+    def __init__(self, fpath: str, vocab_cache: bool = None):
+        if vocab_cache is None:
+            vocab_cache = os.environ.get(GGUF_VOCAB_CACHE_ENV, "0").lower() in ("1", "true")
+        self.fpath = fpath
+        self.vocab_cache_path = fpath + ".vocab.npz" if vocab_cache else None
+        cached_vocab = self.load_vocab_cache()
+
         with open(fpath, 'rb') as f:
             header = GGUFHeader(f)
-            config = GGUFConfig(f, header)
+            skip_keys = GGUF_VOCAB_KEYS if cached_vocab is not None else ()
+            config = GGUFConfig(f, header, skip_keys)
             tensor_infos = GGUFTensorInfos(f, header, config)
             tensor_loader = GGUFTensorLoader(fpath, tensor_infos)
 
         self.header = header
         self.config = config.config
         self.tensor_loader = tensor_loader
+        self.pieces_proto = None
+        if cached_vocab is not None:
+            self.config.update(cached_vocab["config"])
+            self.pieces_proto = cached_vocab["pieces"]
+
+    def _file_stamp(self):
+        stat = os.stat(self.fpath)
+        return numpy.array([stat.st_size, stat.st_mtime_ns], dtype=numpy.int64)
+
+    def load_vocab_cache(self):
+        if self.vocab_cache_path is None or not os.path.exists(self.vocab_cache_path):
+            return None
+        try:
+            with numpy.load(self.vocab_cache_path) as cache:
+                if not numpy.array_equal(cache["stamp"], self._file_stamp()):
+                    return None
+                # tokens are kept as one utf-8 buffer and their character offsets
+                text = cache["tokens"].tobytes().decode()
+                offsets = cache["token_offsets"].tolist()
+                config = {
+                    'tokenizer.ggml.tokens': [text[start:end] for start, end
+                                              in zip(offsets[:-1], offsets[1:])],
+                    'tokenizer.ggml.token_type': cache["token_type"],
+                }
+                if "scores" in cache:
+                    config['tokenizer.ggml.scores'] = cache["scores"]
+                return {"config": config, "pieces": cache["pieces"].tobytes()}
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save_vocab_cache(self):
+        tokens = self.config['tokenizer.ggml.tokens']
+        offsets = numpy.cumsum([0] + [len(token) for token in tokens], dtype=numpy.int64)
+        arrays = {
+            "stamp": self._file_stamp(),
+            "tokens": numpy.frombuffer("".join(tokens).encode(), dtype=numpy.uint8),
+            "token_offsets": offsets,
+            "token_type": numpy.asarray(self.config['tokenizer.ggml.token_type']),
+            "pieces": numpy.frombuffer(self.pieces_proto, dtype=numpy.uint8),
+        }
+        if 'tokenizer.ggml.scores' in self.config:
+            arrays["scores"] = numpy.asarray(self.config['tokenizer.ggml.scores'])
+        try:
+            with open(self.vocab_cache_path, "wb") as f:
+                numpy.savez(f, **arrays)
+        except OSError:
+            # e.g. the directory of the gguf file is read-only
+            pass
 
     def tensors(self, dtype: torch.dtype = torch.float):
         return {
@@ -391,10 +561,7 @@ class GGUFFileLoader:
     def tensors_iter(self):
         return self.tensor_loader
 
-    def tokenizer_pieces(self):
-        from transformers.convert_slow_tokenizer import import_protobuf
-        spm_pb2 = import_protobuf("Failed to import protobuf")
-
+    def tokenizer_arrays(self):
         tokens = self.config['tokenizer.ggml.tokens']
         token_types = self.config['tokenizer.ggml.token_type']
         merges = None
@@ -402,21 +569,45 @@ class GGUFFileLoader:
             scores = self.config['tokenizer.ggml.scores']
         elif self.config['tokenizer.ggml.model'] == "gpt2":
             merges = self.config['tokenizer.ggml.merges']
-            scores = list(range(len(tokens)))
+            scores = numpy.arange(len(tokens), dtype=numpy.float32)
         else:
             invalidInputError(False, "Invalid configuration: 'scores' is not provided.")
+        return tokens, numpy.asarray(scores), numpy.asarray(token_types), merges
+
+    def tokenizer_pieces_proto(self):
+        """
+        The serialized `pieces` of the sentencepiece `ModelProto` of the vocab.
+        """
+        if self.pieces_proto is None:
+            tokens, scores, token_types, _ = self.tokenizer_arrays()
+            self.pieces_proto = serialize_pieces(tokens, scores.tolist(), token_types.tolist())
+            if self.vocab_cache_path is not None:
+                self.save_vocab_cache()
+        return self.pieces_proto
+
+    def tokenizer_proto(self, trainer_spec=None):
+        """
+        The serialized sentencepiece `ModelProto` of the vocab and `trainer_spec`.
+        """
+        from transformers.convert_slow_tokenizer import import_protobuf
+        spm_pb2 = import_protobuf("Failed to import protobuf")
+        # concatenated serialized messages are merged when parsed
+        return self.tokenizer_pieces_proto() + \
+            spm_pb2.ModelProto(trainer_spec=trainer_spec).SerializeToString()
 
-        pieces = [
-            spm_pb2.ModelProto.SentencePiece(
-                piece=token,
-                score=score,
-                type=token_type,
-            )
-            for token, score, token_type in tqdm(
-                zip(tokens, scores, token_types),
-                "Loading gguf vocab"
-            )
-        ]
+    def tokenizer_vocab(self):
+        """
+        The vocab of gpt2 tokenizers as a dict of token to id, and the merges.
+        """
+        tokens, scores, _, merges = self.tokenizer_arrays()
+        return dict(zip(tokens, scores.astype(numpy.int64).tolist())), merges
+
+    def tokenizer_pieces(self):
+        from transformers.convert_slow_tokenizer import import_protobuf
+        spm_pb2 = import_protobuf("Failed to import protobuf")
+
+        merges = self.tokenizer_arrays()[3]
+        pieces = spm_pb2.ModelProto.FromString(self.tokenizer_pieces_proto()).pieces
 
         if merges is not None:
             return pieces, merges
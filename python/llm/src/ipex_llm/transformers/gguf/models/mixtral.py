@@ -94,11 +94,9 @@ def load_gguf_mixtral(loader: GGUFFileLoader, dtype: torch.dtype = torch.float,
     from transformers.convert_slow_tokenizer import import_protobuf
     spm_pb2 = import_protobuf("Failed to import protobuf")
 
-    tokenizer_pieces = loader.tokenizer_pieces()
     trainer_spec = spm_pb2.TrainerSpec(byte_fallback=True,
                                        model_type=spm_pb2.TrainerSpec.ModelType.BPE)
-    proto = spm_pb2.ModelProto(pieces=tokenizer_pieces, trainer_spec=trainer_spec)
-    proto = proto.SerializeToString()
+    proto = loader.tokenizer_proto(trainer_spec)
 
     with NamedTemporaryFile(delete=False) as f:
         f.write(proto)
@@ -66,19 +66,14 @@ def load_gguf_mpt(loader: GGUFFileLoader, dtype: torch.dtype = torch.float):
 
     model = model.cpu()
 
-    pieces, merges = loader.tokenizer_pieces()
+    vocab, merges = loader.tokenizer_vocab()
 
     current_directory = os.path.dirname(os.path.abspath(__file__))
     token_file = current_directory + "/model_implement/mpt/tokenizer.json"
     import json
     with open(token_file, 'r') as file:
         data = json.load(file)
-    vocab = {}
     # load and replace vocab and merges
-    for i in range(len(pieces)):
-        token = pieces[i].piece
-        score = int(pieces[i].score)
-        vocab[token] = score
     data['model']['merges'] = merges
     data['model']['vocab'] = vocab
 
@@ -108,11 +108,9 @@ def load_gguf_yuan(loader: GGUFFileLoader, dtype: torch.dtype = torch.float,
     from transformers.convert_slow_tokenizer import import_protobuf
     spm_pb2 = import_protobuf("Failed to import protobuf")
 
-    pieces = loader.tokenizer_pieces()
     trainer_spec = spm_pb2.TrainerSpec(byte_fallback=True,
                                        model_type=spm_pb2.TrainerSpec.ModelType.BPE)
-    proto = spm_pb2.ModelProto(pieces=pieces, trainer_spec=trainer_spec)
-    proto = proto.SerializeToString()
+    proto = loader.tokenizer_proto(trainer_spec)
 
     with NamedTemporaryFile(delete=False) as f:
         f.write(proto)
@@ -0,0 +1,370 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Some parts of this file is adapted from
+# https://github.com/huggingface/transformers/blob/main/src/transformers/generation/logits_process.py
+# which is licensed under Apache License 2.0:
+#
+# Copyright 2020 The HuggingFace Inc. team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Logits processors working on the scores of several positions at once, i.e. scores of
+# shape [batch, positions, vocab], where position i follows `input_ids` and the first i
+# draft tokens. They replace the per position loop over `logits_processor` when verifying
+# drafts in speculative and prompt lookup decoding, and work as normal transformers logits
+# processors on [batch, vocab] scores, e.g. in `generate` of serving workers.
+
+import torch
+from transformers import LogitsProcessor
+from transformers.generation.logits_process import RepetitionPenaltyLogitsProcessor, \
+    NoRepeatNGramLogitsProcessor, MinLengthLogitsProcessor, TemperatureLogitsWarper, \
+    TopKLogitsWarper, TopPLogitsWarper
+
+from ipex_llm.utils.common import invalidInputError
+
+
+def token_counts(input_ids, vocab_size, mask=None):
+    """
+    Count the occurrences of each token in each row.
+
+    :param input_ids: token ids of shape [batch, seq_len].
+    :param vocab_size: int value, size of the vocabulary.
+    :param mask: optional 0/1 tensor of shape [batch, seq_len], tokens with 0 are not counted.
+
+    :return: counts of shape [batch, vocab_size] in int32
+    """
+    counts = torch.zeros(input_ids.size(0), vocab_size, dtype=torch.int32,
+                         device=input_ids.device)
+    src = torch.ones_like(input_ids, dtype=torch.int32) if mask is None \
+        else mask.to(device=input_ids.device, dtype=torch.int32)
+    return counts.scatter_add_(1, input_ids, src)
+
+
+def position_token_counts(counts, draft_ids):
+    """
+    Extend the counts of the history to every verified position, position i also counts
+    the first i draft tokens.
+
+    :return: counts of shape [batch, num_drafts + 1, vocab_size]
+    """
+    batch_size, num_drafts = draft_ids.shape
+    increments = torch.zeros(batch_size, num_drafts + 1, counts.size(-1),
+                             dtype=counts.dtype, device=counts.device)
+    if num_drafts > 0:
+        increments[:, 1:].scatter_(-1, draft_ids.unsqueeze(-1), 1)
+    return counts.unsqueeze(1) + increments.cumsum(1, dtype=counts.dtype)
+
+
+class _Context:
+    # what the processors know about every verified position, computed at most once per call
+    def __init__(self, input_ids, draft_ids, vocab_size, counts, lengths=None):
+        self.input_ids = input_ids
+        self.draft_ids = draft_ids
+        self.vocab_size = vocab_size
+        self.num_positions = draft_ids.size(1) + 1
+        self.lengths = lengths
+        self._counts = counts
+        self._position_counts = None
+
+    @property
+    def pad_lens(self):
+        # number of left padding tokens of each row, [batch] or [1]
+        if self.lengths is None:
+            return torch.zeros(1, dtype=torch.long, device=self.input_ids.device)
+        return self.input_ids.size(1) - self.lengths.to(self.input_ids.device)
+
+    @property
+    def cur_lens(self):
+        # length of the unpadded sequence each position follows, [batch or 1, positions]
+        lengths = self.input_ids.size(1) - self.pad_lens
+        return lengths.unsqueeze(1) + torch.arange(self.num_positions,
+                                                   device=self.input_ids.device)
+
+    @property
+    def position_counts(self):
+        if self._position_counts is None:
+            if self._counts is None:
+                self._counts = token_counts(self.input_ids, self.vocab_size)
+            self._position_counts = position_token_counts(self._counts, self.draft_ids)
+        return self._position_counts
+
+
+def _repetition_penalty(penalty):
+    def process(scores, ctx):
+        penalized = torch.where(scores < 0, scores * penalty, scores / penalty)
+        return torch.where(ctx.position_counts > 0, penalized, scores)
+    return process
+
+
+def _frequency_presence_penalty(frequency_penalty, presence_penalty):
+    def process(scores, ctx):
+        counts = ctx.position_counts
+        penalty = frequency_penalty * counts + presence_penalty * (counts > 0)
+        return scores - penalty.to(scores.dtype)
+    return process
+
+
+def _temperature(temperature):
+    def process(scores, ctx):
+        return scores / temperature
+    return process
+
+
+def _top_k(top_k, filter_value):
+    def process(scores, ctx):
+        k = min(top_k, scores.size(-1))
+        indices_to_remove = scores < torch.topk(scores, k)[0][..., -1:]
+        return scores.masked_fill(indices_to_remove, filter_value)
+    return process
+
+
+def _top_p(top_p, filter_value, min_tokens_to_keep):
+    def process(scores, ctx):
+        sorted_logits, sorted_indices = torch.sort(scores, descending=False)
+        cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+        # remove tokens with cumulative top_p above the threshold (token with 0 are kept)
+        sorted_indices_to_remove = cumulative_probs <= (1 - top_p)
+        sorted_indices_to_remove[..., -min_tokens_to_keep:] = False
+        indices_to_remove = sorted_indices_to_remove.scatter(-1, sorted_indices,
+                                                             sorted_indices_to_remove)
+        return scores.masked_fill(indices_to_remove, filter_value)
+    return process
+
+
+def _min_length(min_length, eos_token_id):
+    eos_token_id = torch.as_tensor(eos_token_id).view(-1)
+
+    def process(scores, ctx):
+        too_short = (ctx.cur_lens < min_length).unsqueeze(-1)
+        is_eos = torch.zeros(scores.size(-1), dtype=torch.bool, device=scores.device)
+        is_eos[eos_token_id.to(scores.device)] = True
+        return scores.masked_fill(too_short & is_eos, -float("inf"))
+    return process
+
+
+def _no_repeat_ngram(ngram_size):
+    n = ngram_size
+
+    def process(scores, ctx):
+        batch_size, num_positions, vocab_size = scores.shape
+        device = scores.device
+        seq = torch.cat((ctx.input_ids, ctx.draft_ids), dim=-1)
+        if seq.size(1) < n:
+            return scores
+        # index in `seq` right after every position, padding included
+        ends = ctx.input_ids.size(1) + torch.arange(num_positions, device=device)
+        # all ngrams of the sequence and the n - 1 tokens before every position
+        windows = seq.unfold(1, n, 1)
+        num_windows = windows.size(1)
+        query_index = ends.unsqueeze(1) - n + 1 + torch.arange(n - 1, device=device)
+        queries = seq[:, query_index.clamp(min=0)]
+        match = (windows[:, None, :, :n - 1] == queries[:, :, None, :]).all(-1)
+        # an ngram is only banned for positions after it, and never covers left padding
+        starts = torch.arange(num_windows, device=device)
+        match &= (starts.unsqueeze(0) <= (ends - n).unsqueeze(1)).unsqueeze(0)
+        match &= (starts.view(1, 1, -1) >= ctx.pad_lens.view(-1, 1, 1))
+        banned = torch.zeros(batch_size, num_positions, vocab_size,
+                             dtype=torch.int32, device=device)
+        banned.scatter_add_(-1, windows[:, None, :, -1].expand(-1, num_positions, -1),
+                            match.to(torch.int32))
+        return scores.masked_fill(banned > 0, -float("inf"))
+    return process
+
+
+class BatchedLogitsProcessor(LogitsProcessor):
+    """
+    Apply common logits processors to the scores of all verified positions in one call.
+
+    Scores of shape [batch, positions, vocab] follow `input_ids` and the first i tokens of
+    `draft_ids` at position i. Token counts for repetition, frequency and presence penalty
+    are computed once for all positions, and may be maintained incrementally by the caller
+    with `token_counts` and passed by `counts`.
+
+    It can also be used as a normal transformers `LogitsProcessor` on [batch, vocab] scores.
+
+    :param repetition_penalty: float value, same as transformers ``repetition_penalty``.
+    :param frequency_penalty: float value, subtract ``frequency_penalty * count`` from scores
+        of tokens which appear ``count`` times.
+    :param presence_penalty: float value, subtract ``presence_penalty`` from scores of tokens
+        which appear.
+    :param no_repeat_ngram_size: int value, same as transformers ``no_repeat_ngram_size``.
+    :param min_length: int value, same as transformers ``min_length``.
+    :param eos_token_id: int or list of int, eos token ids banned before ``min_length``.
+    :param temperature: float value, same as transformers ``temperature``.
+    :param top_k: int value, same as transformers ``top_k``.
+    :param top_p: float value, same as transformers ``top_p``.
+    """
+
+    def __init__(self, repetition_penalty=None, frequency_penalty=None, presence_penalty=None,
+                 no_repeat_ngram_size=None, min_length=None, eos_token_id=None,
+                 temperature=None, top_k=None, top_p=None, filter_value=-float("inf"),
+                 min_tokens_to_keep=1):
+        self.processors = []
+        self.needs_counts = False
+        if min_length is not None and min_length > 0 and eos_token_id is not None:
+            self.processors.append(_min_length(min_length, eos_token_id))
+        if repetition_penalty is not None and repetition_penalty != 1.0:
+            invalidInputError(repetition_penalty > 0,
+                              f"`repetition_penalty` has to be a strictly positive float, "
+                              f"but is {repetition_penalty}")
+            self.processors.append(_repetition_penalty(repetition_penalty))
+            self.needs_counts = True
+        if frequency_penalty or presence_penalty:
+            self.processors.append(_frequency_presence_penalty(frequency_penalty or 0.0,
+                                                               presence_penalty or 0.0))
+            self.needs_counts = True
+        if no_repeat_ngram_size is not None and no_repeat_ngram_size > 0:
+            self.processors.append(_no_repeat_ngram(no_repeat_ngram_size))
+        self._append_warpers(temperature, top_k, top_p, filter_value, min_tokens_to_keep)
+
+    def _append_warpers(self, temperature=None, top_k=None, top_p=None,
+                        filter_value=-float("inf"), min_tokens_to_keep=1):
+        if temperature is not None and temperature != 1.0:
+            invalidInputError(temperature > 0,
+                              f"`temperature` has to be a strictly positive float, "
+                              f"but is {temperature}")
+            self.processors.append(_temperature(temperature))
+        if top_k is not None and top_k != 0:
+            self.processors.append(_top_k(max(top_k, min_tokens_to_keep), filter_value))
+        if top_p is not None and top_p < 1.0:
+            self.processors.append(_top_p(top_p, filter_value, min_tokens_to_keep))
+
+    @classmethod
+    def from_logits_processor(cls, logits_processor):
+        """
+        Convert a transformers `LogitsProcessorList`, keeping the order of its processors.
+
+        :return: a `BatchedLogitsProcessor`, or None if any processor is not supported
+        """
+        batched = cls()
+        for processor in logits_processor:
+            if isinstance(processor, RepetitionPenaltyLogitsProcessor):
+                batched.processors.append(_repetition_penalty(processor.penalty))
+                batched.needs_counts = True
+            elif isinstance(processor, NoRepeatNGramLogitsProcessor):
+                batched.processors.append(_no_repeat_ngram(processor.ngram_size))
+            elif isinstance(processor, MinLengthLogitsProcessor):
+                batched.processors.append(_min_length(processor.min_length,
+                                                      processor.eos_token_id))
+            elif isinstance(processor, TemperatureLogitsWarper):
+                batched._append_warpers(temperature=processor.temperature)
+            elif isinstance(processor, TopKLogitsWarper):
+                batched._append_warpers(top_k=processor.top_k,
+                                        filter_value=processor.filter_value)
+            elif isinstance(processor, TopPLogitsWarper):
+                batched._append_warpers(top_p=processor.top_p,
+                                        filter_value=processor.filter_value,
+                                        min_tokens_to_keep=processor.min_tokens_to_keep)
+            elif isinstance(processor, BatchedLogitsProcessor):
+                batched.processors += processor.processors
+                batched.needs_counts |= processor.needs_counts
+            else:
+                return None
+        return batched
+
+    def __call__(self, input_ids, scores, draft_ids=None, counts=None, lengths=None):
+        """
+        :param input_ids: history token ids of shape [batch, seq_len].
+        :param scores: scores of shape [batch, positions, vocab] or [batch, vocab].
+        :param draft_ids: draft token ids of shape [batch, positions - 1].
+        :param counts: optional token counts of `input_ids` of shape [batch, vocab].
+        :param lengths: optional unpadded lengths of the left padded `input_ids` of
+            shape [batch], default to ``seq_len`` for every row.
+
+        :return: processed scores of the same shape as `scores`
+        """
+        is_2d = scores.dim() == 2
+        if is_2d:
+            scores = scores.unsqueeze(1)
+        if draft_ids is None:
+            draft_ids = input_ids.new_empty(input_ids.size(0), scores.size(1) - 1)
+        invalidInputError(draft_ids.size(1) == scores.size(1) - 1,
+                          f"Expect {scores.size(1) - 1} draft tokens for {scores.size(1)} "
+                          f"positions, but got {draft_ids.size(1)}.")
+        ctx = _Context(input_ids, draft_ids, scores.size(-1), counts, lengths)
+        for processor in self.processors:
+            scores = processor(scores, ctx)
+        return scores.squeeze(1) if is_2d else scores
+
+
+class VerifyLogitsProcessor:
+    """
+    Process the logits of all verified positions of speculative or prompt lookup decoding,
+    keeping token counts of the history incrementally across verify steps.
+
+    Falls back to calling `logits_processor` position by position if it contains processors
+    which `BatchedLogitsProcessor` does not support.
+    """
+
+    def __init__(self, logits_processor):
+        self.logits_processor = logits_processor
+        self.batched = BatchedLogitsProcessor.from_logits_processor(logits_processor)
+        self.counts = None
+
+    def __call__(self, input_ids, logits, draft_ids, attention_mask=None):
+        """
+        :param input_ids: history token ids of shape [batch, seq_len].
+        :param logits: logits of shape [batch, num_drafts + 1, vocab], processed in place.
+        :param draft_ids: draft token ids of shape [batch, num_drafts].
+        :param attention_mask: optional 0/1 mask of the left padded `input_ids`, padding is
+            neither counted nor part of the sequence lengths.
+        """
+        if len(self.logits_processor) == 0:
+            return logits
+        if self.batched is None:
+            if attention_mask is None:
+                rows = [input_ids]
+            else:
+                # transformers processors see the whole input as the history,
+                # so every row is processed on its own without padding
+                rows = [input_ids[idx:idx + 1, attention_mask[idx].bool()]
+                        for idx in range(input_ids.size(0))]
+            for idx, row in enumerate(rows):
+                row_slice = slice(None) if attention_mask is None else slice(idx, idx + 1)
+                for i in range(logits.size(1)):
+                    logits[row_slice, i, :] = self.logits_processor(
+                        torch.cat((row, draft_ids[row_slice, :i]), dim=-1),
+                        logits[row_slice, i, :])
+            return logits
+        if self.batched.needs_counts and self.counts is None:
+            self.counts = token_counts(input_ids, logits.size(-1), attention_mask)
+        lengths = None if attention_mask is None else attention_mask.sum(-1)
+        logits[:] = self.batched(input_ids, logits, draft_ids, counts=self.counts,
+                                 lengths=lengths)
+        return logits
+
+    def update(self, new_ids, mask=None):
+        """
+        Count the tokens accepted in this verify step.
+
+        :param new_ids: accepted token ids of shape [batch, num_accepted].
+        :param mask: optional 0/1 mask of `new_ids` for rows accepting different numbers of
+            tokens.
+        """
+        if self.counts is not None:
+            self.counts += token_counts(new_ids.to(self.counts.device), self.counts.size(-1),
+                                        mask)
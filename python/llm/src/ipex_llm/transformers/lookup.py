@@ -31,9 +31,11 @@ import transformers
 from transformers import GenerationConfig, LogitsProcessorList, StoppingCriteriaList
 from ipex_llm.transformers.speculative import greedy, deepmind_sample, logits_to_probs,\
     _crop_past_key_values, _prepare_generate_args, _non_cpu_ipex_verify, clear_benchmarks,\
-    _prepare_generate_args_4_45
+    _prepare_generate_args_4_45, speculative_sample
+from ipex_llm.transformers.logits_process import VerifyLogitsProcessor
 from ipex_llm.utils.common import invalidInputError
 from ipex_llm.transformers.utils import get_xpu_device_name
+from ipex_llm.transformers.models.common import clear_forward_context
 
 logger = logging.getLogger("ipex_llm.lookup")
 
@@ -47,6 +49,7 @@ PERFORMANCE_MODE_LOOKUP_INPUT_THRESHOLD = 100
 
 
 @torch.no_grad()
+@clear_forward_context
 def generate(
     self,
     inputs: Optional[torch.Tensor] = None,
@@ -60,6 +63,7 @@ def generate(
     **kwargs,
 ):
     lookahead = kwargs.pop("lookahead", None)
+    prefill_chunk_size = kwargs.pop("prefill_chunk_size", None)
     perf_mode = os.environ.get("IPEX_LLM_PERFORMANCE_MODE", None)
 
     input_tensor_shape = None
@@ -90,14 +94,12 @@ def generate(
             logger.warning("Prompt lookup is currently not supported on CPU with IPEX, "
                            "fallback to original generate.")
             kwargs.pop("max_matching_ngram_size", None)
-        elif input_tensor_shape is not None and input_tensor_shape[0] > 1:
-            logger.warning("Prompt lookup is currently not supported with batch inference, "
-                           "fallback to original generate.")
-            kwargs.pop("max_matching_ngram_size", None)
+            kwargs.pop("datastore", None)
         elif kwargs.get("num_beams", None) not in [None, 1]:
             logger.warning("Prompt lookup is currently not supported with num_beams != 1, "
                            "fallback to original generate.")
             kwargs.pop("max_matching_ngram_size", None)
+            kwargs.pop("datastore", None)
         else:
             # Do prompt lookup generation
             # If lookahead is provided, we will use lookup_generate instead of
@@ -122,6 +124,22 @@ def generate(
                                         prefix_allowed_tokens_fn=prefix_allowed_tokens_fn,
                                         **kwargs)
 
+    # chunked prefill for long prompts, the last chunk is prefilled by original generate
+    from ipex_llm.transformers.chunked_prefill import get_prefill_chunk_size, chunked_prefill
+    prefill_chunk_size = get_prefill_chunk_size(prefill_chunk_size)
+    if (
+        prefill_chunk_size
+        and input_tensor_shape is not None and not is_inputs_embeds
+        and input_tensor_shape[1] > prefill_chunk_size
+        and kwargs.get("past_key_values", None) is None
+        and not getattr(self.config, "is_encoder_decoder", False)
+    ):
+        input_ids = inputs if inputs is not None else kwargs["input_ids"]
+        past_key_values = chunked_prefill(self, input_ids, kwargs.get("attention_mask", None),
+                                          prefill_chunk_size)
+        if past_key_values is not None:
+            kwargs["past_key_values"] = past_key_values
+
     return original_generate(self,
                              inputs=inputs,
                              generation_config=generation_config,
@@ -279,6 +297,7 @@ def lookup_generate(self,
                     generation_config: Optional[GenerationConfig] = None,
                     streamer: Optional["BaseStreamer"] = None,
                     attention_mask=None,
+                    datastore=None,
                     **sampling_kwargs):
     from packaging import version
     trans_version = transformers.__version__
@@ -292,15 +311,19 @@ def lookup_generate(self,
             model_kwargs = _prepare_generate_args(self, inputs, generation_config,
                                                   streamer, **sampling_kwargs)
 
-    invalidInputError(input_ids.shape[0] == 1,
-                      "Prompt lookup is currently not supported with batch inference.")
-
     device_name = get_xpu_device_name(input_ids.device)
 
-    candidates_generator = PromptLookupCandidateGenerator(
-        num_output_tokens=num_output_tokens,
-        max_matching_ngram_size=max_matching_ngram_size,
-        device=device_name)
+    if input_ids.shape[0] > 1:
+        return _lookup_generate_batch(self, input_ids, attention_mask, max_new_tokens,
+                                      num_output_tokens, max_matching_ngram_size,
+                                      generation_config, logits_processor, model_kwargs,
+                                      device_name, datastore)
+
+    candidates_generator = _make_candidates_generator(num_output_tokens,
+                                                      max_matching_ngram_size,
+                                                      device_name, datastore)
+
+    verify_processor = VerifyLogitsProcessor(logits_processor)
 
     step = 0
     step_verify = 0
@@ -371,33 +394,32 @@ def lookup_generate(self,
                 logits = output['logits']
                 past_key_values = output['past_key_values']
 
-            if len(logits_processor) > 0:
-                for i in range(candidate_length + 1):
-                    logits[:, i, :] = logits_processor(candidate_input_ids[:, : cur_len + i],
-                                                       logits[:, i, :])
+            logits = verify_processor(input_ids, logits, verify_input_ids[:, 1:])
 
             if generation_config.do_sample:
-                output_ids, prob_list = deepmind_sample(logits,
-                                                        top_k=generation_config.top_k,
-                                                        top_p=generation_config.top_p,
-                                                        temperature=generation_config.temperature)
-                output_ids = output_ids.transpose(0, 1)
+                # prompt lookup drafts are deterministic, accept them by rejection sampling
+                # against the target distribution instead of comparing with a target sample
+                target_probs = logits_to_probs(logits,
+                                               top_k=generation_config.top_k,
+                                               top_p=generation_config.top_p,
+                                               temperature=generation_config.temperature)
+                output_ids, n_matches = speculative_sample(
+                    target_probs.view(1, candidate_length + 1, -1), verify_input_ids[:, 1:])
+                n_matches = n_matches.item()
             else:
                 output_ids = greedy(logits)
+                # Compare drafts with target verified outputs
+                # Drafts start from [1, k]
+                # Verified output start from [0, k - 1]
+                # including the one generated by the base model
+                n_matches = ((output_ids[:, :-1] != verify_input_ids[:, 1:])
+                             .cumsum(-1) == 0).sum(-1).item()
 
             if self.device.type == 'xpu':
                 torch.xpu.synchronize()
             toc = time.time()
             self.verify_time.append(toc - tic)
 
-            # Compare drafts with target verified outputs
-            # Drafts start from [1, k]
-            # Verified output start from [0, k - 1]
-            # including the one generated by the base model
-
-            n_matches = ((output_ids[:, :-1] != verify_input_ids[:, 1:])
-                         .cumsum(-1) == 0).sum(-1).item()
-
             max_matched = n_matches + 1
             mot = time.time()
             self.match_time.append(mot-toc)
@@ -423,6 +445,7 @@ def lookup_generate(self,
                                                                accept_rate)
 
             input_ids = torch.cat((input_ids, output_ids), dim=-1)
+            verify_processor.update(output_ids)
             candidates_generator.update_look_up_table(input_ids)
 
             step += output_ids.size(1)
@@ -454,4 +477,232 @@ def lookup_generate(self,
     if streamer is not None:
         streamer.end()
 
+    if datastore is not None and datastore.online:
+        datastore.add(input_ids[0, : input_len + step].tolist())
+
     return input_ids[:, : input_len + step]
+
+
+def _make_candidates_generator(num_output_tokens, max_matching_ngram_size, device_name,
+                               datastore=None):
+    if datastore is None:
+        return PromptLookupCandidateGenerator(num_output_tokens=num_output_tokens,
+                                              max_matching_ngram_size=max_matching_ngram_size,
+                                              device=device_name)
+    from ipex_llm.transformers.lookup_datastore import RetrievalCandidateGenerator
+    return RetrievalCandidateGenerator(datastore,
+                                       num_output_tokens=num_output_tokens,
+                                       max_matching_ngram_size=max_matching_ngram_size,
+                                       device=device_name)
+
+
+def _pad_left(rows, pad_token_id, device):
+    max_len = max(len(row) for row in rows)
+    ids = torch.full((len(rows), max_len), pad_token_id, dtype=torch.long)
+    for idx, row in enumerate(rows):
+        if len(row) > 0:
+            ids[idx, max_len - len(row):] = torch.tensor(row, dtype=torch.long)
+    return ids.to(device)
+
+
+def _batch_verify(self, verify_input_ids, verify_mask, past_key_values, cache_mask):
+    # rows have different numbers of valid tokens in the kv cache,
+    # so position ids are counted from the attention mask rather than the cache length
+    position_ids = cache_mask.sum(-1, keepdim=True) + \
+        torch.arange(verify_input_ids.size(1), device=verify_input_ids.device).unsqueeze(0)
+    return self(input_ids=verify_input_ids,
+                past_key_values=past_key_values,
+                attention_mask=torch.cat((cache_mask, verify_mask), dim=1),
+                position_ids=position_ids,
+                return_dict=True,
+                use_cache=True)
+
+
+def _lookup_generate_batch(self, input_ids, attention_mask, max_new_tokens,
+                           num_output_tokens, max_matching_ngram_size,
+                           generation_config, logits_processor, model_kwargs,
+                           device_name, datastore=None):
+    """
+    Prompt lookup decoding for batch size > 1.
+
+    Each row looks up its own candidates, candidates are right padded to the longest one
+    and verified by one forward. Each row accepts its own number of tokens, so the kv cache
+    becomes ragged: it is only cropped to the longest accepted row, and the slots rejected
+    by the other rows are masked out by `cache_mask`, which also gives the position ids.
+    """
+    batch_size = input_ids.size(0)
+    device = input_ids.device
+    if attention_mask is None:
+        attention_mask = torch.ones_like(input_ids)
+    attention_mask = attention_mask.to(device=device, dtype=torch.long)
+    pad_token_id = generation_config.pad_token_id
+    if pad_token_id is None:
+        pad_token_id = 0
+
+    eos_token_id_set = set()
+    if generation_config.eos_token_id is not None:
+        if isinstance(generation_config.eos_token_id, list):
+            eos_token_id_set = set(generation_config.eos_token_id)
+        else:
+            eos_token_id_set = set([generation_config.eos_token_id])
+
+    # valid (unpadded) tokens of each row, used for lookup and logits processors
+    rows = [input_ids[idx][attention_mask[idx].bool()].tolist() for idx in range(batch_size)]
+    generated = [[] for _ in range(batch_size)]
+    finished = [False] * batch_size
+    candidates_generators = [
+        _make_candidates_generator(num_output_tokens, max_matching_ngram_size,
+                                   device_name, datastore)
+        for _ in range(batch_size)
+    ]
+
+    verify_processor = VerifyLogitsProcessor(logits_processor)
+    clear_benchmarks(self)
+    self.accept_rate = []
+
+    def accept(idx, tokens):
+        tokens = tokens[:max_new_tokens - len(generated[idx])]
+        for out_idx, token in enumerate(tokens):
+            if token in eos_token_id_set:
+                tokens = tokens[:out_idx + 1]
+                finished[idx] = True
+                break
+        generated[idx] += tokens
+        rows[idx] += tokens
+        if len(generated[idx]) >= max_new_tokens:
+            finished[idx] = True
+        return tokens
+
+    # first token use full model
+    tic = time.time()
+    model_inputs = self.prepare_inputs_for_generation(input_ids, attention_mask=attention_mask,
+                                                      **model_kwargs)
+    output = self(**model_inputs, return_dict=True)
+    logits = output['logits'][:, -1:]
+    # processed with the unpadded length of each row, e.g. for min_length
+    logits = verify_processor(input_ids, logits, input_ids.new_empty(batch_size, 0),
+                              attention_mask=attention_mask)
+    if generation_config.do_sample:
+        output_ids, _ = deepmind_sample(logits,
+                                        top_k=generation_config.top_k,
+                                        top_p=generation_config.top_p,
+                                        temperature=generation_config.temperature)
+    else:
+        output_ids = greedy(logits)
+    past_key_values = output['past_key_values']
+    verify_processor.update(output_ids)
+    cache_mask = attention_mask
+    # the last accepted token of each row, which is not in kv cache yet
+    last_tokens = output_ids.view(-1).tolist()
+    for idx in range(batch_size):
+        accept(idx, last_tokens[idx:idx + 1])
+        candidates_generators[idx].init_look_up_table(torch.tensor([rows[idx]]))
+    if self.device.type == 'xpu':
+        torch.xpu.synchronize()
+    self.first_token_time = time.time() - tic
+    e2e_tic = time.time()
+
+    while not all(finished):
+        toc = time.time()
+        drafts = []
+        for idx in range(batch_size):
+            draft = []
+            if not finished[idx] and len(rows[idx]) > 1:
+                row_ids = torch.tensor([rows[idx]])
+                candidate_input_ids, _ = candidates_generators[idx].get_candidates(row_ids)
+                draft = candidate_input_ids[0, len(rows[idx]):].tolist()
+            drafts.append(draft)
+        draft_lens = torch.tensor([len(draft) for draft in drafts], device=device)
+        candidate_length = int(draft_lens.max().item())
+        verify_input_ids = torch.full((batch_size, candidate_length + 1), pad_token_id,
+                                      dtype=torch.long, device=device)
+        for idx, draft in enumerate(drafts):
+            verify_input_ids[idx, :len(draft) + 1] = \
+                torch.tensor(last_tokens[idx:idx + 1] + draft, dtype=torch.long)
+        positions = torch.arange(candidate_length + 1, device=device).unsqueeze(0)
+        verify_mask = (positions <= draft_lens.unsqueeze(1)).long()
+        self.draft_num.append(candidate_length)
+        tic = time.time()
+        self.draft_time.append(tic - toc)
+
+        output = _batch_verify(self, verify_input_ids, verify_mask, past_key_values, cache_mask)
+        logits = output['logits']
+        past_key_values = output['past_key_values']
+
+        if len(logits_processor) > 0:
+            history = _pad_left(rows, pad_token_id, device)
+            history_mask = _pad_left([[1] * len(row) for row in rows], 0, device)
+            logits = verify_processor(history, logits, verify_input_ids[:, 1:],
+                                      attention_mask=history_mask)
+
+        if generation_config.do_sample:
+            target_probs = logits_to_probs(logits,
+                                           top_k=generation_config.top_k,
+                                           top_p=generation_config.top_p,
+                                           temperature=generation_config.temperature)
+            output_ids, n_matches = speculative_sample(
+                target_probs.view(batch_size, candidate_length + 1, -1),
+                verify_input_ids[:, 1:], draft_lens=draft_lens)
+        else:
+            output_ids = greedy(logits)
+            # per row number of leading drafts that equal the verified outputs,
+            # padded positions never match
+            matched = (output_ids[:, :-1] == verify_input_ids[:, 1:]) & \
+                (positions[:, 1:] <= draft_lens.unsqueeze(1))
+            n_matches = (matched.long().cumprod(-1)).sum(-1)
+
+        if self.device.type == 'xpu':
+            torch.xpu.synchronize()
+        toc = time.time()
+        self.verify_time.append(toc - tic)
+        # each row accepts its matched drafts and one more verified token
+        accept_lens = n_matches + 1
+        mot = time.time()
+        self.match_time.append(mot - toc)
+
+        n_matches_list = n_matches.tolist()
+        self.accept_num.append(float(accept_lens.float().mean().item()))
+        self.n_matched += sum(n_matches_list)
+        self.n_drafted += sum(len(draft) for draft in drafts)
+        accept_rate = self.n_matched / self.n_drafted if self.n_drafted > 0 else 1
+        self.accept_rate.append(accept_rate)
+
+        # the kv cache now holds the last tokens and all drafts, a row keeps
+        # `accept_lens` of them, crop the tail no row keeps and mask out the rest
+        max_matched = int(accept_lens.max().item())
+        if max_matched < candidate_length + 1:
+            past_key_values = _crop_past_key_values(self, past_key_values,
+                                                    candidate_length + 1 - max_matched)
+        kept_mask = (positions[:, :max_matched] < accept_lens.unsqueeze(1)).long()
+        cache_mask = torch.cat((cache_mask, kept_mask), dim=1)
+
+        output_ids_list = output_ids.tolist()
+        appended = [[] for _ in range(batch_size)]
+        for idx in range(batch_size):
+            accepted = output_ids_list[idx][:n_matches_list[idx] + 1]
+            last_tokens[idx] = accepted[-1]
+            if finished[idx]:
+                continue
+            appended[idx] = accept(idx, accepted)
+            candidates_generators[idx].update_look_up_table(torch.tensor([rows[idx]]))
+            if device_name not in ["mtl", "lnl"]:
+                candidates_generators[idx].update_candidate_strategy(len(drafts[idx]),
+                                                                     n_matches_list[idx],
+                                                                     accept_rate)
+        verify_processor.update(_pad_left(appended, pad_token_id, device),
+                                _pad_left([[1] * len(tokens) for tokens in appended], 0, device))
+        pot = time.time()
+        self.post_time.append(pot - mot)
+
+    self.n_token_generated = max(len(tokens) for tokens in generated)
+    self.e2e_time_without_first = time.time() - e2e_tic
+
+    if datastore is not None and datastore.online:
+        for row in rows:
+            datastore.add(row)
+
+    outputs = torch.full((batch_size, self.n_token_generated), pad_token_id,
+                         dtype=torch.long, device=device)
+    for idx, tokens in enumerate(generated):
+        outputs[idx, :len(tokens)] = torch.tensor(tokens, dtype=torch.long)
+    return torch.cat((input_ids, outputs), dim=-1)
@@ -0,0 +1,330 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Retrieval based drafting (REST, https://arxiv.org/abs/2311.08252) for `lookup_generate`:
+# drafts come from a suffix array over a token corpus instead of the prompt itself, so
+# spans repeated across requests (code completion, templated reports, ...) can be drafted
+# without a draft model.
+#
+# The index is built offline and memory-mapped at serving time:
+#   python -m ipex_llm.transformers.lookup_datastore build --tokenizer /path/to/model \
+#       --input corpus.jsonl --output /path/to/datastore
+#
+#   datastore = SuffixArrayDatastore.load("/path/to/datastore", online=True)
+#   output = model.generate(input_ids, lookahead=3, datastore=datastore)
+#
+# In online mode, finished generations are appended to an in-memory index, which is merged
+# into the suffix array by `save`, or once it holds `max_online_tokens` tokens.
+
+import argparse
+import json
+import os
+import threading
+from collections import defaultdict
+
+import numpy as np
+import torch
+
+from ipex_llm.utils.common import invalidInputError
+from ipex_llm.transformers.lookup import PromptLookupCandidateGenerator
+
+SEPARATOR = -1
+TOKENS_NAME = "tokens.npy"
+SUFFIX_ARRAY_NAME = "suffix_array.npy"
+CONFIG_NAME = "datastore_config.json"
+
+
+def build_suffix_array(tokens):
+    """
+    Build the suffix array of `tokens` by prefix doubling, in O(n log^2 n).
+
+    :param tokens: 1-D int array, documents separated by ``-1``.
+
+    :return: int64 array of suffix start positions in lexicographical order of suffixes
+    """
+    n = len(tokens)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    # rank 0 is past the end, which sorts before everything, then the separator
+    rank = tokens.astype(np.int64) + 2
+    k = 1
+    while True:
+        second = np.zeros(n, dtype=np.int64)
+        second[:n - k] = rank[k:]
+        suffix_array = np.lexsort((second, rank))
+        sorted_rank, sorted_second = rank[suffix_array], second[suffix_array]
+        changed = np.empty(n, dtype=np.int64)
+        changed[0] = 1
+        changed[1:] = (sorted_rank[1:] != sorted_rank[:-1]) | \
+            (sorted_second[1:] != sorted_second[:-1])
+        rank = np.empty(n, dtype=np.int64)
+        rank[suffix_array] = np.cumsum(changed)
+        if rank.max() == n or k >= n:
+            return suffix_array
+        k *= 2
+
+
+class SuffixArrayDatastore:
+    """
+    A token corpus with its suffix array, drafting the most frequent continuation of the
+    longest matched suffix of the current sequence.
+
+    :param tokens: 1-D int32 array of the corpus, documents separated by ``-1``.
+    :param suffix_array: suffix array of `tokens`, see `build_suffix_array`.
+    :param max_suffix_len: int value, the longest suffix of the current sequence to match.
+    :param min_suffix_len: int value, the shortest suffix of the current sequence to match.
+    :param max_matches: int value, at most this many matches are used to count
+        continuations, evenly sampled from all matches.
+    :param online: boolean value, whether `lookup_generate` appends finished generations.
+    :param max_online_tokens: int value, the online index is merged into the suffix array
+        once it holds this many tokens, which bounds its memory.
+    """
+
+    def __init__(self, tokens, suffix_array, max_suffix_len=16, min_suffix_len=2,
+                 max_matches=512, online=False, max_online_tokens=16384):
+        invalidInputError(len(tokens) == len(suffix_array),
+                          "tokens and suffix_array should have the same length.")
+        invalidInputError(0 < min_suffix_len <= max_suffix_len,
+                          "Expect 0 < min_suffix_len <= max_suffix_len.")
+        self.tokens = tokens
+        self.suffix_array = suffix_array
+        self.max_suffix_len = max_suffix_len
+        self.min_suffix_len = min_suffix_len
+        self.max_matches = max_matches
+        self.online = online
+        self.max_online_tokens = max_online_tokens
+        # appended sequences, indexed by their ngrams until merged into the suffix array
+        self.online_tokens = []
+        self.online_index = defaultdict(list)
+        # requests draft from and append to the datastore concurrently
+        self.lock = threading.RLock()
+
+    @classmethod
+    def build(cls, sequences, **kwargs):
+        """
+        Build a datastore from an iterable of token id lists.
+        """
+        chunks = []
+        for sequence in sequences:
+            chunks.append(np.asarray(sequence, dtype=np.int32))
+            chunks.append(np.array([SEPARATOR], dtype=np.int32))
+        tokens = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int32)
+        return cls(tokens, build_suffix_array(tokens), **kwargs)
+
+    @classmethod
+    def load(cls, path, mmap=True, **kwargs):
+        """
+        Load a datastore saved by `save`, memory-mapped by default.
+        """
+        mmap_mode = "r" if mmap else None
+        config = {}
+        if os.path.exists(os.path.join(path, CONFIG_NAME)):
+            with open(os.path.join(path, CONFIG_NAME), "r") as f:
+                config = json.load(f)
+        config.update(kwargs)
+        return cls(np.load(os.path.join(path, TOKENS_NAME), mmap_mode=mmap_mode),
+                   np.load(os.path.join(path, SUFFIX_ARRAY_NAME), mmap_mode=mmap_mode),
+                   **config)
+
+    def save(self, path):
+        """
+        Save the datastore, sequences appended online are merged into the suffix array.
+        """
+        with self.lock:
+            self.merge_online()
+            tokens, suffix_array = self.tokens, self.suffix_array
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, TOKENS_NAME), np.asarray(tokens))
+        np.save(os.path.join(path, SUFFIX_ARRAY_NAME), np.asarray(suffix_array))
+        with open(os.path.join(path, CONFIG_NAME), "w") as f:
+            json.dump({"max_suffix_len": self.max_suffix_len,
+                       "min_suffix_len": self.min_suffix_len,
+                       "max_matches": self.max_matches}, f, indent=2)
+
+    def __len__(self):
+        return len(self.tokens) + len(self.online_tokens)
+
+    def add(self, sequence):
+        """
+        Append a token id list to the online index.
+        """
+        with self.lock:
+            start = len(self.online_tokens)
+            self.online_tokens += list(sequence)
+            end = len(self.online_tokens)
+            self.online_tokens.append(SEPARATOR)
+            for ngram_size in range(self.min_suffix_len, self.max_suffix_len + 1):
+                for pos in range(start + ngram_size, end):
+                    ngram = tuple(self.online_tokens[pos - ngram_size:pos])
+                    self.online_index[ngram].append(pos)
+            if len(self.online_tokens) >= self.max_online_tokens:
+                self.merge_online()
+
+    def merge_online(self):
+        """
+        Rebuild the suffix array with the sequences appended online.
+        """
+        with self.lock:
+            if not self.online_tokens:
+                return
+            self.tokens = np.concatenate((np.asarray(self.tokens),
+                                          np.asarray(self.online_tokens, dtype=np.int32)))
+            self.suffix_array = build_suffix_array(self.tokens)
+            self.online_tokens = []
+            self.online_index = defaultdict(list)
+
+    def _prefix(self, pos, length):
+        return self.tokens[pos:pos + length].tolist()
+
+    def _match_range(self, query):
+        # suffixes starting with `query` form a contiguous range of the suffix array
+        length = len(query)
+        lo, hi = 0, len(self.suffix_array)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._prefix(self.suffix_array[mid], length) < query:
+                lo = mid + 1
+            else:
+                hi = mid
+        start, hi = lo, len(self.suffix_array)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._prefix(self.suffix_array[mid], length) <= query:
+                lo = mid + 1
+            else:
+                hi = mid
+        return start, lo
+
+    def _continuations(self, query, num_tokens):
+        # continuation tokens of all (sampled) matches of `query`, padded by the separator
+        start, end = self._match_range(query)
+        continuations = []
+        if end > start:
+            step = max(1, (end - start) // self.max_matches)
+            positions = np.asarray(self.suffix_array[start:end:step][:self.max_matches],
+                                   dtype=np.int64) + len(query)
+            index = positions[:, None] + np.arange(num_tokens)
+            valid = index < len(self.tokens)
+            continuations.append(np.where(valid, np.asarray(self.tokens)[
+                np.minimum(index, len(self.tokens) - 1)], SEPARATOR))
+        online_positions = self.online_index.get(tuple(query), [])
+        if online_positions:
+            online_tokens = self.online_tokens + [SEPARATOR] * num_tokens
+            continuations.append(np.array([online_tokens[pos:pos + num_tokens]
+                                           for pos in online_positions[-self.max_matches:]]))
+        if not continuations:
+            return None
+        return np.concatenate(continuations)
+
+    def draft(self, sequence, num_tokens):
+        """
+        Draft up to `num_tokens` tokens following `sequence`.
+
+        The longest suffix of `sequence` found in the corpus is matched, then the draft
+        follows the most frequent next token among its continuations, token by token.
+
+        :param sequence: list of token ids.
+        :param num_tokens: int value, the max number of drafted tokens.
+
+        :return: list of drafted token ids, empty if nothing is matched
+        """
+        if num_tokens <= 0:
+            return []
+        with self.lock:
+            return self._draft(sequence, num_tokens)
+
+    def _draft(self, sequence, num_tokens):
+        for length in range(min(self.max_suffix_len, len(sequence)),
+                            self.min_suffix_len - 1, -1):
+            continuations = self._continuations(list(sequence[-length:]), num_tokens)
+            if continuations is None:
+                continue
+            draft = []
+            for depth in range(num_tokens):
+                column = continuations[:, depth]
+                column = column[column != SEPARATOR]
+                if len(column) == 0:
+                    break
+                values, counts = np.unique(column, return_counts=True)
+                token = values[np.argmax(counts)]
+                draft.append(int(token))
+                continuations = continuations[continuations[:, depth] == token]
+            if draft:
+                return draft
+        return []
+
+
+class RetrievalCandidateGenerator(PromptLookupCandidateGenerator):
+    """
+    Candidate generator for `lookup_generate` drafting from a `SuffixArrayDatastore`, and
+    from the prompt itself like `PromptLookupCandidateGenerator` if the datastore has no
+    match.
+    """
+
+    def __init__(self, datastore, num_output_tokens=10, max_matching_ngram_size=None,
+                 device="arc"):
+        super().__init__(num_output_tokens=num_output_tokens,
+                         max_matching_ngram_size=max_matching_ngram_size,
+                         device=device)
+        self.datastore = datastore
+
+    def get_candidates(self, input_ids):
+        if self.num_output_tokens == 0:
+            return input_ids, None
+        sequence = input_ids[0, -self.datastore.max_suffix_len:].tolist()
+        draft = self.datastore.draft(sequence, self.num_output_tokens)
+        if not draft:
+            return super().get_candidates(input_ids)
+        draft = torch.tensor([draft], dtype=input_ids.dtype, device=input_ids.device)
+        return torch.cat((input_ids, draft), dim=1), None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a suffix array datastore for "
+                                                 "retrieval based lookup decoding")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build", help="tokenize a corpus and build the datastore")
+    build.add_argument("--tokenizer", type=str, required=True,
+                       help="path or hub id of the tokenizer")
+    build.add_argument("--input", type=str, nargs="+", required=True,
+                       help="text files with one document per line, or jsonl files with "
+                            "a `text` field")
+    build.add_argument("--output", type=str, required=True, help="output directory")
+    build.add_argument("--max-suffix-len", type=int, default=16)
+    build.add_argument("--min-suffix-len", type=int, default=2)
+    args = parser.parse_args()
+
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, trust_remote_code=True)
+
+    def documents():
+        for input_file in args.input:
+            with open(input_file, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    text = json.loads(line)["text"] if input_file.endswith(".jsonl") \
+                        else line.rstrip("\n")
+                    yield tokenizer.encode(text, add_special_tokens=False)
+
+    datastore = SuffixArrayDatastore.build(documents(), max_suffix_len=args.max_suffix_len,
+                                           min_suffix_len=args.min_suffix_len)
+    datastore.save(args.output)
+    print(f"Built datastore of {len(datastore)} tokens in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Multi-LoRA serving over one shared low-bit base model: LoRA adapters are registered by
+# name and loaded lazily into the LoRA layers of the base model (`qlora.LoraLowBitLinear`)
+# when a request uses them, the least recently used unreferenced adapters are deleted
+# beyond `max_loaded_adapters`. Each row of a batch is computed with its own adapter.
+# Adapters are trained on the original model, their q/k/v_proj LoRA weights are mapped
+# onto the qkv_proj merged by `_optimize_pre` when they are loaded.
+#
+# Usage:
+#   pool = LoraAdapterPool(model, {"sql": "/path/to/sql-lora"}, max_loaded_adapters=4)
+#   output = pool.generate(model, input_ids, adapter_names=["sql"], max_new_tokens=32)
+
+import copy
+import math
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+
+from ipex_llm.utils.common import invalidInputError
+from ipex_llm.transformers.utils import logger
+
+BASE_ADAPTER = "__base__"
+QKV_PROJS = ["q_proj", "k_proj", "v_proj"]
+
+
+def merge_qkv_lora(model, config, state_dict):
+    """
+    Map the LoRA weights of q/k/v_proj in a saved adapter onto the qkv_proj of `model`
+    merged by `_optimize_pre`. A of the projections are concatenated along the rank and
+    their B, with scaling folded in, form a block diagonal B, so the merged LoRA layer
+    with scaling 1 computes the same outputs as the separate ones.
+
+    :param model: the base model, whose attention modules may have merged qkv_proj.
+    :param config: `LoraConfig` of the adapter.
+    :param state_dict: the adapter weights, as returned by `peft.utils.load_peft_weights`.
+
+    :return: the config and the state dict to load into `model`.
+    """
+    merged = [name for name, module in model.named_modules()
+              if hasattr(module, "qkv_proj") and not hasattr(module, "q_proj")]
+    target_modules = config.target_modules
+    if not merged or not target_modules:
+        return config, state_dict
+    invalidInputError(not isinstance(target_modules, str),
+                      "LoRA adapters of a model with merged qkv_proj should list "
+                      "target_modules by name instead of a regex.")
+    targeted = [name for name in QKV_PROJS if name in target_modules]
+    if not targeted:
+        return config, state_dict
+    invalidInputError(not config.rank_pattern and not config.alpha_pattern
+                      and not getattr(config, "use_dora", False),
+                      "rank_pattern, alpha_pattern and DoRA are not supported for LoRA "
+                      "adapters of q/k/v_proj merged into qkv_proj.")
+    scaling = config.lora_alpha / (math.sqrt(config.r) if config.use_rslora else config.r)
+    rank = len(targeted) * config.r
+    config = copy.deepcopy(config)
+    config.target_modules = set(target_modules) | {"qkv_proj"}
+    config.rank_pattern = {"qkv_proj": rank}
+    config.alpha_pattern = {"qkv_proj": math.sqrt(rank) if config.use_rslora else rank}
+    state_dict = dict(state_dict)
+    for prefix in merged:
+        key = f"base_model.model.{prefix}." if prefix else "base_model.model."
+        weights_A = [state_dict.pop(f"{key}{name}.lora_A.weight", None) for name in targeted]
+        weights_B = [state_dict.pop(f"{key}{name}.lora_B.weight", None) for name in targeted]
+        if any(weight is None for weight in weights_A + weights_B):
+            # e.g. a layer outside `layers_to_transform`
+            continue
+        out_sizes = dict(zip(targeted, [weight.size(0) for weight in weights_B]))
+        total = model.get_submodule(prefix).qkv_proj.out_features
+        kv_size = out_sizes.get("k_proj", out_sizes.get("v_proj", None))
+        if kv_size is None:
+            kv_size = (total - out_sizes["q_proj"]) // 2
+        offsets = {"q_proj": 0, "k_proj": total - 2 * kv_size, "v_proj": total - kv_size}
+        weight_B = weights_B[0].new_zeros(total, rank)
+        for i, (name, weight) in enumerate(zip(targeted, weights_B)):
+            weight_B[offsets[name]:offsets[name] + weight.size(0),
+                     i * config.r:(i + 1) * config.r] = weight * scaling
+        state_dict[f"{key}qkv_proj.lora_A.weight"] = torch.cat(weights_A, dim=0)
+        state_dict[f"{key}qkv_proj.lora_B.weight"] = weight_B
+    return config, state_dict
+
+
+class LoraAdapterPool:
+    """
+    Registry of LoRA adapters and the LRU pool of the adapters loaded into `model`.
+
+    :param model: the low-bit base model, LoRA layers are injected into it in place.
+    :param adapters: dict of adapter name to the path of a saved peft adapter.
+    :param max_loaded_adapters: int value, the number of adapters kept loaded. Adapters
+        used by running requests are never deleted, so more may be loaded meanwhile.
+    """
+
+    def __init__(self, model, adapters=None, max_loaded_adapters=4):
+        self.model = model
+        self.peft_model = None
+        self.registry = dict(adapters or {})
+        self.max_loaded_adapters = max_loaded_adapters
+        # name -> memory of the loaded adapter, in LRU order
+        self.loaded = OrderedDict()
+        self.ref_counts = {}
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+        self.load_time = 0.0
+        self.last_load_time = 0.0
+
+    def register(self, name: str, path: str):
+        invalidInputError(name != BASE_ADAPTER, f"{BASE_ADAPTER} is reserved for the base model.")
+        with self.lock:
+            self.registry[name] = path
+            if name in self.loaded and self.ref_counts.get(name, 0) == 0:
+                # reloaded from the new path when it is used next time
+                self._unload(name)
+
+    def unregister(self, name: str):
+        with self.lock:
+            self.registry.pop(name, None)
+            if name in self.loaded and self.ref_counts.get(name, 0) == 0:
+                self._unload(name)
+
+    def _adapter_nbytes(self, name):
+        return sum(param.numel() * param.element_size()
+                   for param_name, param in self.peft_model.named_parameters()
+                   if "lora_" in param_name and f".{name}." in param_name)
+
+    def _load(self, name):
+        from peft import PeftConfig, PeftModel
+        from peft.utils import load_peft_weights, set_peft_model_state_dict
+        from ipex_llm.transformers.qlora import patch_create_new_module
+        start = time.perf_counter()
+        path = self.registry[name]
+        config = PeftConfig.from_pretrained(path)
+        config.inference_mode = True
+        # injected LoRA layers are active until they are deactivated below, so they start
+        # with zero lora_B to keep the outputs of concurrent requests unchanged meanwhile
+        config.init_lora_weights = True
+        config, state_dict = merge_qkv_lora(self.model, config,
+                                            load_peft_weights(path, device="cpu"))
+        with patch_create_new_module():
+            if self.peft_model is None:
+                self.peft_model = PeftModel(self.model, config, adapter_name=name)
+            else:
+                self.peft_model.add_adapter(name, config)
+        # adapters only apply to the rows selected by `qlora.lora_adapters`, requests
+        # without adapter are computed by the base model, also while the weights are loaded
+        from peft.tuners.lora import LoraLayer
+        for module in self.peft_model.modules():
+            if isinstance(module, LoraLayer):
+                module.set_adapter([])
+        set_peft_model_state_dict(self.peft_model, state_dict, adapter_name=name)
+        device = next(self.model.parameters()).device
+        if device.type == "xpu":
+            # LoRA layers compute in bf16 on gpu
+            for module in self.peft_model.modules():
+                for lora_dict in [getattr(module, "lora_A", None),
+                                  getattr(module, "lora_B", None)]:
+                    if isinstance(lora_dict, torch.nn.ModuleDict) and name in lora_dict:
+                        lora_dict[name].to(torch.bfloat16)
+        self.peft_model.eval()
+        self.loaded[name] = self._adapter_nbytes(name)
+        self.loads += 1
+        self.last_load_time = time.perf_counter() - start
+        self.load_time += self.last_load_time
+        logger.info(f"Loaded LoRA adapter {name} in {self.last_load_time:.2f}s")
+
+    def _unload(self, name):
+        self.peft_model.base_model.delete_adapter(name)
+        self.loaded.pop(name)
+        self.evictions += 1
+
+    def _evict(self):
+        for name in list(self.loaded.keys()):
+            if len(self.loaded) <= self.max_loaded_adapters:
+                break
+            if self.ref_counts.get(name, 0) == 0:
+                self._unload(name)
+
+    def acquire(self, adapter_names):
+        """
+        Load the adapters of `adapter_names` if needed and keep them loaded until they
+        are released, `None` or `__base__` means the base model.
+        """
+        names = [name for name in dict.fromkeys(adapter_names)
+                 if name is not None and name != BASE_ADAPTER]
+        with self.lock:
+            for name in names:
+                invalidInputError(name in self.registry, f"Unknown LoRA adapter: {name}.")
+            for name in names:
+                if name in self.loaded:
+                    self.hits += 1
+                    self.loaded.move_to_end(name)
+                else:
+                    self._load(name)
+                self.ref_counts[name] = self.ref_counts.get(name, 0) + 1
+            self._evict()
+        return names
+
+    def release(self, names):
+        with self.lock:
+            for name in names:
+                self.ref_counts[name] -= 1
+            self._evict()
+
+    def generate(self, model, input_ids: torch.Tensor, adapter_names=None, **kwargs):
+        """
+        `model.generate` computing row `i` of `input_ids` with adapter `adapter_names[i]`.
+        """
+        from ipex_llm.transformers.qlora import lora_adapters
+        if adapter_names is None:
+            adapter_names = [BASE_ADAPTER] * input_ids.size(0)
+        adapter_names = [name or BASE_ADAPTER for name in adapter_names]
+        names = self.acquire(adapter_names)
+        try:
+            with lora_adapters(adapter_names):
+                return model.generate(input_ids, **kwargs)
+        finally:
+            self.release(names)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "registered": sorted(self.registry.keys()),
+                "loaded": list(self.loaded.keys()),
+                "memory_gb": sum(self.loaded.values()) / (1024 ** 3),
+                "hits": self.hits,
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "avg_load_time": self.load_time / self.loads if self.loads else 0.0,
+                "last_load_time": self.last_load_time,
+            }
@@ -0,0 +1,352 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# An on-disk cache of converted low-bit models, so that `from_pretrained(load_in_low_bit=...)`
+# of the same checkpoint with the same conversion options only quantizes once, and later
+# calls go through `load_low_bit` on the cached `save_low_bit` output.
+#
+# Each entry is a directory named by the cache key, which is a hash of the checkpoint
+# fingerprint, the conversion options and the versions of ipex-llm, transformers and torch.
+# Entries are written to a temporary directory and renamed into place, so concurrent
+# processes never see a partial entry. Least recently used entries are evicted once the
+# total size exceeds the size limit.
+#
+# Usage:
+#   export IPEX_LLM_LOW_BIT_CACHE_DIR=/path/to/cache
+#   export IPEX_LLM_LOW_BIT_CACHE_MAX_GB=100
+#   model = AutoModelForCausalLM.from_pretrained(model_path, load_in_low_bit="sym_int4")
+#
+#   llm-cache list
+#   llm-cache warm /path/to/model --low-bit sym_int4
+#   llm-cache evict --max-gb 50
+#   llm-cache clear
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from ipex_llm.utils.common import invalidInputError
+
+CACHE_DIR_ENV = "IPEX_LLM_LOW_BIT_CACHE_DIR"
+CACHE_MAX_GB_ENV = "IPEX_LLM_LOW_BIT_CACHE_MAX_GB"
+METADATA_NAME = "ipex_llm_cache.json"
+
+# `from_pretrained` kwargs which are either explicit options of the key already or don't
+# change the converted model, all other kwargs (config overrides, attn_implementation,
+# revision, ...) are part of the key
+KEY_EXCLUDED_KWARGS = {
+    "torch_dtype", "cpu_embedding", "modules_to_not_convert", "mixed_precision",
+    "disable_optimize_pre", "embedding_qtype", "imatrix_data", "device_map",
+    "low_cpu_mem_usage", "layerwise_load", "trust_remote_code", "cache_dir",
+    "force_download", "resume_download", "proxies", "local_files_only", "token",
+    "use_auth_token",
+}
+
+
+def _package_version(name):
+    from importlib.metadata import version, PackageNotFoundError
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return None
+
+
+def _file_digest(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def describe_kwargs(kwargs):
+    """
+    Return a JSON string describing the `from_pretrained` kwargs outside of
+    ``KEY_EXCLUDED_KWARGS``, or None if some value cannot be described reliably, e.g. an
+    arbitrary object, in which case the converted model should not be cached.
+    """
+    unknown = []
+
+    def default(value):
+        if hasattr(value, "to_dict"):
+            # PretrainedConfig, GenerationConfig, ...
+            return value.to_dict()
+        import torch
+        if isinstance(value, torch.dtype):
+            return str(value)
+        unknown.append(type(value).__name__)
+        return None
+
+    description = json.dumps({key: value for key, value in kwargs.items()
+                              if key not in KEY_EXCLUDED_KWARGS},
+                             sort_keys=True, default=default)
+    return None if unknown else description
+
+
+def checkpoint_fingerprint(pretrained_model_name_or_path, hash_content=False):
+    """
+    Return a hash identifying the files of a checkpoint.
+
+    By default the hash covers the name, size and modification time of every file, which is
+    cheap for multi-GB checkpoints. For a hub checkpoint the snapshot directory is named by
+    its commit, so it changes whenever the checkpoint changes.
+
+    :param pretrained_model_name_or_path: local directory or hub id of the checkpoint.
+    :param hash_content: whether to hash the content of every file instead of its size and
+        modification time.
+
+    :return: str value, hex digest of the checkpoint
+    """
+    path = pretrained_model_name_or_path
+    if not os.path.isdir(path):
+        from transformers.utils import cached_file
+        path = os.path.dirname(cached_file(pretrained_model_name_or_path, "config.json"))
+
+    sha = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for name in sorted(files):
+            if name.startswith("."):
+                continue
+            file_path = os.path.join(root, name)
+            stat = os.stat(file_path)
+            sha.update(os.path.relpath(file_path, path).encode())
+            if hash_content:
+                sha.update(_file_digest(file_path).encode())
+            else:
+                sha.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return sha.hexdigest()
+
+
+class LowBitModelCache:
+    """
+    An on-disk cache of low-bit models converted by `from_pretrained`.
+
+    :param cache_dir: str value, directory of the cache. Default to be the value of
+        ``IPEX_LLM_LOW_BIT_CACHE_DIR``.
+    :param max_size_gb: float value, total size limit of the cache in GB, least recently
+        used entries are evicted when it is exceeded. Default to be the value of
+        ``IPEX_LLM_LOW_BIT_CACHE_MAX_GB``, or no limit if it is not set.
+    """
+
+    def __init__(self, cache_dir=None, max_size_gb=None):
+        cache_dir = cache_dir or os.environ.get(CACHE_DIR_ENV, None)
+        invalidInputError(cache_dir is not None,
+                          f"Please specify the cache directory or set {CACHE_DIR_ENV}.")
+        if max_size_gb is None and os.environ.get(CACHE_MAX_GB_ENV, None):
+            max_size_gb = float(os.environ[CACHE_MAX_GB_ENV])
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.max_size_gb = max_size_gb
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(pretrained_model_name_or_path, model_class, low_bit, optimize_model=True,
+                 modules_to_not_convert=None, cpu_embedding=False, embedding_qtype=None,
+                 imatrix=None, mixed_precision=False, disable_optimize_pre=False,
+                 torch_dtype="auto", extra_kwargs=None, hash_content=False):
+        """
+        Return the cache key and the description it is computed from.
+
+        `extra_kwargs` is the description of the other `from_pretrained` kwargs returned by
+        `describe_kwargs`.
+        """
+        options = {
+            "checkpoint": checkpoint_fingerprint(pretrained_model_name_or_path, hash_content),
+            "model_class": model_class,
+            "low_bit": low_bit,
+            "optimize_model": optimize_model,
+            "modules_to_not_convert": sorted(modules_to_not_convert or []),
+            "cpu_embedding": cpu_embedding,
+            "embedding_qtype": embedding_qtype,
+            "imatrix": _file_digest(imatrix) if imatrix is not None else None,
+            "mixed_precision": _file_digest(os.fspath(mixed_precision))
+            if isinstance(mixed_precision, (str, os.PathLike)) else mixed_precision,
+            "disable_optimize_pre": disable_optimize_pre,
+            "torch_dtype": str(torch_dtype),
+            "kwargs": extra_kwargs,
+            "ipex_llm": _package_version("ipex-llm"),
+            "transformers": _package_version("transformers"),
+            "torch": _package_version("torch"),
+        }
+        key = hashlib.sha256(json.dumps(options, sort_keys=True).encode()).hexdigest()
+        return key, options
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def lookup(self, key):
+        """
+        Return the directory of the cached model of `key`, or None if it is not cached.
+        """
+        path = self.entry_path(key)
+        metadata_path = os.path.join(path, METADATA_NAME)
+        if not os.path.isfile(metadata_path):
+            return None
+        # the modification time of the metadata file is the last access time
+        os.utime(metadata_path)
+        return path
+
+    def store(self, model, key, options, source=None):
+        """
+        Save a low-bit model into the cache with `save_low_bit`, then evict old entries.
+        """
+        path = self.entry_path(key)
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        try:
+            model.save_low_bit(tmp_path)
+            metadata = {
+                "key": key,
+                "source": str(source),
+                "options": options,
+                "size": _dir_size(tmp_path),
+                "created": time.time(),
+            }
+            with open(os.path.join(tmp_path, METADATA_NAME), "w") as f:
+                json.dump(metadata, f, indent=2)
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # another process has stored the same entry
+                shutil.rmtree(tmp_path, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        self.evict(keep=[key])
+        return path
+
+    def entries(self):
+        """
+        Return the metadata of all entries, least recently used first.
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            metadata_path = os.path.join(self.cache_dir, name, METADATA_NAME)
+            if not os.path.isfile(metadata_path):
+                continue
+            try:
+                with open(metadata_path, "r") as f:
+                    metadata = json.load(f)
+            except (OSError, ValueError):
+                continue
+            metadata["path"] = os.path.join(self.cache_dir, name)
+            metadata["last_access"] = os.path.getmtime(metadata_path)
+            entries.append(metadata)
+        return sorted(entries, key=lambda entry: entry["last_access"])
+
+    def evict(self, max_size_gb=None, keep=()):
+        """
+        Remove least recently used entries until the total size is within `max_size_gb`.
+
+        :return: list of evicted entries
+        """
+        max_size_gb = self.max_size_gb if max_size_gb is None else max_size_gb
+        if max_size_gb is None:
+            return []
+        entries = self.entries()
+        total_size = sum(entry["size"] for entry in entries)
+        evicted = []
+        for entry in entries:
+            if total_size <= max_size_gb * (1024 ** 3):
+                break
+            if entry["key"] in keep:
+                continue
+            shutil.rmtree(entry["path"], ignore_errors=True)
+            total_size -= entry["size"]
+            evicted.append(entry)
+        return evicted
+
+    def clear(self):
+        for entry in self.entries():
+            shutil.rmtree(entry["path"], ignore_errors=True)
+
+
+def get_low_bit_cache(cache_dir=None):
+    """
+    Return the cache at `cache_dir` or ``IPEX_LLM_LOW_BIT_CACHE_DIR``, or None if neither
+    is set.
+    """
+    if cache_dir is None and os.environ.get(CACHE_DIR_ENV, None) is None:
+        return None
+    return LowBitModelCache(cache_dir)
+
+
+def _dir_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the cache of converted low-bit models")
+    parser.add_argument("--cache-dir", type=str, default=None,
+                        help=f"cache directory, default to ${CACHE_DIR_ENV}")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("list", help="list cached models, least recently used first")
+
+    warm = subparsers.add_parser("warm", help="convert a model and store it in the cache")
+    warm.add_argument("model", type=str, help="local path or hub id of the model")
+    warm.add_argument("--low-bit", type=str, default="sym_int4")
+    warm.add_argument("--model-class", type=str, default="AutoModelForCausalLM",
+                      help="class in ipex_llm.transformers used to load the model")
+    warm.add_argument("--modules-to-not-convert", type=str, nargs="*", default=None)
+    warm.add_argument("--embedding-qtype", type=str, default=None)
+    warm.add_argument("--imatrix", type=str, default=None)
+    warm.add_argument("--trust-remote-code", action="store_true")
+
+    evict = subparsers.add_parser("evict", help="evict least recently used models")
+    evict.add_argument("--max-gb", type=float, required=True)
+
+    subparsers.add_parser("clear", help="remove all cached models")
+
+    args = parser.parse_args()
+    cache = LowBitModelCache(args.cache_dir)
+
+    if args.command == "list":
+        for entry in reversed(cache.entries()):
+            options = entry["options"]
+            last_access = time.strftime("%Y-%m-%d %H:%M:%S",
+                                        time.localtime(entry["last_access"]))
+            print(f"{entry['key'][:12]}  {entry['size'] / (1024 ** 3):8.2f} GB  "
+                  f"{last_access}  {options['low_bit']:<12}  {entry['source']}")
+    elif args.command == "warm":
+        import ipex_llm.transformers
+        model_class = getattr(ipex_llm.transformers, args.model_class)
+        kwargs = {}
+        if args.modules_to_not_convert is not None:
+            kwargs["modules_to_not_convert"] = args.modules_to_not_convert
+        if args.embedding_qtype is not None:
+            kwargs["embedding_qtype"] = args.embedding_qtype
+        if args.imatrix is not None:
+            kwargs["imatrix"] = args.imatrix
+        model_class.from_pretrained(args.model, load_in_low_bit=args.low_bit,
+                                    trust_remote_code=args.trust_remote_code,
+                                    low_bit_cache_dir=cache.cache_dir, **kwargs)
+    elif args.command == "evict":
+        for entry in cache.evict(args.max_gb):
+            print(f"evicted {entry['key'][:12]}  {entry['source']}")
+    elif args.command == "clear":
+        cache.clear()
+
+
+if __name__ == "__main__":
+    main()
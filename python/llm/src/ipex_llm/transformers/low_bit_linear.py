@@ -44,6 +44,8 @@
 from typing import Optional, TypeVar, Union, overload
 from ipex_llm.utils.common import invalidInputError
 import os
+import threading
+import weakref
 import torch
 import torch.distributed
 import torch.nn.functional as F
@@ -88,6 +90,9 @@ ASYM_INT4_RTN = ggml_tensor_qtype["asym_int4_rtn"]
 WOQ_INT4 = ggml_tensor_qtype["woq_int4"]
 TORCH_FP8E5 = ggml_tensor_qtype["torch_fp8_e5m2"]
 TORCH_FP8E4 = ggml_tensor_qtype["torch_fp8_e4m3"]
+# qtypes without a CPU dequantization kernel
+DEQUANT_UNSUPPORTED_QTYPES = [SYM_INT4_RTN, SYM_INT8_RTN, ASYM_INT4_RTN, WOQ_INT4,
+                              TORCH_FP8E5, TORCH_FP8E4, FP16]
 RTN_DTYPE = {
     SYM_INT4_RTN: torch.uint8,
     ASYM_INT4_RTN: torch.uint8,
@@ -491,42 +496,205 @@ class FP4Params(torch.nn.Parameter):
             return new_param
 
 
-def ggml_matmul_src1_x_src0_t(src0: torch.Tensor,
-                              src1: torch.Tensor,
-                              src0_shape: torch.Size,
-                              src0_qtype: int):
-    if src1.dtype != torch.float32:
-        src1 = src1.float()
+class _Workspace(threading.local):
+    """
+    Per-thread scratch buffers reused across calls, one flat buffer per name and dtype which
+    grows up to `max_bytes`. Larger requests, i.e. long prefill, are allocated normally, so
+    that one prefill does not pin its buffers for the lifetime of the thread; only the small
+    and frequent decode calls are worth reusing buffers for. Only for intermediate results
+    which do not escape the caller.
+    """
+
+    max_bytes = 32 * 1024 * 1024
 
-    src0_ptr = src0.data_ptr()
-    src1_ptr = src1.data_ptr()
+    def __init__(self):
+        self.buffers = {}
 
-    result_shape = (src1.shape[0], src0_shape[0])
+    def get(self, name, shape, dtype):
+        numel = reduce(mul, shape, 1)
+        if numel * torch.tensor([], dtype=dtype).element_size() > self.max_bytes:
+            return torch.empty(shape, dtype=dtype)
+        buffer = self.buffers.get((name, dtype), None)
+        if buffer is None or buffer.numel() < numel:
+            buffer = torch.empty(numel, dtype=dtype)
+            self.buffers[(name, dtype)] = buffer
+        return buffer[:numel].view(shape)
 
-    result_t = torch.empty(result_shape, dtype=torch.float32)
-    result_ptr = result_t.data_ptr()
+    def clear(self):
+        self.buffers = {}
 
-    src0_shape = tuple(reversed(src0_shape))
-    src1_shape = tuple(reversed(src1.shape))
 
-    # ctx_p = ctx.context
-    src_0_ne = (ctypes.c_int64 * 2)(*src0_shape)
-    src_0_data = ctypes.c_void_p(src0_ptr)
-    src_1_ne = (ctypes.c_int64 * 2)(*src1_shape)
-    src_1_data = ctypes.c_void_p(src1_ptr)
-    result_ptr = ctypes.c_void_p(result_ptr)
+_workspace = _Workspace()
+_NE_TYPE = ctypes.c_int64 * 2
+# ggml shape descriptors of weights, which are the same for every call of a layer
+_src0_ne_cache = {}
+
+
+def _get_src0_ne(src0_shape):
+    src0_ne = _src0_ne_cache.get(src0_shape, None)
+    if src0_ne is None:
+        src0_ne = _NE_TYPE(*reversed(src0_shape))
+        _src0_ne_cache[src0_shape] = src0_ne
+    return src0_ne
+
+
+def ggml_matmul_src1_x_src0_t(src0: torch.Tensor,
+                              src1: torch.Tensor,
+                              src0_shape: torch.Size,
+                              src0_qtype: int,
+                              result: Optional[torch.Tensor]=None):
+    if src1.dtype != torch.float32 or not src1.is_contiguous():
+        src1_fp32 = _workspace.get("src1", src1.shape, torch.float32)
+        src1_fp32.copy_(src1)
+        src1 = src1_fp32
+
+    if result is None:
+        result = torch.empty((src1.shape[0], src0_shape[0]), dtype=torch.float32)
 
     ggml.ggml_compute_forward_mul_mat_q_fp32(
-        # ctx=ctx_p,
-        src_0_ne=src_0_ne,
-        src_0_data=src_0_data,
+        src_0_ne=_get_src0_ne(tuple(src0_shape)),
+        src_0_data=ctypes.c_void_p(src0.data_ptr()),
         src_0_qtype=src0_qtype,
-        src_1_ne=src_1_ne,
-        src_1_data=src_1_data,
-        result=result_ptr,
+        src_1_ne=_NE_TYPE(src1.shape[1], src1.shape[0]),
+        src_1_data=ctypes.c_void_p(src1.data_ptr()),
+        result=ctypes.c_void_p(result.data_ptr()),
     )
 
-    return result_t
+    return result
+
+
+def ggml_matmul_cpu(src0: torch.Tensor,
+                    src1: torch.Tensor,
+                    src0_shape: torch.Size,
+                    src0_qtype: int,
+                    dtype: torch.dtype,
+                    bias: Optional[torch.Tensor]=None):
+    """
+    Low-bit matmul on CPU returning a result of `dtype`, with `bias` added.
+
+    The kernel computes in fp32, for another `dtype` its output goes to a reused workspace
+    buffer, and the bias add and the conversion are fused into one write to the result.
+    """
+    if dtype == torch.float32:
+        result = ggml_matmul_src1_x_src0_t(src0, src1, src0_shape, src0_qtype)
+        if bias is not None:
+            result += bias
+        return result
+    result_fp32 = _workspace.get("result", (src1.shape[0], src0_shape[0]), torch.float32)
+    ggml_matmul_src1_x_src0_t(src0, src1, src0_shape, src0_qtype, result=result_fp32)
+    result = torch.empty(result_fp32.shape, dtype=dtype)
+    if bias is not None:
+        torch.add(result_fp32, bias, out=result)
+    else:
+        result.copy_(result_fp32)
+    return result
+
+
+class MultiLowBitLinear:
+    """
+    Several CPU `LowBitLinear` sharing one input (e.g. q/k/v_proj or gate/up_proj), run as
+    one low-bit matmul over their concatenated output dimension.
+
+    The quantized weights are concatenated into one buffer at the first CPU forward, and the
+    weight of every linear becomes a view of it, so no memory is duplicated and each linear
+    still works alone. The first linear called with an input computes the outputs of all,
+    the others get their split views of the result without any copy, as long as they are
+    called with the same input tensor in the same thread.
+
+    :param linears: list of `LowBitLinear` with the same qtype and input features.
+    """
+
+    def __init__(self, linears):
+        self.linears = linears
+        self.out_sizes = [linear.out_len for linear in linears]
+        self.weight_shape = (sum(self.out_sizes), linears[0].in_len)
+        self.qtype = linears[0].qtype
+        self.fused_weight = None
+        self.fused_bias = None
+        self.fuse_lock = threading.Lock()
+        # (weak reference to the input, its version, outputs of the other linears) of each
+        # thread, as concurrent generations run the same model
+        self.local = threading.local()
+
+    def is_fused(self):
+        if self.fused_weight is None:
+            return False
+        ptr = self.fused_weight.data_ptr()
+        for linear in self.linears:
+            weight = linear.weight.data
+            if weight.device.type != "cpu" or weight.data_ptr() != ptr:
+                return False
+            ptr += weight.numel() * weight.element_size()
+        return True
+
+    def fuse(self):
+        weights = [linear.weight.data for linear in self.linears]
+        if not all(weight.device.type == "cpu" and weight.dtype == torch.uint8
+                   for weight in weights):
+            return False
+        fused_weight = torch.cat([weight.view(-1) for weight in weights])
+        offset = 0
+        for linear, weight in zip(self.linears, weights):
+            linear.weight.data = fused_weight[offset:offset + weight.numel()].view(weight.shape)
+            offset += weight.numel()
+        self.fused_weight = fused_weight
+        self.fused_bias = None
+        return True
+
+    def get_bias(self, dtype):
+        if self.linears[0].bias is None:
+            return None
+        fused_bias = self.fused_bias
+        if fused_bias is None or fused_bias.dtype != dtype:
+            fused_bias = torch.cat([linear.bias.data.to(dtype) for linear in self.linears])
+            self.fused_bias = fused_bias
+        return fused_bias
+
+    def pending_outputs(self):
+        """
+        Return the outputs of the current thread not consumed yet, by linear index.
+        """
+        cached = getattr(self.local, "cached", None)
+        return cached[2] if cached is not None else {}
+
+    def clear(self):
+        self.local.cached = None
+
+    def forward(self, linear, x: torch.Tensor, x_2d: torch.Tensor):
+        """
+        Return the output of `linear` with bias, or None if it cannot be computed fused.
+        """
+        idx = next(idx for idx, member in enumerate(self.linears) if member is linear)
+        cached = getattr(self.local, "cached", None)
+        if cached is not None:
+            input_ref, version, outputs = cached
+            if idx in outputs and input_ref() is x and version == self.get_version(x):
+                output = outputs.pop(idx)
+                if not outputs:
+                    self.clear()
+                return output
+        self.clear()
+        # a non contiguous input is copied by every linear, so the others would miss
+        if not x.is_contiguous():
+            return None
+        if not self.is_fused():
+            with self.fuse_lock:
+                if not self.is_fused() and not self.fuse():
+                    return None
+        result = ggml_matmul_cpu(self.fused_weight, x_2d, self.weight_shape, self.qtype,
+                                 x.dtype, self.get_bias(x.dtype))
+        outputs = result.split(self.out_sizes, dim=-1)
+        # the input is matched by identity and not kept alive, the outputs of the other
+        # linears are dropped once they are all consumed or the input is freed
+        pending = {i: output for i, output in enumerate(outputs) if i != idx}
+        self.local.cached = (weakref.ref(x, lambda ref: pending.clear()),
+                             self.get_version(x), pending)
+        return outputs[idx]
+
+    @staticmethod
+    def get_version(x: torch.Tensor):
+        # inference tensors do not track their version counter
+        return None if x.is_inference() else x._version
 
 
 class MatMulLowBit(torch.autograd.Function):
@@ -573,33 +741,60 @@ class MatMulLowBit(torch.autograd.Function):
         return grad_A, grad_weight, None
 
 
+# output rows of the low-bit weight dequantized at a time by `MatMulLowBitCPU`
+CPU_TRAINING_TILE_ROWS = int(os.getenv("IPEX_LLM_CPU_TRAINING_TILE_ROWS", "256"))
+
+
+def ggml_convert_bf16_rows(weight, start: int, end: int):
+    # dequantize output rows [start, end) of a low-bit weight, its quantized blocks are
+    # stored row by row
+    out_features, in_features = weight._shape
+    qk_size = ggml.ggml_qk_size(weight.qtype)
+    row_bytes = in_features // qk_size * ggml.ggml_type_size(weight.qtype)
+    tile = weight.data[start * row_bytes:end * row_bytes]
+    tile = ggml_convert_fp32(tile, (end - start, in_features), (end - start) * in_features,
+                             weight.qtype)
+    return tile.to(torch.bfloat16)
+
+
 class MatMulLowBitCPU(torch.autograd.Function):
+    # Dequantize the weight tile by tile of `CPU_TRAINING_TILE_ROWS` output rows in both
+    # forward and backward, so that at most one tile is dequantized at a time during
+    # fine-tuning, and compute bf16 matmuls on it.
 
     @staticmethod
     def forward(ctx, A, weight):
-        ctx.is_empty = False
-        x0_fp32 = ggml_int4_convert_fp32(weight.data, weight._shape,
-                                         weight._shape[0] * weight._shape[1])
-        result = torch.matmul(A, x0_fp32.T)
+        invalidInputError(weight.qtype not in DEQUANT_UNSUPPORTED_QTYPES,
+                          f"qtype {weight.qtype} is not supported for training on CPU.")
+        out_features = weight._shape[0]
+        A_2d = A.reshape(-1, A.shape[-1]).to(torch.bfloat16)
+        result = torch.empty((A_2d.shape[0], out_features), dtype=A.dtype)
+        for start in range(0, out_features, CPU_TRAINING_TILE_ROWS):
+            end = min(start + CPU_TRAINING_TILE_ROWS, out_features)
+            tile = ggml_convert_bf16_rows(weight, start, end)
+            result[:, start:end] = torch.matmul(A_2d, tile.T)
         if any(ctx.needs_input_grad[:2]):
             ctx.tensors = (A, weight)
         else:
             ctx.tensors = (None, None)
-        return result
+        return result.view(*A.shape[:-1], out_features)
 
     @staticmethod
     def backward(ctx, grad_output):
-        if ctx.is_empty:
-            bias_grad = None if ctx.bias is None else torch.zeros_like(ctx.bias)
-            return torch.zeros_like(ctx.A), torch.zeros_like(ctx.B), None, bias_grad, None
         req_gradA, _, = ctx.needs_input_grad
         A, weight = ctx.tensors
         grad_A, grad_weight = None, None
         if req_gradA:
-            x0_fp32 = ggml_int4_convert_fp32(weight.data, weight._shape,
-                                             weight._shape[0] * weight._shape[1])
-            grad_A = torch.matmul(grad_output, x0_fp32.to(grad_output.dtype))
-        return grad_A, grad_weight, None
+            out_features = weight._shape[0]
+            grad_output_2d = grad_output.reshape(-1, out_features).to(torch.bfloat16)
+            grad_A = torch.zeros((grad_output_2d.shape[0], weight._shape[1]),
+                                 dtype=torch.float)
+            for start in range(0, out_features, CPU_TRAINING_TILE_ROWS):
+                end = min(start + CPU_TRAINING_TILE_ROWS, out_features)
+                tile = ggml_convert_bf16_rows(weight, start, end)
+                grad_A.add_(torch.matmul(grad_output_2d[:, start:end], tile))
+            grad_A = grad_A.to(A.dtype).view(A.shape)
+        return grad_A, grad_weight
 
 
 class LowBitLinear(nn.Linear):
@@ -630,6 +825,8 @@ class LowBitLinear(nn.Linear):
         self.is_lm_head = self.in_len * self.out_len >= 32000 * 4096 and self.bias is None
         self.low_memory_mode = self.is_lm_head
         self.act_order = act_order
+        # set by `apply_multi_low_bit_linear` if this linear shares its input with others
+        self.multi_linear = None
         if act_order:
             self.register_buffer(
                 "g_idx_map",
@@ -730,27 +927,37 @@ class LowBitLinear(nn.Linear):
                                                  TORCH_FP8E5, TORCH_FP8E4],
                               "NF3, NF4, FP4 and FP8 quantization are currently not"
                               " supported on CPU")
+            bias_fused = False
             if self.training and x.requires_grad:
                 result = MatMulLowBitCPU.apply(x, self.weight)
             else:
-                from ipex_llm.utils.isa_checker import is_server, is_spr
+                from ipex_llm.transformers.dequant_cache import get_dequantized_weight
                 x0 = self.weight.data
-                # convert if necessary, and compute a linear result
-                if is_server() and (not is_spr()) and \
-                        self.qtype == SYM_INT4 and x_2d.shape[0] >= TORCH_LINEAR_THRESHOLD:
-                    x0_fp32 = ggml_int4_convert_fp32(x0, self.weight_shape, self.weight_length)
-                    result = F.linear(x.to(dtype=x0_fp32.dtype), x0_fp32)
-                else:
-                    # Weight does not need a convert
-                    result = ggml_matmul_src1_x_src0_t(x0, x_2d, self.weight_shape, self.qtype)
-                    result = result.view(new_shape)
+                # a dense GEMM on the (cached) dequantized weight is faster for long prefill
+                x0_dense = None
+                if self.qtype not in DEQUANT_UNSUPPORTED_QTYPES:
+                    x0_dense = get_dequantized_weight(self, x_2d.shape[0])
+                result = None
+                if x0_dense is None and self.multi_linear is not None:
+                    # linears sharing this input are computed by one matmul, bias included
+                    result = self.multi_linear.forward(self, x, x_2d)
+                    bias_fused = result is not None
+                if result is None and x0_dense is not None:
+                    result = F.linear(x_2d.to(dtype=x0_dense.dtype), x0_dense)
+                elif result is None:
+                    # Weight does not need a convert, bias is added before allreduce
+                    # if there is no mp_group
+                    bias_fused = self.mp_group is None
+                    result = ggml_matmul_cpu(x0, x_2d, self.weight_shape, self.qtype,
+                                             x.dtype, self.bias if bias_fused else None)
+                result = result.view(new_shape)
             # allreduce to combine partial results and add bias if necessary
             if self.mp_group is not None:
                 # TODO: implement for CPU logic for vLLM tp
                 # deepspeed distibuted mode
                 from deepspeed import comm as dist
                 dist.inference_all_reduce(result, group=self.mp_group)
-            if self.bias is not None:
+            if self.bias is not None and not bias_fused:
                 result += self.bias
         return result.to(x.dtype)
 
@@ -0,0 +1,359 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Automatic mixed precision: measure how much the output of each linear changes when
+# its weight is quantized to each candidate low-bit type, on a small calibration set,
+# then choose one qtype per module that minimizes the total error under a model size
+# (or decode tokens/s) budget. The result is a plan file that `from_pretrained` consumes:
+#
+#   python -m ipex_llm.transformers.mixed_precision --model <path> --calib-file <txt> \
+#       --target-size-gb 4.5 --output plan.json
+#   model = AutoModelForCausalLM.from_pretrained(path, load_in_low_bit="sym_int4",
+#                                                mixed_precision="plan.json")
+#
+# Projections run together by `MultiLowBitLinear` or merged by `_optimize_pre`
+# (q/k/v, gate/up) always get the same qtype.
+
+import argparse
+import json
+import os
+
+import torch
+
+from ipex_llm.ggml.quantize import ggml_tensor_qtype
+from ipex_llm.utils.common import invalidInputError
+from ipex_llm.transformers.utils import logger
+
+PLAN_FORMAT = "ipex-llm-mixed-precision-plan"
+PLAN_VERSION = 1
+DEFAULT_CANDIDATE_QTYPES = ["sym_int4", "q4_k", "q5_k", "q6_k", "sym_int8"]
+METRICS = ["mse", "kl"]
+
+# module merged by `_optimize_pre` -> module name in the plan, which is made on the
+# unmerged model and gives all projections of a merged module the same qtype
+MERGED_LINEARS = {
+    "qkv_proj": "q_proj",
+    "gate_up_proj": "gate_proj",
+}
+
+
+def load_plan(plan):
+    """
+    Load a mixed precision plan.
+
+    :param plan: path of a plan file, or an already loaded plan dict.
+
+    :return: the plan dict.
+    """
+    if isinstance(plan, (str, os.PathLike)):
+        with open(plan, "r") as f:
+            plan = json.load(f)
+    invalidInputError(isinstance(plan, dict) and plan.get("format", None) == PLAN_FORMAT,
+                      f"Invalid mixed precision plan, expected a `{PLAN_FORMAT}` file.")
+    invalidInputError(plan.get("version", None) == PLAN_VERSION,
+                      f"Unsupported mixed precision plan version {plan.get('version', None)}, "
+                      f"expected {PLAN_VERSION}.")
+    for name, qtype in plan["modules"].items():
+        invalidInputError(qtype in ggml_tensor_qtype,
+                          f"Unknown qtype {qtype} of {name} in mixed precision plan.")
+    return plan
+
+
+def save_plan(plan, path):
+    with open(path, "w") as f:
+        json.dump(plan, f, indent=2)
+
+
+def get_plan_qtype(plan, full_module_name, default_qtype):
+    """
+    Return the qtype of `full_module_name` in `plan`, or `default_qtype` if the plan
+    does not cover it.
+    """
+    modules = plan["modules"]
+    qtype = modules.get(full_module_name, None)
+    if qtype is None:
+        parent, _, name = full_module_name.rpartition(".")
+        if name in MERGED_LINEARS:
+            alias = MERGED_LINEARS[name]
+            qtype = modules.get(parent + "." + alias if parent else alias, None)
+    if qtype is None:
+        return default_qtype
+    return ggml_tensor_qtype[qtype]
+
+
+def _candidate_qtypes(qtypes, in_features):
+    from ipex_llm.transformers.utils import check_hidden_size
+    from ipex_llm.transformers.low_bit_linear import DEQUANT_UNSUPPORTED_QTYPES, NF4
+    candidates = {}
+    for name in qtypes:
+        # the qtype actually used by `_replace_with_low_bit_linear`
+        qtype = check_hidden_size(ggml_tensor_qtype[name], in_features)
+        if qtype in DEQUANT_UNSUPPORTED_QTYPES + [NF4, ggml_tensor_qtype["bf16"]]:
+            continue
+        actual = [key for key, value in ggml_tensor_qtype.items() if value == qtype][0]
+        candidates.setdefault(actual, qtype)
+    return candidates
+
+
+def _output_error(reference, output, metric):
+    if metric == "mse":
+        # normalized by the output power, so that errors of different layers are comparable
+        power = reference.pow(2).mean().clamp(min=1e-12)
+        return ((output - reference).pow(2).mean() / power).item()
+    else:
+        log_p = torch.log_softmax(reference, dim=-1)
+        log_q = torch.log_softmax(output, dim=-1)
+        return (log_p.exp() * (log_p - log_q)).sum(-1).mean().item()
+
+
+def measure_sensitivity(weight, inputs, qtypes, metric="mse"):
+    """
+    Quantize `weight` to each of `qtypes` and measure the error of the layer output.
+
+    :param weight: `[out_features, in_features]` weight of the full precision layer.
+    :param inputs: `[rows, in_features]` calibration inputs of the layer.
+    :param qtypes: list of qtype names.
+    :param metric: ``'mse'`` for the output mean squared error normalized by the output
+        power, or ``'kl'`` for the KL divergence of the softmax of the output.
+
+    :return: dict of qtype name -> (quantized size in bytes, error).
+    """
+    from ipex_llm.transformers.low_bit_linear import ggml_convert_qtype, ggml_convert_fp32
+    weight = weight.float().contiguous()
+    inputs = inputs.float()
+    reference = inputs @ weight.t()
+    result = {}
+    for name, qtype in _candidate_qtypes(qtypes, weight.size(1)).items():
+        quantized = ggml_convert_qtype(weight, qtype, device="cpu")
+        dequantized = ggml_convert_fp32(quantized, weight.shape, weight.numel(), qtype)
+        result[name] = (quantized.numel() * quantized.element_size(),
+                        _output_error(reference, inputs @ dequantized.t(), metric))
+    return result
+
+
+@torch.no_grad()
+def collect_inputs(model, calibration_data, max_rows=256):
+    """
+    Run `calibration_data` through `model` and keep up to `max_rows` randomly sampled
+    input rows of each `nn.Linear`, so the memory is bounded by
+    `max_rows * sum(in_features) * 4` bytes.
+    """
+    linears = {name: module for name, module in model.named_modules()
+               if type(module) is torch.nn.Linear}
+    inputs = {name: [] for name in linears}
+    generator = torch.Generator().manual_seed(0)
+
+    def make_hook(name):
+        def hook(module, args, output):
+            x = args[0].detach().reshape(-1, module.in_features)
+            if x.size(0) > max_rows:
+                x = x[torch.randperm(x.size(0), generator=generator)[:max_rows]]
+            inputs[name].append(x.float().cpu())
+            rows = torch.cat(inputs[name])
+            if rows.size(0) > max_rows:
+                rows = rows[torch.randperm(rows.size(0), generator=generator)[:max_rows]]
+            inputs[name] = [rows]
+        return hook
+
+    handles = [module.register_forward_hook(make_hook(name))
+               for name, module in linears.items()]
+    try:
+        for input_ids in calibration_data:
+            model(input_ids=input_ids.to(model.device))
+    finally:
+        for handle in handles:
+            handle.remove()
+    return {name: xs[0] for name, xs in inputs.items() if xs}
+
+
+def _plan_units(model, names):
+    # tie the projections which are merged or run together to one unit
+    from ipex_llm.transformers.models.common import MULTI_LINEAR_GROUPS
+    units, grouped, available = [], set(), set(names)
+    for parent_name, _ in model.named_modules():
+        for group in MULTI_LINEAR_GROUPS:
+            members = [parent_name + "." + name if parent_name else name for name in group]
+            if all(member in available for member in members):
+                units.append(members)
+                grouped.update(members)
+    units.extend([name] for name in names if name not in grouped)
+    return units
+
+
+def solve_plan(units, budget_bytes):
+    """
+    Choose one option of each unit, minimizing the total error with the total size
+    within `budget_bytes`: start from the smallest option of every unit, then greedily
+    apply the upgrade with the largest error reduction per byte that still fits.
+
+    :param units: list of dicts of qtype name -> (size in bytes, error).
+    :param budget_bytes: int value, the size budget of all units.
+
+    :return: list of chosen qtype names, and their total size in bytes.
+    """
+    choices = [min(options, key=lambda name: (options[name][0], options[name][1]))
+               for options in units]
+    total = sum(options[choice][0] for options, choice in zip(units, choices))
+    invalidInputError(total <= budget_bytes,
+                      f"The budget of {budget_bytes / (1024 ** 3):.2f} GB is too small, the "
+                      f"smallest candidate qtypes need {total / (1024 ** 3):.2f} GB.")
+    while True:
+        best = None
+        for i, options in enumerate(units):
+            size, error = options[choices[i]]
+            for name, (new_size, new_error) in options.items():
+                if new_error >= error or total - size + new_size > budget_bytes:
+                    continue
+                gain = (error - new_error) / max(new_size - size, 1)
+                if best is None or gain > best[0]:
+                    best = (gain, i, name)
+        if best is None:
+            break
+        _, i, name = best
+        total += units[i][name][0] - units[i][choices[i]][0]
+        choices[i] = name
+    return choices, total
+
+
+def plan_mixed_precision(model, calibration_data, qtypes=None, target_size_gb=None,
+                         target_tokens_per_s=None, memory_bandwidth_gb=None, metric="mse",
+                         max_rows=256, modules_to_not_convert=None):
+    """
+    Build a mixed precision plan of a full precision model.
+
+    :param model: the Hugging Face model before low-bit conversion.
+    :param calibration_data: iterable of `[1, seq_len]` input ids tensors.
+    :param qtypes: list of candidate qtype names, default to
+        ``['sym_int4', 'q4_k', 'q5_k', 'q6_k', 'sym_int8']``.
+    :param target_size_gb: float value, the budget of the whole model size in GB.
+    :param target_tokens_per_s: float value, the decode speed to reach. As decoding reads
+        every linear weight once per token, it is converted to a budget of the linear
+        weights of ``memory_bandwidth_gb / target_tokens_per_s``.
+    :param memory_bandwidth_gb: float value, the achievable memory bandwidth in GB/s,
+        required by ``target_tokens_per_s``.
+    :param metric: ``'mse'`` or ``'kl'``, see `measure_sensitivity`.
+    :param max_rows: int value, the number of sampled input rows of each linear.
+    :param modules_to_not_convert: list of module names kept in full precision.
+
+    :return: the plan dict.
+    """
+    qtypes = qtypes or DEFAULT_CANDIDATE_QTYPES
+    modules_to_not_convert = modules_to_not_convert or []
+    invalidInputError(metric in METRICS, f"Unknown metric {metric}, expected one of {METRICS}.")
+    invalidInputError((target_size_gb is None) != (target_tokens_per_s is None),
+                      "Please specify one of `target_size_gb` and `target_tokens_per_s`.")
+    invalidInputError(target_tokens_per_s is None or memory_bandwidth_gb is not None,
+                      "`target_tokens_per_s` requires `memory_bandwidth_gb`.")
+
+    inputs = collect_inputs(model, calibration_data, max_rows)
+    modules = dict(model.named_modules())
+    names = [name for name, x in inputs.items()
+             if modules[name].in_features % 64 == 0
+             and not any(key in name for key in modules_to_not_convert)]
+    # the size of parameters which are not quantized by the plan
+    fixed_bytes = sum(param.numel() * param.element_size()
+                      for name, param in model.named_parameters()
+                      if name.rpartition(".")[0] not in names or name.endswith("bias"))
+
+    units, unit_options = _plan_units(model, names), []
+    for i, unit in enumerate(units):
+        options = {}
+        for name in unit:
+            for qtype, (size, error) in measure_sensitivity(modules[name].weight, inputs[name],
+                                                            qtypes, metric).items():
+                old_size, old_error = options.get(qtype, (0, 0.0))
+                options[qtype] = (old_size + size, old_error + error)
+        # qtypes unavailable for one member, e.g. k-quants with in_features % 256 != 0
+        unit_options.append({qtype: value for qtype, value in options.items()
+                             if all(qtype in _candidate_qtypes(qtypes, modules[name].in_features)
+                                    for name in unit)})
+        errors = ", ".join(f"{qtype}={error:.3e}"
+                           for qtype, (_, error) in unit_options[-1].items())
+        logger.info(f"Measured {i + 1}/{len(units)} {unit[0]}: {errors}")
+
+    if target_size_gb is not None:
+        budget_bytes = int(target_size_gb * (1024 ** 3)) - fixed_bytes
+    else:
+        budget_bytes = int(memory_bandwidth_gb * (1024 ** 3) / target_tokens_per_s)
+    choices, size_bytes = solve_plan(unit_options, budget_bytes)
+
+    plan_modules = {}
+    for unit, choice in zip(units, choices):
+        for name in unit:
+            plan_modules[name] = choice
+    return {
+        "format": PLAN_FORMAT,
+        "version": PLAN_VERSION,
+        "metric": metric,
+        "target_size_gb": target_size_gb,
+        "target_tokens_per_s": target_tokens_per_s,
+        "memory_bandwidth_gb": memory_bandwidth_gb,
+        "linear_size_gb": size_bytes / (1024 ** 3),
+        "total_size_gb": (size_bytes + fixed_bytes) / (1024 ** 3),
+        "error": sum(options[choice][1] for options, choice in zip(unit_options, choices)),
+        "modules": plan_modules,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a mixed precision plan, which assigns "
+                                                 "one low-bit qtype to each linear")
+    parser.add_argument("--model", type=str, required=True,
+                        help="path or hub id of the full precision model")
+    parser.add_argument("--calib-file", type=str, required=True,
+                        help="text file of the calibration data")
+    parser.add_argument("--output", type=str, required=True, help="output plan file")
+    parser.add_argument("--qtypes", type=str, nargs="+", default=DEFAULT_CANDIDATE_QTYPES)
+    parser.add_argument("--target-size-gb", type=float, default=None)
+    parser.add_argument("--target-tokens-per-s", type=float, default=None)
+    parser.add_argument("--memory-bandwidth-gb", type=float, default=None,
+                        help="achievable memory bandwidth in GB/s, required by "
+                             "--target-tokens-per-s")
+    parser.add_argument("--metric", type=str, default="mse", choices=METRICS)
+    parser.add_argument("--num-samples", type=int, default=8)
+    parser.add_argument("--seq-len", type=int, default=512)
+    parser.add_argument("--max-rows", type=int, default=256)
+    parser.add_argument("--modules-to-not-convert", type=str, nargs="*", default=None)
+    args = parser.parse_args()
+
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(args.model, trust_remote_code=True)
+    model = AutoModelForCausalLM.from_pretrained(args.model, torch_dtype=torch.bfloat16,
+                                                 trust_remote_code=True)
+    model.eval()
+
+    with open(args.calib_file, "r", encoding="utf-8") as f:
+        input_ids = tokenizer(f.read(), return_tensors="pt").input_ids
+    calibration_data = [input_ids[:, start:start + args.seq_len]
+                        for start in range(0, input_ids.size(1), args.seq_len)]
+    calibration_data = calibration_data[:args.num_samples]
+
+    plan = plan_mixed_precision(model, calibration_data, args.qtypes,
+                                target_size_gb=args.target_size_gb,
+                                target_tokens_per_s=args.target_tokens_per_s,
+                                memory_bandwidth_gb=args.memory_bandwidth_gb,
+                                metric=args.metric, max_rows=args.max_rows,
+                                modules_to_not_convert=args.modules_to_not_convert)
+    save_plan(plan, args.output)
+    counts = {}
+    for qtype in plan["modules"].values():
+        counts[qtype] = counts.get(qtype, 0) + 1
+    print(f"Saved plan of {len(plan['modules'])} modules ({counts}), "
+          f"{plan['total_size_gb']:.2f} GB in total, to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
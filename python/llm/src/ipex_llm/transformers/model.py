@@ -150,7 +150,20 @@ class _BaseAutoModelClass:
             ``nn.Embedding`` layer.
         :param mixed_precision: boolean value, Whether to use mixed precision quantization.
             Default to be False. If set to True, we will use sym_int8 for lm_head when
-            load_in_low_bit is sym_int4 or asym_int4.
+            load_in_low_bit is sym_int4 or asym_int4. It can also be the path (or the
+            loaded dict) of a mixed precision plan built by
+            ``python -m ipex_llm.transformers.mixed_precision``, which assigns a qtype to
+            each linear, and ``load_in_low_bit`` is used for the linears not in the plan.
+            The plan is saved by ``save_low_bit`` and applied again by ``load_low_bit``.
+        :param layerwise_load: boolean value, whether to stream the safetensors checkpoint
+            into the model one decoder layer at a time, so that the peak memory during
+            conversion is about the low-bit model plus one full precision decoder layer.
+            Default to be False. Only safetensors checkpoints are supported.
+        :param low_bit_cache_dir: str value, directory of the cache of converted low-bit
+            models, default to the value of ``IPEX_LLM_LOW_BIT_CACHE_DIR``. If set, the
+            converted model is saved into the cache, and later calls with the same
+            checkpoint and conversion options load it with ``load_low_bit`` instead of
+            converting again. Default to be None, which disables the cache.
         :param pipeline_parallel_stages: int value, the number of GPUs allocated for
             pipeline parallel. Default to be ``1``. Please set pipeline_parallel_stages > 1
             to run pipeline parallel inference on multiple GPUs.
@@ -190,6 +203,7 @@ class _BaseAutoModelClass:
         pipeline_parallel_stages = kwargs.pop("pipeline_parallel_stages", 1)
         torch_dtype = kwargs.pop("torch_dtype", None)
         embedding_qtype = kwargs.pop("embedding_qtype", None)
+        low_bit_cache_dir = kwargs.pop("low_bit_cache_dir", None)
 
         if user_quantization_config is not None and \
                 "BitsAndBytesConfig" in str(user_quantization_config.__class__):
@@ -346,7 +360,50 @@ class _BaseAutoModelClass:
                 imatrix_data = load_imatrix_data(imatrix_file)
                 kwargs["imatrix_data"] = imatrix_data
             kwargs["embedding_qtype"] = embedding_qtype
-            model = cls.load_convert(q_k, optimize_model, *args, **kwargs)
+
+            low_bit_cache = None
+            if model_hub == "huggingface" and kwargs.get("quantization_config", None) is None:
+                from .low_bit_cache import get_low_bit_cache, describe_kwargs
+                low_bit_cache = get_low_bit_cache(low_bit_cache_dir)
+                extra_kwargs = describe_kwargs(kwargs)
+                if low_bit_cache is not None and extra_kwargs is None:
+                    logger.info("Some arguments of from_pretrained cannot be part of the "
+                                "low-bit cache key, the converted model is not cached.")
+                    low_bit_cache = None
+            model = None
+            if low_bit_cache is not None:
+                cache_key, cache_options = low_bit_cache.make_key(
+                    pretrained_model_name_or_path, cls.HF_Model.__name__, q_k, optimize_model,
+                    modules_to_not_convert=kwargs.get("modules_to_not_convert", None),
+                    cpu_embedding=cpu_embedding,
+                    embedding_qtype=embedding_qtype,
+                    imatrix=imatrix_file,
+                    mixed_precision=kwargs.get("mixed_precision", False),
+                    disable_optimize_pre=kwargs.get("disable_optimize_pre", False),
+                    torch_dtype=kwargs["torch_dtype"],
+                    extra_kwargs=extra_kwargs)
+                cache_path = low_bit_cache.lookup(cache_key)
+                if cache_path is not None:
+                    logger.info(f"Loading converted low-bit model from cache {cache_path}.")
+                    model = cls.load_low_bit(
+                        cache_path,
+                        optimize_model=optimize_model,
+                        modules_to_not_convert=kwargs.get("modules_to_not_convert", None),
+                        cpu_embedding=cpu_embedding,
+                        disk_embedding=kwargs.get("disk_embedding", False),
+                        embedding_qtype=embedding_qtype,
+                        torch_dtype=kwargs["torch_dtype"],
+                        trust_remote_code=kwargs.get("trust_remote_code", None))
+                    import types
+                    model.save_low_bit = types.MethodType(save_low_bit, model)
+            if model is None:
+                model = cls.load_convert(q_k, optimize_model, *args, **kwargs)
+                if low_bit_cache is not None:
+                    try:
+                        low_bit_cache.store(model, cache_key, cache_options,
+                                            source=pretrained_model_name_or_path)
+                    except OSError as e:
+                        logger.warning(f"Failed to store the low-bit model into cache: {e}")
 
             if pipeline_parallel_stages > 1:
                 if speculative:
@@ -435,9 +492,13 @@ class _BaseAutoModelClass:
         imatrix_data = kwargs.pop("imatrix_data", None)
         embedding_qtype = kwargs.pop("embedding_qtype", None)
         mixed_precision = kwargs.pop("mixed_precision", False)
+        if not isinstance(mixed_precision, bool):
+            from .mixed_precision import load_plan
+            mixed_precision = load_plan(mixed_precision)
         if embedding_qtype is not None:
             embedding_qtype = ggml_tensor_qtype[embedding_qtype]
         disable_optimize_pre = kwargs.pop("disable_optimize_pre", False)
+        layerwise_load = kwargs.pop("layerwise_load", False)
         _args = copy.deepcopy(args)
         _kwargs = copy.deepcopy(kwargs)
         awq_config = None
@@ -484,6 +545,24 @@ class _BaseAutoModelClass:
                 device_map=device_map,
                 offload_dir=None
             )
+        elif layerwise_load:
+            from .streaming_load import layerwise_load_low_bit
+            invalidInputError(quant_config is None,
+                              "`layerwise_load` does not support `quantization_config`.")
+            kwargs.pop("device_map", None)
+            kwargs.pop("low_cpu_mem_usage", None)
+            torch_dtype = kwargs.pop("torch_dtype", None)
+            model = layerwise_load_low_bit(
+                cls.HF_Model, args[0], qtype, optimize_model,
+                torch_dtype=torch_dtype,
+                subfolder=kwargs.pop("subfolder", ""),
+                convert_kwargs=dict(modules_to_not_convert=modules_to_not_convert,
+                                    cpu_embedding=cpu_embedding,
+                                    imatrix_data=imatrix_data,
+                                    embedding_qtype=embedding_qtype,
+                                    mixed_precision=mixed_precision,
+                                    disable_optimize_pre=disable_optimize_pre),
+                **kwargs)
         else:
             if quant_config is not None:
                 kwargs["quantization_config"] = quant_config
@@ -498,15 +577,16 @@ class _BaseAutoModelClass:
                 model = cls.HF_Model.from_pretrained(*_args, **_kwargs)
                 model.config.update({"bigdl_lcmu_enabled": False})
 
-        model = model.to("cpu")
-        model = ggml_convert_low_bit(model, qtype, optimize_model,
-                                     modules_to_not_convert=modules_to_not_convert,
-                                     cpu_embedding=cpu_embedding,
-                                     torch_dtype=kwargs.get("torch_dtype", 'auto'),
-                                     imatrix_data=imatrix_data,
-                                     embedding_qtype=embedding_qtype,
-                                     mixed_precision=mixed_precision,
-                                     disable_optimize_pre=disable_optimize_pre)
+        if not layerwise_load or awq_config is not None:
+            model = model.to("cpu")
+            model = ggml_convert_low_bit(model, qtype, optimize_model,
+                                         modules_to_not_convert=modules_to_not_convert,
+                                         cpu_embedding=cpu_embedding,
+                                         torch_dtype=kwargs.get("torch_dtype", 'auto'),
+                                         imatrix_data=imatrix_data,
+                                         embedding_qtype=embedding_qtype,
+                                         mixed_precision=mixed_precision,
+                                         disable_optimize_pre=disable_optimize_pre)
 
         if disk_embedding:
             from ipex_llm.transformers.embedding import DiskEmbedding
@@ -514,6 +594,8 @@ class _BaseAutoModelClass:
 
         model.config.update({"bigdl_transformers_low_bit": q_k,
                              "bigdl_disk_embedding": disk_embedding})
+        if isinstance(mixed_precision, dict):
+            model.config.update({"bigdl_mixed_precision_plan": mixed_precision})
 
         # enable tie_word_embeddings for MPT
         # refer to https://huggingface.co/mosaicml/mpt-7b-chat/blob/main/modeling_mpt.py#L232
@@ -525,6 +607,10 @@ class _BaseAutoModelClass:
         import types
         model.save_low_bit = types.MethodType(save_low_bit, model)
 
+        # time the dense prefill path here instead of in the first long request
+        from .dequant_cache import calibrate_model
+        calibrate_model(model)
+
         return model
 
     @classmethod
@@ -593,6 +679,7 @@ class _BaseAutoModelClass:
         config_dict, _ = PretrainedConfig.get_config_dict(pretrained_model_name_or_path)
         bigdl_transformers_low_bit = config_dict.pop("bigdl_transformers_low_bit", False)
         bigdl_lcmu_enabled = config_dict.pop("bigdl_lcmu_enabled", True)
+        mixed_precision_plan = config_dict.pop("bigdl_mixed_precision_plan", None)
 
         invalidInputError(bigdl_transformers_low_bit,
                           "Detect this model is not a low-bit model, Please use from_pretrained"
@@ -700,7 +787,8 @@ class _BaseAutoModelClass:
         model = ggml_convert_low_bit(model, qtype, optimize_model, device=quant_device,
                                      modules_to_not_convert=modules_to_not_convert,
                                      cpu_embedding=cpu_embedding,
-                                     embedding_qtype=embedding_qtype, torch_dtype=torch_dtype)
+                                     embedding_qtype=embedding_qtype, torch_dtype=torch_dtype,
+                                     mixed_precision=mixed_precision_plan or False)
 
         if is_sharded:
             loaded_state_dict_keys = sharded_metadata["all_checkpoint_keys"]
@@ -785,6 +873,9 @@ class _BaseAutoModelClass:
         except ImportError as e:
             pass
 
+        from .dequant_cache import calibrate_model
+        calibrate_model(model)
+
         return model
 
 
@@ -15,7 +15,10 @@
 
 
 import math
+import threading
+import functools
 import torch
+from collections import OrderedDict
 from typing import List
 from ipex_llm.utils.common import invalidInputError
 
@@ -53,6 +56,50 @@ def merge_qkv_base(module: torch.nn.Module, attention_class):
             del module.q_proj, module.k_proj, module.v_proj
 
 
+# projections sharing one input, which are run by `MultiLowBitLinear` on CPU if not merged
+QKV_LINEAR_GROUP = ["q_proj", "k_proj", "v_proj"]
+MULTI_LINEAR_GROUPS = [
+    QKV_LINEAR_GROUP,
+    ["gate_proj", "up_proj"],
+    ["w1", "w3"],
+]
+
+
+def mark_multi_linear(module: torch.nn.Module, groups=MULTI_LINEAR_GROUPS):
+    if "CrossAttention" in module.__class__.__name__ or \
+            getattr(module, "is_cross_attention", False):
+        # k/v_proj of cross attention take the encoder output, not the input of q_proj
+        groups = [names for names in groups if names != QKV_LINEAR_GROUP]
+    marked_groups = []
+    for names in groups:
+        linears = [getattr(module, name, None) for name in names]
+        if (
+            all(type(linear) is torch.nn.Linear for linear in linears)
+            and len(set(linear.in_features for linear in linears)) == 1
+            and len(set(linear.bias is None for linear in linears)) == 1
+        ):
+            marked_groups.append(names)
+    if marked_groups:
+        module.multi_linear_groups = marked_groups
+
+
+def apply_multi_low_bit_linear(module: torch.nn.Module):
+    from ipex_llm.transformers.low_bit_linear import LowBitLinear, MultiLowBitLinear
+    from ipex_llm.transformers.low_bit_linear import DEQUANT_UNSUPPORTED_QTYPES
+    for names in getattr(module, "multi_linear_groups", []):
+        linears = [getattr(module, name, None) for name in names]
+        if (
+            all(type(linear) is LowBitLinear for linear in linears)
+            and len(set(linear.qtype for linear in linears)) == 1
+            and linears[0].qtype not in DEQUANT_UNSUPPORTED_QTYPES
+            and not any(linear.act_order or linear.optimize_lm_head
+                        or linear.mp_group is not None for linear in linears)
+        ):
+            multi_linear = MultiLowBitLinear(linears)
+            for linear in linears:
+                linear.multi_linear = multi_linear
+
+
 def padding_linear_hd(linear: torch.nn.Linear,
                       old_head_dim: int, new_head_dim: int) -> torch.nn.Linear:
     in_features, out_features = linear.in_features, linear.out_features
@@ -216,26 +263,145 @@ def layer_norm_forward(self, hidden_states: torch.Tensor):
         )
 
 
+class ForwardContext(threading.local):
+    """
+    Attention masks and RoPE cos/sin shared by all decoder layers, instead of being built
+    by every layer of every forward.
+
+    Masks only depend on their shapes, so they are cached by shape across forwards: padding
+    masks are views of one ramp buffer growing by blocks, small (decode-size) causal masks
+    are kept in an LRU cache bounded by bytes. RoPE cos/sin only depend on the positions,
+    which are the same `position_ids` tensor for all layers of a forward, so they are
+    computed by the first layer and reused until `position_ids` changes.
+    """
+
+    block_size = 128
+    max_causal_mask_bytes = 4 * 1024 * 1024
+    # larger (prefill) masks are built by every forward instead of being cached
+    max_cached_causal_mask_bytes = 512 * 1024
+
+    def __init__(self):
+        self.ramps = {}
+        self.causal_masks = OrderedDict()
+        self.causal_mask_bytes = 0
+        self.rope = None
+
+    def padding_mask(self, kv_length, padding_kv_length, dtype, device):
+        """
+        Return a `[1, 1, 1, padding_kv_length]` mask, 0 for the first `kv_length` positions
+        and the min value of `dtype` for the others.
+        """
+        ramp = self.ramps.get((dtype, device), None)
+        if ramp is None or ramp.size(0) < 2 * padding_kv_length:
+            capacity = (padding_kv_length + self.block_size - 1) // self.block_size \
+                * self.block_size
+            if ramp is not None:
+                capacity = max(capacity, ramp.size(0))
+            ramp = torch.full([2 * capacity], torch.finfo(dtype).min, dtype=dtype,
+                              device=device)
+            ramp[:capacity] = 0
+            self.ramps[(dtype, device)] = ramp
+        # `capacity` zeros then `capacity` min values
+        capacity = ramp.size(0) // 2
+        return ramp[capacity - kv_length:capacity - kv_length + padding_kv_length].view(
+            1, 1, 1, padding_kv_length)
+
+    def causal_mask(self, seq_length, kv_length, padding_kv_length, dtype, device):
+        """
+        Return a `[1, 1, seq_length, padding_kv_length]` causal mask for the last
+        `seq_length` positions of `kv_length`, the padding is masked too.
+        """
+        key = (seq_length, kv_length, padding_kv_length, dtype, device)
+        mask = self.causal_masks.get(key, None)
+        if mask is None:
+            mask = torch.full([1, 1, seq_length, padding_kv_length], torch.finfo(dtype).min,
+                              dtype=dtype, device=device)
+            mask.triu_(1 + kv_length - seq_length)
+            mask[..., kv_length:] = torch.finfo(dtype).min
+            nbytes = mask.numel() * mask.element_size()
+            if nbytes <= self.max_cached_causal_mask_bytes:
+                self.causal_masks[key] = mask
+                self.causal_mask_bytes += nbytes
+                while self.causal_mask_bytes > self.max_causal_mask_bytes:
+                    _, evicted = self.causal_masks.popitem(last=False)
+                    self.causal_mask_bytes -= evicted.numel() * evicted.element_size()
+        else:
+            self.causal_masks.move_to_end(key)
+        return mask
+
+    def rotary(self, rotary_emb: torch.nn.Module, x: torch.Tensor,
+               position_ids: torch.Tensor):
+        """
+        Return `rotary_emb(x, position_ids)`, shared by all layers of one forward.
+        """
+        inv_freq = getattr(rotary_emb, "inv_freq", None)
+        if self.rope is not None:
+            (cached_type, cached_inv_freq, cached_scaling, cached_position_ids,
+             cached_version, cached_dtype, cos, sin) = self.rope
+            # each layer may have its own `rotary_emb` with the same `inv_freq`
+            if (
+                cached_position_ids is position_ids
+                and cached_version == position_ids._version
+                and cached_dtype == x.dtype
+                and cached_type is type(rotary_emb)
+                and cached_scaling == getattr(rotary_emb, "attention_scaling", None)
+                and (cached_inv_freq is inv_freq
+                     or isinstance(inv_freq, torch.Tensor)
+                     and cached_inv_freq.shape == inv_freq.shape
+                     and torch.equal(cached_inv_freq, inv_freq))
+            ):
+                return cos, sin
+        from ipex_llm.transformers.models.utils import make_cache_contiguous_inplaced
+        cos, sin = rotary_emb(x, position_ids)
+        make_cache_contiguous_inplaced(cos, sin)
+        # keep `position_ids` alive, so that its memory is not reused by new positions
+        self.rope = (type(rotary_emb), inv_freq, getattr(rotary_emb, "attention_scaling", None),
+                     position_ids, position_ids._version, x.dtype, cos, sin)
+        return cos, sin
+
+    def clear(self):
+        self.ramps = {}
+        self.causal_masks = OrderedDict()
+        self.causal_mask_bytes = 0
+        self.rope = None
+
+
+forward_context = ForwardContext()
+
+
+def clear_forward_context(generate):
+    """
+    Decorate `generate` to release the masks and RoPE cos/sin of `forward_context` once it
+    returns, as the context of a thread is shared by all models it runs.
+    """
+    @functools.wraps(generate)
+    def wrapper(*args, **kwargs):
+        try:
+            return generate(*args, **kwargs)
+        finally:
+            forward_context.clear()
+    return wrapper
+
+
 def prepare_mask(mask, bsz, n_heads, seq_length, kv_length, is_causal, dtype, device):
-    max_kvs = 128
+    max_kvs = ForwardContext.block_size
     padding_kv_length = (kv_length + max_kvs - 1) // max_kvs * max_kvs
     if mask is None:
         if is_causal:
-            mask = torch.full([1, 1, seq_length, padding_kv_length], torch.finfo(dtype).min,
-                              dtype=dtype, device=device)
-            mask.triu_(1)
+            mask = forward_context.causal_mask(seq_length, kv_length, padding_kv_length,
+                                               dtype, device)
             mask = mask.expand([bsz, n_heads, seq_length, padding_kv_length])
         elif seq_length != kv_length and seq_length <= 32:
             mask = None
         else:
-            mask = torch.zeros([1, 1, 1, padding_kv_length], dtype=dtype, device=device)
-            mask[..., kv_length:padding_kv_length] = torch.finfo(dtype).min
+            mask = forward_context.padding_mask(kv_length, padding_kv_length, dtype, device)
             mask = mask.expand([bsz, n_heads, seq_length, padding_kv_length])
     else:
         if seq_length != kv_length and seq_length <= 32:
             mask = mask[..., :seq_length, :kv_length]
             mask = mask.expand([bsz, n_heads, seq_length, kv_length])
         elif mask.size(3) != padding_kv_length:
+            # the model level mask is padded by the first layer and shared by the others
             new_mask = torch.empty([bsz, 1, seq_length, padding_kv_length],
                                    dtype=dtype, device=device)
             new_mask[:, :, :, :kv_length] = mask[:, 0:1, :seq_length, :kv_length]
@@ -288,6 +454,11 @@ def scaled_dot_product_attention(query: torch.Tensor, key: torch.Tensor,
         return attn_output
     else:
         mask = mask[..., :seq_length, :kv_length] if mask is not None else None
+        if is_causal and mask is None and seq_length != kv_length:
+            # torch's `is_causal` aligns to the top left, while the queries are the last
+            # `seq_length` positions here
+            mask = forward_context.causal_mask(seq_length, kv_length, kv_length,
+                                               dtype, device)
 
         from ipex_llm.transformers.models.utils import repeat_kv
         if n_heads != n_kv_heads:
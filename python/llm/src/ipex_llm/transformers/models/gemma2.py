@@ -35,6 +35,7 @@ import torch
 
 from typing import Optional, Tuple
 from ipex_llm.transformers.models.common import merge_qkv_base
+from ipex_llm.transformers.models.common import forward_context
 from ipex_llm.transformers.models.utils import GELU
 from ipex_llm.transformers.models.utils import should_use_fuse_rope, use_sdp, use_sdp_causal
 from transformers.cache_utils import Cache
@@ -112,7 +113,7 @@ def gemma2_attention_forward(
                                        query_states, key_states)
         cos, sin = None, None
     else:
-        cos, sin = self.rotary_emb(value_states, position_ids)
+        cos, sin = forward_context.rotary(self.rotary_emb, value_states, position_ids)
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin)
 
     if past_key_value is not None:
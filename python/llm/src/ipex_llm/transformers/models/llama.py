@@ -46,6 +46,7 @@ from transformers.models.llama.modeling_llama import apply_rotary_pos_emb
 
 from ipex_llm.transformers.models.common import merge_qkv_base
 from ipex_llm.transformers.models.common import scaled_dot_product_attention
+from ipex_llm.transformers.models.common import forward_context
 from ipex_llm.transformers.models.utils import make_cache_contiguous_inplaced
 from ipex_llm.transformers.models.utils import use_quantize_kv_cache
 from ipex_llm.transformers.models.utils import should_use_compresskv, is_enough_kv_cache_room_4_36
@@ -171,7 +172,7 @@ def llama_attention_forward(
                 cos, sin = self.rotary_emb(value_states, kv_seq_len)
             else:
                 # transformers >= 4.38
-                cos, sin = self.rotary_emb(value_states, position_ids)
+                cos, sin = forward_context.rotary(self.rotary_emb, value_states, position_ids)
         else:
             cos, sin = position_embeddings
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states,
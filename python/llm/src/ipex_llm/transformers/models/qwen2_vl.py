@@ -44,6 +44,7 @@ import torch
 
 from ipex_llm.transformers.models.common import merge_qkv_base, attention_softmax
 from ipex_llm.transformers.models.common import scaled_dot_product_attention
+from ipex_llm.transformers.models.common import forward_context
 from ipex_llm.transformers.models.utils import use_quantize_kv_cache
 from ipex_llm.transformers.models.utils import should_use_fuse_rope
 from ipex_llm.transformers.models.utils import use_sdp_non_causal
@@ -291,7 +292,7 @@ def qwen2_vl_attention_forward(
         xe_addons.rotary_half_inplaced(inv_freq, position_ids, query_states, key_states)
     else:
         if position_embeddings is None:
-            cos, sin = self.rotary_emb(value_states, position_ids)
+            cos, sin = forward_context.rotary(self.rotary_emb, value_states, position_ids)
         else:
             cos, sin = position_embeddings
         query_states, key_states = apply_multimodal_rotary_pos_emb(
@@ -466,6 +466,11 @@ class BatchTask(BaseModel):
     prefilled_index: int
     partial_prefilling: int
 
+    # length of the cached prefix shared by all prompts, and the prompt token ids to keep
+    # in the prefix cache after prefilling, see `PPModelWorker.match_prefix`
+    prefix_len: int = 0
+    prompt_ids: Optional[List[List[int]]] = None
+
 
 def make_attention_mask(prompt_lengths, device):
     max_length = max(prompt_lengths)
@@ -520,6 +525,20 @@ class PPModelWorker:
 
         self.stream_tasks = {}
 
+        # every stage keeps the kv of its own layers in its own prefix cache, the budget of
+        # IPEX_LLM_PREFIX_CACHE_GB is for all layers and applied as a number of tokens so
+        # that all stages evict the same prefixes
+        from ipex_llm.transformers.prefix_cache import PrefixCache, PREFIX_CACHE_GB_ENV, \
+            kv_bytes_per_token
+        self.prefix_cache = None
+        self.prefix_nodes = {}
+        prefix_cache_gb = float(os.environ.get(PREFIX_CACHE_GB_ENV, "0"))
+        if prefix_cache_gb > 0 and \
+                self.model.config.model_type not in ["baichuan", "chatglm", "mixtral"]:
+            max_tokens = int(prefix_cache_gb * (1024 ** 3)
+                             / kv_bytes_per_token(self.model.config, self.dtype))
+            self.prefix_cache = PrefixCache(max_tokens=max_tokens)
+
     def load_model(self, model_path, world_size, low_bit='sym_int4'):
         from ipex_llm.transformers import AutoModelForCausalLM, AutoModel
         try:
@@ -590,6 +609,50 @@ class PPModelWorker:
 
             return kv_cache_1
 
+    def match_prefix(self, batch_id, prompt_ids, pad_token_id):
+        # prefill only the prompts after their longest cached prefix shared by the batch,
+        # each row of the kv cache is [prefix][padding][rest of the prompt]
+        prompts = [torch.tensor(ids) for ids in prompt_ids]
+        prefix_len = min(self.prefix_cache.longest_prefix(prompts[0]),
+                         min(prompt.size(0) for prompt in prompts) - 1)
+        from ipex_llm.transformers.session_cache import common_prefix_length
+        for prompt in prompts[1:]:
+            prefix_len = min(prefix_len, common_prefix_length(prompts[0], prompt))
+        for prompt in prompts:
+            self.prefix_cache.record(prompt.size(0), max(prefix_len, 0))
+        if prefix_len <= 0:
+            return None, 0
+        self.prefix_nodes[batch_id], _ = self.prefix_cache.match(prompts[0], prefix_len)
+        rest_lengths = [prompt.size(0) - prefix_len for prompt in prompts]
+        input_ids = torch.full((len(prompts), max(rest_lengths)), pad_token_id,
+                               dtype=torch.int64)
+        for i, prompt in enumerate(prompts):
+            input_ids[i, input_ids.size(1) - rest_lengths[i]:] = prompt[prefix_len:]
+        return input_ids, prefix_len
+
+    def reference_prefix(self, cur_batch):
+        # later stages reference the same prefix as the first stage
+        if cur_batch.prefix_len == 0 or cur_batch.batch_id in self.prefix_nodes:
+            return
+        prefix_ids = torch.tensor(cur_batch.prompt_ids[0][:cur_batch.prefix_len])
+        node, length = self.prefix_cache.match(prefix_ids, cur_batch.prefix_len)
+        invalidInputError(length == cur_batch.prefix_len,
+                          f"Prefix cache of rank {self.rank} is inconsistent with rank 0, "
+                          f"IPEX_LLM_PREFIX_CACHE_GB should be the same on all ranks.")
+        self.prefix_nodes[cur_batch.batch_id] = node
+
+    def insert_prefix(self, cur_batch, past_key_values):
+        # keep the kv of the prompts after prefilling
+        if self.prefix_cache is None or cur_batch.prompt_ids is None:
+            return
+        prefix_positions = torch.arange(cur_batch.prefix_len)
+        for i, prompt in enumerate(cur_batch.prompt_ids):
+            rest_len = int(cur_batch.prompt_lengths[i])
+            end = cur_batch.prefix_len + cur_batch.input_len
+            positions = torch.cat([prefix_positions, torch.arange(end - rest_len, end)])
+            self.prefix_cache.insert(torch.tensor(prompt), past_key_values, i, positions)
+        cur_batch.prompt_ids = None
+
     def update_kv_cache(self, kv_cache, prefill=False):
         layer_start = self.model.layer_start
         layer_end = self.model.layer_end
@@ -627,6 +690,16 @@ class PPModelWorker:
         cur_id = cur_batch.batch_id
         _past_key_values = self.past_key_values_dict.get(cur_id, None)
         attention_mask = make_attention_mask(cur_batch.prompt_lengths, input.device)
+        position_ids = None
+        prefix_node = None
+        if self.prefix_cache is not None and cur_batch.prefix_len > 0:
+            self.reference_prefix(cur_batch)
+            prefix_node = self.prefix_nodes[cur_id]
+            prefix_mask = torch.ones((attention_mask.size(0), cur_batch.prefix_len),
+                                     dtype=attention_mask.dtype, device=attention_mask.device)
+            attention_mask = torch.cat([prefix_mask, attention_mask], dim=1)
+            position_ids = attention_mask.cumsum(-1) - 1
+            position_ids = position_ids.clamp(min=0)[:, -cur_batch.input_len:]
 
         if self.rank == 0:
             input_ids = input
@@ -650,12 +723,22 @@ class PPModelWorker:
                 tmp_past_key_values = _past_key_values
                 _past_key_values = None
 
+        if cur_batch.partial_prefilling > 0 and position_ids is not None:
+            position_ids = position_ids[cur_input_start:cur_input_end]
+        _prefill = _past_key_values is None
+        if _prefill and prefix_node is not None:
+            _past_key_values = self.prefix_cache.build_cache(prefix_node,
+                                                             cur_batch.prefix_len,
+                                                             attention_mask.size(0))
+
         torch.xpu.empty_cache()
+        model_kwargs = {} if position_ids is None else {"position_ids": position_ids}
         output = self.model(input_ids=input_ids,
                             inputs_embeds=inputs_embeds,
                             past_key_values=_past_key_values,
                             attention_mask=attention_mask,
-                            use_cache=True,)
+                            use_cache=True,
+                            **model_kwargs)
 
         if cur_batch.partial_prefilling > 0:
             cur_batch.prefilled_index = cur_input_end
@@ -669,6 +752,7 @@ class PPModelWorker:
 
             if cur_batch.prefilled_index == cur_batch.batch_size:
                 tmp_past_key_values = self.update_kv_cache(tmp_past_key_values, True)
+                self.insert_prefix(cur_batch, tmp_past_key_values)
 
             self.past_key_values_dict[cur_id] = tmp_past_key_values
 
@@ -682,9 +766,10 @@ class PPModelWorker:
                     _pre_output = torch.cat((_pre_output, tmp_output), dim=0)
                 self.partial_output_dict[cur_id] = _pre_output
         else:
-            _prefill = self.past_key_values_dict.get(cur_id, None) is None
             _past_key_values = self.update_kv_cache(output.past_key_values, prefill=_prefill)
             self.past_key_values_dict[cur_id] = _past_key_values
+            if _prefill:
+                self.insert_prefix(cur_batch, _past_key_values)
         torch.xpu.synchronize()
         if not self.pp_config.is_tail:
             _output = output[0]
@@ -715,18 +800,32 @@ class PPModelWorker:
 
         plain_texts = [req.inputs for req in prompt_requests]
         inputs = tokenizer(plain_texts, return_tensors="pt", padding=True)
-        input_ids = inputs.input_ids.to(f'xpu:{self.rank}')
-        attention_mask = inputs.attention_mask.to(f'xpu:{self.rank}')
+        batch_id = "batch_" + str(uuid.uuid4())
+        prompt_ids, prefix_len = None, 0
+        if self.prefix_cache is not None:
+            prompt_ids = [ids[mask.bool()].tolist()
+                          for ids, mask in zip(inputs.input_ids, inputs.attention_mask)]
+            prefix_input_ids, prefix_len = self.match_prefix(batch_id, prompt_ids,
+                                                             tokenizer.pad_token_id or 0)
+        if prefix_len > 0:
+            input_ids = prefix_input_ids.to(f'xpu:{self.rank}')
+            prompt_lengths = [len(ids) - prefix_len for ids in prompt_ids]
+        else:
+            input_ids = inputs.input_ids.to(f'xpu:{self.rank}')
+            attention_mask = inputs.attention_mask.to(f'xpu:{self.rank}')
+            prompt_lengths = [sum(attention_mask[i, :]) for i in range(input_ids.size(0))]
         new_batch = BatchTask(
-            batch_id="batch_" + str(uuid.uuid4()),
+            batch_id=batch_id,
             request_ids=request_ids,
             max_tokens=max([req.parameters.max_new_tokens for req in prompt_requests]),
             batch_size=input_ids.size(0),
             input_len=input_ids.size(1),
-            prompt_lengths=[sum(attention_mask[i, :]) for i in range(input_ids.size(0))],
+            prompt_lengths=prompt_lengths,
             stopped=False,
             prefilled_index=0,
             partial_prefilling=0,
+            prefix_len=prefix_len,
+            prompt_ids=prompt_ids,
         )
 
         self.input_ids_dict[new_batch.batch_id] = input_ids
@@ -742,6 +841,9 @@ class PPModelWorker:
 
         self.is_finish.pop(cur_id, None)
         self.partial_output_dict.pop(cur_id, None)
+        prefix_node = self.prefix_nodes.pop(cur_id, None)
+        if prefix_node is not None:
+            self.prefix_cache.release(prefix_node)
 
     async def wait_stream_output(self, cur_id):
         cur_task = self.stream_tasks.pop(cur_id, None)
@@ -873,6 +975,9 @@ class PPModelWorker:
                         next_token = (cur_times[-1] - cur_times[1]) / (len(self.tokens[cur_id]) - 1)
                         logger.info(f"First token latency: {first_token}, "
                                     f"next token latency: {next_token}")
+                        if self.prefix_cache is not None:
+                            hit_rate = self.prefix_cache.stats()["hit_rate"]
+                            logger.info(f"Prefix cache hit rate: {hit_rate:.2%}")
                         await self.wait_stream_output(cur_id)
                         self.clear_batch(cur_id)
                         cur_batch.stopped = True
@@ -0,0 +1,316 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Automatic prefix cache across requests: the kv cache of served prompts is kept in a
+# radix tree over their token ids, so a request sharing a system prompt or a few-shot
+# block with earlier requests copies the kv of the longest cached prefix into its own
+# `DynamicNormalCache` and only prefills the remainder. Each node holds the kv of the
+# tokens on its edge, nodes referenced by running requests are never evicted and the
+# least recently used unreferenced leaves are evicted beyond the memory budget.
+#
+# Usage:
+#   prefix_cache = PrefixCache(max_memory_gb=4)
+#   output = prefix_cache.generate(model, input_ids, max_new_tokens=32)
+# or set IPEX_LLM_PREFIX_CACHE_GB=4 to enable `get_prefix_cache()` in the serving workers.
+
+import heapq
+import os
+import threading
+
+import torch
+
+from ipex_llm.transformers.utils import logger
+from ipex_llm.transformers.session_cache import common_prefix_length
+
+PREFIX_CACHE_GB_ENV = "IPEX_LLM_PREFIX_CACHE_GB"
+
+
+def kv_bytes_per_token(config, dtype=torch.float16):
+    # kv cache size of one token in all layers of the model
+    num_heads = config.num_attention_heads
+    num_kv_heads = getattr(config, "num_key_value_heads", None) or num_heads
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // num_heads
+    element_size = torch.tensor([], dtype=dtype).element_size()
+    return 2 * config.num_hidden_layers * num_kv_heads * head_dim * element_size
+
+
+class _Node:
+    def __init__(self, parent, token_ids, keys, values):
+        self.parent = parent
+        self.children = {}
+        # token ids on the edge from `parent`, and their kv of each layer: [heads, len, dim]
+        self.token_ids = token_ids
+        self.keys = keys
+        self.values = values
+        self.ref_count = 0
+        self.last_access = 0
+
+    @property
+    def nbytes(self):
+        return sum(t.numel() * t.element_size() for t in self.keys + self.values)
+
+    def __lt__(self, other):
+        return self.last_access < other.last_access
+
+
+class PrefixCache:
+    """
+    Radix tree keeping the kv cache of prompts to be reused by later requests.
+
+    :param max_memory_gb: float value, the memory budget of the kept kv cache, the least
+        recently used unreferenced prefixes are evicted beyond it. None means no limit.
+    :param max_tokens: int value, the budget of kept tokens, used instead of the memory
+        budget when every pipeline parallel stage keeps the kv of its own layers, so that
+        all stages evict the same prefixes. None means no limit.
+    """
+
+    def __init__(self, max_memory_gb=None, max_tokens=None):
+        self.max_bytes = int(max_memory_gb * (1024 ** 3)) if max_memory_gb is not None else None
+        self.max_tokens = max_tokens
+        self.root = _Node(None, torch.empty(0, dtype=torch.long), [], [])
+        self.nbytes = 0
+        self.num_tokens = 0
+        self.clock = 0
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.hit_requests = 0
+        self.prompt_tokens = 0
+        self.hit_tokens = 0
+        self.evicted_tokens = 0
+        self.warned = False
+
+    def _touch(self, node):
+        self.clock += 1
+        while node is not self.root:
+            node.last_access = self.clock
+            node = node.parent
+
+    def _walk(self, token_ids, max_length):
+        # the deepest node on the longest cached prefix of `token_ids`, the length of the
+        # prefix, and how many tokens on the edge of that node are matched
+        node, length, matched = self.root, 0, 0
+        while length < max_length:
+            child = node.children.get(token_ids[length].item())
+            if child is None:
+                break
+            matched = common_prefix_length(child.token_ids, token_ids[length:max_length])
+            node = child
+            length += matched
+            if matched < child.token_ids.size(0):
+                break
+        return node, length, matched
+
+    def longest_prefix(self, token_ids: torch.Tensor):
+        """
+        Length of the longest cached prefix of `token_ids`, without referencing it.
+        """
+        token_ids = token_ids.cpu()
+        with self.lock:
+            return self._walk(token_ids, token_ids.size(0))[1]
+
+    def match(self, token_ids: torch.Tensor, max_length=None):
+        """
+        Reference the longest cached prefix of `token_ids`.
+
+        :param token_ids: 1-D token ids of the prompt.
+        :param max_length: the longest prefix to match, defaults to all but the last token,
+            which is left to prefill to compute the logits of the next token.
+
+        :return: the referenced node to `build_cache` from and to `release` after the
+            request, and the length of the matched prefix. A referenced node and all its
+            ancestors are never evicted.
+        """
+        token_ids = token_ids.cpu()
+        if max_length is None:
+            max_length = token_ids.size(0) - 1
+        with self.lock:
+            node, length, _ = self._walk(token_ids, max(max_length, 0))
+            node.ref_count += 1
+            self._touch(node)
+        return node, length
+
+    def release(self, node):
+        with self.lock:
+            node.ref_count -= 1
+
+    def build_cache(self, node, length: int, batch_size: int = 1):
+        """
+        Copy the kv of the first `length` tokens on the path to `node` into a new
+        `DynamicNormalCache` of `batch_size` rows, later tokens are appended to its
+        reserved storage.
+        """
+        from ipex_llm.transformers.kv import DynamicNormalCache
+        # a concurrent `insert` may split a node on the path, so snapshot the kv of the
+        # path under the lock, `_split` replaces the lists instead of changing the tensors
+        path = []
+        with self.lock:
+            while node is not self.root:
+                path.append((node.keys, node.values))
+                node = node.parent
+        path.reverse()
+        past_key_values = DynamicNormalCache()
+        for layer_idx in range(len(path[0][0])):
+            keys = torch.cat([k[layer_idx] for k, _ in path], dim=1)[:, :length]
+            values = torch.cat([v[layer_idx] for _, v in path], dim=1)[:, :length]
+            past_key_values.update(keys.unsqueeze(0).expand(batch_size, -1, -1, -1),
+                                   values.unsqueeze(0).expand(batch_size, -1, -1, -1),
+                                   layer_idx)
+        return past_key_values
+
+    def _split(self, node, length):
+        # cut the edge of `node` after `length` tokens, clone so that both parts own
+        # exactly their memory, references on `node` keep protecting the whole path
+        head = _Node(node.parent, node.token_ids[:length],
+                     [k[:, :length].clone() for k in node.keys],
+                     [v[:, :length].clone() for v in node.values])
+        head.last_access = node.last_access
+        node.token_ids = node.token_ids[length:]
+        node.keys = [k[:, length:].clone() for k in node.keys]
+        node.values = [v[:, length:].clone() for v in node.values]
+        node.parent = head
+        head.children[node.token_ids[0].item()] = node
+        head.parent.children[head.token_ids[0].item()] = head
+        return head
+
+    def _over_budget(self, incoming_bytes, incoming_tokens):
+        return (self.max_bytes is not None and self.nbytes + incoming_bytes > self.max_bytes) \
+            or (self.max_tokens is not None
+                and self.num_tokens + incoming_tokens > self.max_tokens)
+
+    def _evict(self, incoming_bytes, incoming_tokens):
+        leaves = [node for node in self._nodes() if not node.children and node.ref_count == 0]
+        heapq.heapify(leaves)
+        while leaves and self._over_budget(incoming_bytes, incoming_tokens):
+            node = heapq.heappop(leaves)
+            parent = node.parent
+            del parent.children[node.token_ids[0].item()]
+            self.nbytes -= node.nbytes
+            self.num_tokens -= node.token_ids.size(0)
+            self.evicted_tokens += node.token_ids.size(0)
+            if parent is not self.root and not parent.children and parent.ref_count == 0:
+                heapq.heappush(leaves, parent)
+
+    def _nodes(self):
+        stack = list(self.root.children.values())
+        while stack:
+            node = stack.pop()
+            stack.extend(node.children.values())
+            yield node
+
+    def insert(self, token_ids: torch.Tensor, past_key_values, batch_index: int = 0,
+               positions: torch.Tensor = None):
+        """
+        Keep the kv of `token_ids` from row `batch_index` of `past_key_values`.
+
+        :param token_ids: 1-D token ids of the prompt.
+        :param past_key_values: the `DynamicNormalCache` after prefilling the prompt.
+        :param batch_index: the row of the prompt in `past_key_values`.
+        :param positions: the position of each token in the cache, defaults to
+            `0, 1, ..., len(token_ids) - 1`, rows of a padded batch pass their own.
+        """
+        from ipex_llm.transformers.kv import DynamicNormalCache
+        if type(past_key_values) is not DynamicNormalCache:
+            if not self.warned:
+                self.warned = True
+                logger.warning(f"Prefix cache needs DynamicNormalCache, "
+                               f"but got {type(past_key_values).__name__}.")
+            return
+        token_ids = token_ids.cpu()
+        if positions is None:
+            positions = torch.arange(token_ids.size(0))
+        with self.lock:
+            parent, length, matched = self._walk(token_ids, token_ids.size(0))
+            if length == token_ids.size(0):
+                self._touch(parent)
+                return
+            if parent is not self.root and matched < parent.token_ids.size(0):
+                # the prompt diverges in the middle of the edge
+                parent = self._split(parent, matched)
+            self._touch(parent)
+            index = positions[length:].to(past_key_values.key_cache[0].device)
+            node = _Node(parent, token_ids[length:],
+                         [k[batch_index].index_select(1, index)
+                          for k in past_key_values.key_cache],
+                         [v[batch_index].index_select(1, index)
+                          for v in past_key_values.value_cache])
+            nbytes, num_tokens = node.nbytes, node.token_ids.size(0)
+            # the path being extended must not be evicted
+            parent.ref_count += 1
+            self._evict(nbytes, num_tokens)
+            parent.ref_count -= 1
+            if self._over_budget(nbytes, num_tokens):
+                return
+            parent.children[node.token_ids[0].item()] = node
+            node.last_access = self.clock
+            self.nbytes += nbytes
+            self.num_tokens += num_tokens
+
+    def record(self, prompt_length: int, hit_length: int):
+        self.requests += 1
+        self.hit_requests += hit_length > 0
+        self.prompt_tokens += prompt_length
+        self.hit_tokens += hit_length
+
+    def generate(self, model, input_ids: torch.Tensor, **kwargs):
+        """
+        `model.generate` prefilling only the prompt after its longest cached prefix and then
+        keeping the kv of the prompt.
+        """
+        if input_ids.size(0) != 1:
+            return model.generate(input_ids, **kwargs)
+        return_dict_in_generate = kwargs.pop("return_dict_in_generate", False)
+        token_ids = input_ids[0].cpu()
+        node, length = self.match(token_ids)
+        self.record(token_ids.size(0), length)
+        try:
+            if length > 0:
+                kwargs["past_key_values"] = self.build_cache(node, length)
+            outputs = model.generate(input_ids, return_dict_in_generate=True, use_cache=True,
+                                     **kwargs)
+            past_key_values = getattr(outputs, "past_key_values", None)
+            if past_key_values is not None:
+                self.insert(token_ids, past_key_values)
+        finally:
+            self.release(node)
+        return outputs if return_dict_in_generate else outputs.sequences
+
+    def stats(self):
+        return {
+            "cached_tokens": self.num_tokens,
+            "memory_gb": self.nbytes / (1024 ** 3),
+            "requests": self.requests,
+            "hit_requests": self.hit_requests,
+            "prompt_tokens": self.prompt_tokens,
+            "hit_tokens": self.hit_tokens,
+            "hit_rate": self.hit_tokens / self.prompt_tokens if self.prompt_tokens else 0.0,
+            "evicted_tokens": self.evicted_tokens,
+        }
+
+
+_prefix_cache = None
+
+
+def get_prefix_cache():
+    """
+    Return the process wide `PrefixCache` configured by `IPEX_LLM_PREFIX_CACHE_GB`,
+    or None if it is not enabled.
+    """
+    global _prefix_cache
+    if _prefix_cache is None:
+        max_memory_gb = float(os.environ.get(PREFIX_CACHE_GB_ENV, "0"))
+        if max_memory_gb > 0:
+            _prefix_cache = PrefixCache(max_memory_gb)
+    return _prefix_cache
@@ -50,8 +50,12 @@
 
 import torch
 import logging
+import threading
+from contextlib import contextmanager
 from torch.nn import Linear, Embedding, Module
-from ipex_llm.transformers.low_bit_linear import LowBitLinear, BF16Linear, get_qk_size
+import torch.nn.functional as F
+from ipex_llm.transformers.low_bit_linear import LowBitLinear, BF16Linear, get_qk_size, \
+    MatMulLowBitCPU, DEQUANT_UNSUPPORTED_QTYPES
 from peft.tuners.lora import LoraLayer
 from typing import Any, Optional, Union
 from ipex_llm.utils.common import invalidInputError
@@ -63,6 +67,33 @@ from ipex_llm.transformers import training_patch
 LOG = logging.getLogger("ipex_llm.qlora")
 
 
+class LoraAdapterContext(threading.local):
+    """
+    Adapter of each row of the batch in the current forward, read by every
+    `LoraLowBitLinear` when `adapter_names` is not passed to it, e.g. through `generate`.
+    """
+
+    def __init__(self):
+        self.adapter_names = None
+
+
+lora_adapter_context = LoraAdapterContext()
+
+
+@contextmanager
+def lora_adapters(adapter_names):
+    """
+    Compute row `i` of the batch with LoRA adapter `adapter_names[i]`, or with the base
+    model only if that adapter is not loaded in a layer.
+    """
+    previous = lora_adapter_context.adapter_names
+    lora_adapter_context.adapter_names = adapter_names
+    try:
+        yield
+    finally:
+        lora_adapter_context.adapter_names = previous
+
+
 class LoraLowBitLinear(Module, LoraLayer):
     # Lora implemented in a dense layer
     def __init__(
@@ -107,18 +138,109 @@ class LoraLowBitLinear(Module, LoraLayer):
             self.qa_pool = torch.nn.AvgPool1d(qk_size)
         else:
             self.qa_pool = torch.nn.Identity()
+        # (key, lora_A, lora_B) of the last stacked adapters, reused until they change
+        self.lora_weights_cache = None
+
+    def base_forward(self, x: torch.Tensor):
+        base_layer = self.base_layer
+        if x.device.type == "cpu" and self.training and torch.is_grad_enabled() \
+                and base_layer.qtype not in DEQUANT_UNSUPPORTED_QTYPES:
+            # dequantize the frozen weight tile by tile even if `x` does not require grad,
+            # instead of keeping a dense copy of it
+            result = MatMulLowBitCPU.apply(x, base_layer.weight)
+            if base_layer.bias is not None:
+                result += base_layer.bias
+            return result.to(x.dtype)
+        return base_layer.forward(x)
+
+    def lora_weights(self, adapter_names, stacked=False):
+        """
+        Return the LoRA weights of `adapter_names` with their scaling folded into B.
+        Concatenated along the rank, `[sum_r, in]` A and `[out, sum_r]` B compute the sum
+        of all adapters. Stacked and zero padded to the max rank, `[n + 1, r, in]` A and
+        `[n + 1, out, r]` B are gathered by adapter index, index n is a zero adapter.
+        """
+        key = tuple((name, self.lora_A[name].weight.data_ptr(),
+                     self.lora_A[name].weight._version,
+                     self.lora_B[name].weight.data_ptr(),
+                     self.lora_B[name].weight._version,
+                     self.scaling[name]) for name in adapter_names) + (stacked,)
+        # weights with grad are stacked again in every forward for autograd
+        cacheable = not torch.is_grad_enabled()
+        cache = self.lora_weights_cache
+        if cacheable and cache is not None and cache[0] == key:
+            return cache[1:]
+        weights_A = [self.lora_A[name].weight for name in adapter_names]
+        weights_B = [self.lora_B[name].weight * self.scaling[name] for name in adapter_names]
+        if stacked:
+            rank = max(weight.size(0) for weight in weights_A)
+            lora_A = weights_A[0].new_zeros(len(weights_A) + 1, rank, weights_A[0].size(1))
+            lora_B = weights_B[0].new_zeros(len(weights_B) + 1, weights_B[0].size(0), rank)
+            for i, (weight_A, weight_B) in enumerate(zip(weights_A, weights_B)):
+                lora_A[i, :weight_A.size(0)] = weight_A
+                lora_B[i, :, :weight_B.size(1)] = weight_B
+        else:
+            lora_A = torch.cat(weights_A, dim=0)
+            lora_B = torch.cat(weights_B, dim=1)
+        if cacheable:
+            self.lora_weights_cache = (key, lora_A, lora_B)
+        return lora_A, lora_B
+
+    def can_fuse_adapters(self):
+        # dropout is applied to the input of each adapter separately
+        return not self.training or all(
+            isinstance(self.lora_dropout[name], torch.nn.Identity)
+            for name in self.active_adapters if name in self.lora_A.keys()
+        )
 
-    def forward(self, x: torch.Tensor):
+    def fused_lora_forward(self, x: torch.Tensor, result: torch.Tensor, adapter_names=None):
+        x = self.qa_pool(x)
+        if adapter_names is None:
+            # all active adapters on all rows, in one matmul pair
+            names = [name for name in self.active_adapters if name in self.lora_A.keys()]
+            if len(names) == 0:
+                return result
+            lora_A, lora_B = self.lora_weights(names)
+            x = x.to(lora_A.dtype)
+            result += F.linear(F.linear(x, lora_A), lora_B).to(result.dtype)
+            return result
+
+        # SGMV-style: gather the adapter of each row, then one batched matmul pair
+        invalidInputError(len(adapter_names) == x.size(0),
+                          f"Got {len(adapter_names)} adapter names for {x.size(0)} rows.")
+        # only the adapters of this batch, others may be loaded or deleted meanwhile
+        names = [name for name in dict.fromkeys(adapter_names) if name in self.lora_A.keys()]
+        if len(names) == 0:
+            return result
+        indices = [names.index(name) if name in names else len(names)
+                   for name in adapter_names]
+        lora_A, lora_B = self.lora_weights(names, stacked=True)
+        index = torch.tensor(indices, device=lora_A.device)
+        x_3d = x.reshape(x.size(0), -1, x.size(-1)).to(lora_A.dtype)
+        hidden = torch.bmm(x_3d, lora_A[index].transpose(1, 2))
+        delta = torch.bmm(hidden, lora_B[index].transpose(1, 2))
+        result += delta.view(result.shape).to(result.dtype)
+        return result
+
+    def forward(self, x: torch.Tensor, *args, adapter_names=None, **kwargs):
         autocast_dtype = get_autocast_dtype(x.device.type)
         if x.device.type == "xpu":
             # force to use bf16 on gpu
             x = x.to(torch.bfloat16)
         elif autocast_dtype is not None:
             x = x.to(autocast_dtype)
-        result = self.base_layer.forward(x)
+        result = self.base_forward(x)
 
+        if adapter_names is None:
+            adapter_names = lora_adapter_context.adapter_names
         if self.disable_adapters or self.merged:
             return result
+        elif adapter_names is not None:
+            invalidInputError(self.can_fuse_adapters(),
+                              "Per-row adapters are not supported in training with dropout.")
+            return self.fused_lora_forward(x, result, adapter_names)
+        elif self.can_fuse_adapters():
+            return self.fused_lora_forward(x, result)
         else:
             if autocast_dtype is None and x.device.type == "cpu":
                 expected_dtype = result.dtype
@@ -369,6 +491,18 @@ class PeftModel:
         return model
 
 
+@contextmanager
+def patch_create_new_module():
+    # create ipex-llm LoRA layers when peft injects adapters, e.g. in `load_adapter`
+    old_create_new_module = LoraModel._create_new_module
+    LoraModel._create_new_module = staticmethod(functools.partial(_create_new_module,
+                                                                  old_create_new_module))
+    try:
+        yield
+    finally:
+        LoraModel._create_new_module = old_create_new_module
+
+
 from peft.mapping import PEFT_TYPE_TO_CONFIG_MAPPING
 
 PEFT_TYPE_TO_CONFIG_MAPPING["lora"] = LoraConfig
@@ -38,6 +38,8 @@ import json
 import logging
 import os.path
 import shutil
+import struct
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, List, Sequence
 import peft
@@ -380,6 +382,140 @@ def update_weights(
         target._parameters['weight'] = new_low_bit_params
 
 
+# element size of the dtypes in safetensors headers
+SAFETENSORS_DTYPE_SIZES = {
+    "F64": 8, "F32": 4, "F16": 2, "BF16": 2, "F8_E4M3": 1, "F8_E5M2": 1,
+    "I64": 8, "I32": 4, "I16": 2, "I8": 1, "U8": 1, "BOOL": 1,
+}
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8,
+    "U8": torch.uint8, "BOOL": torch.bool,
+}
+if hasattr(torch, "float8_e4m3fn"):
+    SAFETENSORS_DTYPES.update({"F8_E4M3": torch.float8_e4m3fn, "F8_E5M2": torch.float8_e5m2})
+COPY_CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def read_safetensors_header(path: str):
+    with open(path, "rb") as file:
+        header_size = struct.unpack("<Q", file.read(8))[0]
+        header = json.loads(file.read(header_size))
+    return header, 8 + header_size
+
+
+def load_torch_shard(path: str):
+    try:
+        # tensors are read from the page cache when they are used
+        state_dict = torch.load(path, map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError):
+        # torch < 2.1 or a checkpoint not saved in the zip format
+        state_dict = torch.load(path, map_location="cpu")
+    if "state_dict" in state_dict:
+        state_dict = state_dict["state_dict"]
+    return state_dict
+
+
+def write_tensor(file, tensor: torch.Tensor):
+    file.write(tensor.contiguous().reshape(-1).view(torch.uint8).numpy())
+
+
+def merge_shard(
+    shard_path: str,
+    model_src: str,
+    model_dst: str,
+    targets: Dict[str, peft.tuners.lora.LoraLayer],
+    reinit: bool,
+    cpu_offload: bool,
+    actually_save: bool,
+):
+    """
+    Merge the LoRA deltas of `targets` into the weights of one input shard and write the
+    output shard tensor by tensor, other tensors are copied without conversion.
+
+    :return: the name of the output shard and the names of its tensors.
+    """
+    src = str(Path(model_src) / shard_path)
+    LOG.info(f"load from {model_src}, {shard_path}")
+    if shard_path.endswith(".safetensors"):
+        header, data_start = read_safetensors_header(src)
+        header.pop("__metadata__", None)
+        # in file order, so that the input is read sequentially
+        entries = sorted(header.items(), key=lambda item: item[1]["data_offsets"][0])
+        specs = [(name, info["dtype"], info["shape"]) for name, info in entries]
+        in_file = st.safe_open(src, framework="pt", device="cpu")
+        load_tensor = in_file.get_tensor
+    else:
+        header, data_start = None, 0
+        state_dict = load_torch_shard(src)
+        dtype_names = {dtype: name for name, dtype in SAFETENSORS_DTYPES.items()}
+        specs = [(name, dtype_names[tensor.dtype], list(tensor.shape))
+                 for name, tensor in state_dict.items()]
+        load_tensor = state_dict.__getitem__
+
+    def merge(key):
+        target = targets[key]
+        orig_weight = load_tensor(key)
+        old_dev = target.weight.data.device
+        math_dev = "cpu" if cpu_offload else old_dev
+
+        delta_weight = lora_delta_weight(target, math_dev).float()
+        new_weight = orig_weight.to(math_dev).float() + delta_weight
+        del delta_weight
+        update_weights(target, new_weight, reinit=reinit, device=old_dev)
+        return new_weight.to(orig_weight.dtype).cpu()
+
+    if not actually_save:
+        for key in targets:
+            merge(key)
+        return None, []
+
+    out_shard_name = shard_path
+    if out_shard_name.startswith("pytorch_model"):
+        out_shard_name = (
+            out_shard_name.replace("pytorch_model", "model").rstrip(".bin")
+            + ".safetensors"
+        )
+    # merged weights keep their dtype, so the whole header is known before merging
+    out_header, offset = {}, 0
+    for name, dtype, shape in specs:
+        nbytes = SAFETENSORS_DTYPE_SIZES[dtype]
+        for dim in shape:
+            nbytes *= dim
+        out_header[name] = {"dtype": dtype, "shape": shape,
+                            "data_offsets": [offset, offset + nbytes]}
+        offset += nbytes
+    out_header["__metadata__"] = {"format": "pt"}
+    header_bytes = json.dumps(out_header, separators=(",", ":")).encode("utf-8")
+    header_bytes += b" " * (-len(header_bytes) % 8)
+
+    shard_fn = str(Path(model_dst) / out_shard_name)
+    LOG.info(f"saving tensors to {shard_fn}")
+    with open(shard_fn, "wb") as out_file:
+        out_file.write(struct.pack("<Q", len(header_bytes)))
+        out_file.write(header_bytes)
+        in_raw = open(src, "rb") if header is not None else None
+        try:
+            for name, _, _ in specs:
+                if name in targets:
+                    write_tensor(out_file, merge(name))
+                elif in_raw is not None:
+                    # untouched tensors are copied byte by byte
+                    begin, end = header[name]["data_offsets"]
+                    in_raw.seek(data_start + begin)
+                    remaining = end - begin
+                    while remaining > 0:
+                        chunk = in_raw.read(min(remaining, COPY_CHUNK_BYTES))
+                        out_file.write(chunk)
+                        remaining -= len(chunk)
+                else:
+                    write_tensor(out_file, load_tensor(name))
+        finally:
+            if in_raw is not None:
+                in_raw.close()
+    return out_shard_name, [name for name, _, _ in specs]
+
+
 def merge_and_save(
     model: peft.LoraModel,
     model_src: str,
@@ -387,6 +523,7 @@ def merge_and_save(
     reinit: bool = False,
     cpu_offload: bool = False,
     actually_save: bool = True,
+    max_workers: int = 4,
 ):
     modules = find_lora_modules(model)
 
@@ -394,55 +531,26 @@ def merge_and_save(
     shard_paths = sharded_paths(model_src, modules.keys())
     out_shard_paths = {}
 
-    unique_shards = list(set(shard_paths.values()))
-    for shard_path in unique_shards:
-        out_tensors = {}
-        if shard_path.endswith(".safetensors"):
-            in_tensors = st.load_file(str(Path(model_src) / shard_path))
-        else:
-            in_tensors = torch.load(Path(model_src) / shard_path)
-            if "state_dict" in in_tensors:
-                in_tensors = in_tensors["state_dict"]
-
-        LOG.info(f"load from {model_src}, {shard_path}")
-
-        for module_name, target in modules.items():
-            key = module_name + ".weight"
-            if key not in shard_paths or shard_paths[key] != shard_path:
-                continue
+    unique_shards = sorted(set(shard_paths.values()))
+    shard_targets = {shard_path: {} for shard_path in unique_shards}
+    for module_name, target in modules.items():
+        key = module_name + ".weight"
+        if key in shard_paths:
+            shard_targets[shard_paths[key]][key] = target
 
-            orig_weight = in_tensors[key].float()
-            old_dev = target.weight.data.device
-            math_dev = "cpu" if cpu_offload else old_dev
-
-            delta_weight = lora_delta_weight(target, math_dev).float()
-            new_weight = orig_weight.to(math_dev) + delta_weight
-            del delta_weight
-
-            if actually_save:
-                out_tensors[key] = new_weight.half().cpu()
-
-            update_weights(target, new_weight, reinit=reinit, device=old_dev)
-
-        if actually_save:
-            out_shard_name = shard_path
-            if out_shard_name.startswith("pytorch_model"):
-                out_shard_name = (
-                    out_shard_name.replace("pytorch_model", "model").rstrip(".bin")
-                    + ".safetensors"
-                )
-
-            for module_name in in_tensors:
-                if module_name not in out_tensors:
-                    out_tensors[module_name] = in_tensors[module_name].half()
-                out_shard_paths[module_name] = out_shard_name
-
-            shard_fn = str(Path(model_dst) / out_shard_name)
-            LOG.info(f"saving tensors to {shard_fn}")
-            st.save_file(out_tensors, shard_fn, metadata={"format": "pt"})
-
-        del in_tensors
-        del out_tensors
+    def merge_one(shard_path):
+        # no_grad of the caller does not apply to the worker threads
+        with torch.no_grad():
+            return merge_shard(shard_path, model_src, model_dst, shard_targets[shard_path],
+                               reinit, cpu_offload, actually_save)
+
+    # shards are independent, the merge math and IO of different shards overlap
+    max_workers = max(1, min(max_workers, len(unique_shards)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for out_shard_name, names in executor.map(merge_one, unique_shards):
+            for name in names:
+                out_shard_paths[name] = out_shard_name
+    if torch.xpu.is_available():
         torch.xpu.empty_cache()
 
     if actually_save and len(unique_shards) > 1:
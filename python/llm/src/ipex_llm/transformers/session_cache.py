@@ -0,0 +1,228 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Cross-turn kv cache of chat sessions: a multi-turn chat re-sends the whole history
+# every turn, so the kv cache of the previous turn (its prompt and response) is kept
+# and only the new suffix is prefilled. A session is found by its session id, or else
+# by the longest common prefix with the kept conversations, which are keyed by the hash
+# of their tokens. If the history of a session is edited, its cache is cropped to the
+# longest common prefix.
+#
+# Usage:
+#   session_cache = SessionKVCache(max_memory_gb=4)
+#   output = session_cache.generate(model, input_ids, session_id="abc", max_new_tokens=32)
+# or set IPEX_LLM_SESSION_CACHE_GB=4 to enable `get_session_cache()` in the serving workers.
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+
+from ipex_llm.utils.common import invalidInputError
+from ipex_llm.transformers.utils import logger
+
+SESSION_CACHE_GB_ENV = "IPEX_LLM_SESSION_CACHE_GB"
+SESSION_IDLE_TIMEOUT_ENV = "IPEX_LLM_SESSION_IDLE_TIMEOUT"
+
+
+def cache_nbytes(past_key_values):
+    return sum(cache.untyped_storage().nbytes()
+               for cache in past_key_values.key_cache + past_key_values.value_cache)
+
+
+def crop_cache(past_key_values, length: int):
+    # the cropped views keep the reserved storage, later tokens are appended in place
+    for i in range(len(past_key_values.key_cache)):
+        past_key_values.key_cache[i] = past_key_values.key_cache[i][:, :, :length]
+        past_key_values.value_cache[i] = past_key_values.value_cache[i][:, :, :length]
+    if hasattr(past_key_values, "_seen_tokens"):
+        past_key_values._seen_tokens = length
+    elif hasattr(past_key_values, "seen_tokens"):
+        past_key_values.seen_tokens = length
+
+
+def common_prefix_length(a: torch.Tensor, b: torch.Tensor) -> int:
+    length = min(a.size(0), b.size(0))
+    mismatch = (a[:length] != b[:length]).nonzero()
+    return mismatch[0].item() if mismatch.size(0) > 0 else length
+
+
+class _Session:
+    def __init__(self, token_ids, past_key_values):
+        self.token_ids = token_ids
+        self.past_key_values = past_key_values
+        self.nbytes = cache_nbytes(past_key_values)
+        self.last_used = time.monotonic()
+
+
+class SessionKVCache:
+    """
+    Keep the `DynamicNormalCache` and the token ids of chat sessions between turns.
+
+    :param max_memory_gb: float value, the memory budget of the kept kv caches, the least
+        recently used sessions are evicted beyond it. None means no limit.
+    :param idle_timeout: float value, seconds after which an unused session is evicted.
+    :param match_tolerance: int value, a request without session id continues a kept
+        conversation if they differ only in its last `match_tolerance` tokens, which
+        happens when the response is tokenized differently as a part of the new prompt.
+    """
+
+    def __init__(self, max_memory_gb=None, idle_timeout=600, match_tolerance=8):
+        self.max_bytes = int(max_memory_gb * (1024 ** 3)) if max_memory_gb is not None else None
+        self.idle_timeout = idle_timeout
+        self.match_tolerance = match_tolerance
+        self.sessions = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self.warned = False
+
+    def _remove(self, key):
+        session = self.sessions.pop(key)
+        self.nbytes -= session.nbytes
+        return session
+
+    def evict(self):
+        with self.lock:
+            self._evict(0)
+
+    def _evict(self, incoming_bytes):
+        now = time.monotonic()
+        for key in [key for key, session in self.sessions.items()
+                    if now - session.last_used > self.idle_timeout]:
+            self._remove(key)
+        if self.max_bytes is not None:
+            while self.sessions and self.nbytes + incoming_bytes > self.max_bytes:
+                self._remove(next(iter(self.sessions)))
+
+    def _match(self, token_ids):
+        # the kept conversation which `token_ids` continues, by the longest common prefix
+        best_key, best_length = None, 0
+        for key, session in self.sessions.items():
+            if not key.startswith("prefix:"):
+                continue
+            length = common_prefix_length(session.token_ids, token_ids)
+            if length >= session.token_ids.size(0) - self.match_tolerance \
+                    and length > best_length:
+                best_key, best_length = key, length
+        return best_key
+
+    def acquire(self, input_ids: torch.Tensor, session_id=None):
+        """
+        Take the kept kv cache of the session of `input_ids` out of the store.
+
+        :param input_ids: `[1, seq_len]` token ids of the whole conversation.
+        :param session_id: optional session id of the conversation.
+
+        :return: the session key to `release` the cache with after generation, and the kv
+            cache cropped to the tokens shared with `input_ids`, or None if nothing is reused.
+        """
+        invalidInputError(input_ids.size(0) == 1, "Session kv cache only supports batch size 1.")
+        token_ids = input_ids[0].cpu()
+        key = "id:" + str(session_id) if session_id is not None else None
+        with self.lock:
+            self._evict(0)
+            match_key = key if key is not None else self._match(token_ids)
+            session = self._remove(match_key) if match_key in self.sessions else None
+        if session is None:
+            self.misses += 1
+            return key, None
+        # leave at least one token to prefill, which computes the logits of the next token
+        length = common_prefix_length(session.token_ids, token_ids)
+        length = min(length, token_ids.size(0) - 1)
+        if length == 0:
+            self.misses += 1
+            return key, None
+        if length < session.token_ids.size(0):
+            # history edited or the last response tokenized differently
+            crop_cache(session.past_key_values, length)
+        self.hits += 1
+        self.reused_tokens += length
+        return key, session.past_key_values
+
+    def release(self, key, token_ids: torch.Tensor, past_key_values):
+        """
+        Keep `past_key_values` of `token_ids` as the cache of session `key`, or of the
+        conversation itself if `key` is None.
+        """
+        from ipex_llm.transformers.kv import DynamicNormalCache
+        if not isinstance(past_key_values, DynamicNormalCache):
+            return
+        token_ids = token_ids.cpu()
+        if key is None:
+            key = "prefix:" + hashlib.sha1(token_ids.numpy().tobytes()).hexdigest()
+        session = _Session(token_ids, past_key_values)
+        if self.max_bytes is not None and session.nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.sessions:
+                self._remove(key)
+            self._evict(session.nbytes)
+            self.sessions[key] = session
+            self.nbytes += session.nbytes
+
+    def generate(self, model, input_ids: torch.Tensor, session_id=None, **kwargs):
+        """
+        `model.generate` reusing and then keeping the kv cache of the session.
+        """
+        from ipex_llm.transformers.kv import DynamicNormalCache
+        return_dict_in_generate = kwargs.pop("return_dict_in_generate", False)
+        key, past_key_values = self.acquire(input_ids, session_id)
+        if past_key_values is not None:
+            kwargs["past_key_values"] = past_key_values
+        outputs = model.generate(input_ids, return_dict_in_generate=True, use_cache=True,
+                                 **kwargs)
+        past_key_values = getattr(outputs, "past_key_values", None)
+        if isinstance(past_key_values, DynamicNormalCache):
+            # the kv of the last generated token is not computed yet
+            length = past_key_values.get_seq_length()
+            self.release(key, outputs.sequences[0, :length], past_key_values)
+        elif not self.warned:
+            self.warned = True
+            logger.warning(f"Session kv cache needs the DynamicNormalCache returned by "
+                           f"generate, but got {type(past_key_values).__name__}.")
+        return outputs if return_dict_in_generate else outputs.sequences
+
+    def stats(self):
+        return {
+            "sessions": len(self.sessions),
+            "memory_gb": self.nbytes / (1024 ** 3),
+            "hits": self.hits,
+            "misses": self.misses,
+            "reused_tokens": self.reused_tokens,
+        }
+
+
+_session_cache = None
+
+
+def get_session_cache():
+    """
+    Return the process wide `SessionKVCache` configured by `IPEX_LLM_SESSION_CACHE_GB`
+    and `IPEX_LLM_SESSION_IDLE_TIMEOUT`, or None if it is not enabled.
+    """
+    global _session_cache
+    if _session_cache is None:
+        max_memory_gb = float(os.environ.get(SESSION_CACHE_GB_ENV, "0"))
+        if max_memory_gb > 0:
+            idle_timeout = float(os.environ.get(SESSION_IDLE_TIMEOUT_ENV, "600"))
+            _session_cache = SessionKVCache(max_memory_gb, idle_timeout)
+    return _session_cache
@@ -177,6 +177,65 @@ def multinomial_sample_one_no_sync(probs_sort):
     return torch.argmax(probs_sort / q, dim=-1, keepdim=True).to(dtype=torch.int64)
 
 
+def speculative_sample(target_probs, draft_tokens, draft_probs=None, draft_lens=None):
+    """
+    Lossless speculative sampling: accept each draft token x with probability
+    min(1, q(x) / p(x)), and sample the token after the first rejection from the residual
+    distribution norm(max(q - p, 0)), so that the output follows the target distribution q
+    no matter what the draft distribution p is.
+
+    :param target_probs: target probabilities of shape [batch, k + 1, vocab].
+    :param draft_tokens: draft tokens of shape [batch, k].
+    :param draft_probs: draft probabilities of shape [batch, k, vocab], None means the drafts
+        are deterministic (e.g. prompt lookup), i.e. p is one-hot on the draft token.
+    :param draft_lens: number of valid drafts of each row of shape [batch], for drafts
+        padded to the same length. Default to be None, which means all k drafts are valid.
+
+    :return: output ids of shape [batch, k + 1] and number of accepted drafts of shape [batch],
+        for each row only the first n_matches + 1 output ids are valid.
+    """
+    batch_size, k = draft_tokens.shape
+    device = target_probs.device
+    draft_tokens = draft_tokens.to(device)
+    positions = torch.arange(k, device=device).unsqueeze(0)
+
+    q = torch.gather(target_probs[:, :k], -1, draft_tokens.unsqueeze(-1)).squeeze(-1)
+    if draft_probs is None:
+        p = torch.ones_like(q)
+    else:
+        p = torch.gather(draft_probs, -1, draft_tokens.unsqueeze(-1)).squeeze(-1)
+    # u < q / p, written without division for p == 0
+    accepted = torch.rand(q.shape, device=device, dtype=q.dtype) * p < q
+    if draft_lens is not None:
+        accepted &= positions < draft_lens.to(device).unsqueeze(1)
+    n_matches = accepted.long().cumprod(-1).sum(-1)
+
+    # distribution of the token after accepted drafts, residual if a valid draft is rejected
+    rows = torch.arange(batch_size, device=device)
+    next_probs = target_probs[rows, n_matches]
+    rejected = n_matches < (k if draft_lens is None else draft_lens.to(device))
+    if rejected.any():
+        padded_tokens = torch.cat((draft_tokens, draft_tokens[:, :1]), dim=-1)
+        rejected_tokens = padded_tokens[rows, n_matches]
+        if draft_probs is None:
+            rejected_probs = torch.zeros_like(next_probs)
+            rejected_probs[rows, rejected_tokens] = 1.0
+        else:
+            padded_probs = torch.cat((draft_probs, draft_probs[:, :1]), dim=1)
+            rejected_probs = padded_probs[rows, n_matches]
+        residual = torch.clamp(next_probs - rejected_probs, min=0)
+        residual_sum = residual.sum(-1, keepdim=True)
+        # q <= p everywhere only happens with rounding errors, fall back to q
+        residual = torch.where(residual_sum > 0, residual / residual_sum.clamp(min=1e-20),
+                               next_probs)
+        next_probs = torch.where(rejected.unsqueeze(-1), residual, next_probs)
+    next_tokens = multinomial_sample_one_no_sync(next_probs).squeeze(-1)
+
+    output_ids = torch.cat((draft_tokens, next_tokens.unsqueeze(-1)), dim=-1)
+    output_ids[rows, n_matches] = next_tokens
+    return output_ids, n_matches
+
+
 def clear_benchmarks(self):
     self.first_token_time = 0
     self.generate_time = []
@@ -855,6 +914,9 @@ def speculative_generate(self,
             query_group_size = draft_model.config.num_attention_heads // \
                 draft_model.config.multi_query_group_num
 
+    from ipex_llm.transformers.logits_process import VerifyLogitsProcessor
+    verify_processor = VerifyLogitsProcessor(logits_processor)
+
     tmp_matchness = 0
     e2e_tic = 0.0
 
@@ -1138,11 +1200,8 @@ def speculative_generate(self,
             if isinstance(output, dict):
                 logits = output['logits']
                 past_key_values = output['past_key_values']
-            temp_input_ids = torch.cat((input_ids, generate_ids[:, :step],
-                                        draft_generate_ids[:, 1:step_draft + 2]), dim=-1)
-            for i in range(logits.size(1)):
-                logits[:, i, :] = logits_processor(temp_input_ids[:, :input_ids.size(1)+step+i],
-                                                   logits[:, i, :])
+            logits = verify_processor(torch.cat((input_ids, generate_ids[:, :step]), dim=-1),
+                                      logits, draft_generate_ids[:, 1:step_draft + 2])
             if generation_config.do_sample:
                 target_probs = logits_to_probs(logits,
                                                top_k=generation_config.top_k,
@@ -1162,32 +1221,12 @@ def speculative_generate(self,
                 past_key_values = output['past_key_values']
 
             if generation_config.do_sample:
-                draft_tokens = drafted_input_ids[:, 1:].squeeze(0)
-                draft_probs = torch.stack(draft_prob_list).squeeze((1, 2))
-
-                # q: target prob, p: draft prob
-                # q >= p: always accept draft token
-                # q < p: q/p prob to accept draft token
-                p = draft_probs[torch.arange(0, drafted_n_tokens), draft_tokens]
-                q = target_probs[torch.arange(0, drafted_n_tokens), draft_tokens]
-                accept_draft_prob = torch.minimum(torch.ones(()), q[:drafted_n_tokens] / p)
-                rejected_locations = (random_probs[:drafted_n_tokens] > accept_draft_prob).nonzero()
-
-                if rejected_locations.shape[0] == 0:    # All draft tokens have been accepted
-                    max_matched = drafted_n_tokens + 1
-                    last_token = multinomial_sample_one_no_sync(target_probs[-1])
-                    output_ids = torch.cat([draft_tokens, last_token])
-                else:
-                    max_matched = rejected_locations[0].item()
-                    p = draft_probs[max_matched]
-                    q = target_probs[max_matched]
-                    resample_prob = q - p
-                    resample_prob = torch.where(resample_prob > 0, resample_prob, 0.0)
-                    resample_prob = resample_prob / resample_prob.sum()
-                    next_token = multinomial_sample_one_no_sync(resample_prob)
-                    output_ids = torch.cat([draft_tokens[:max_matched], next_token])
-                    max_matched += 1
-                output_ids = output_ids.unsqueeze(0)
+                draft_probs = torch.stack(draft_prob_list, dim=1)
+                output_ids, n_matches = speculative_sample(
+                    target_probs.view(1, drafted_n_tokens + 1, -1),
+                    drafted_input_ids[:, 1:],
+                    draft_probs.view(1, drafted_n_tokens, -1))
+                max_matched = n_matches.item() + 1
             else:
                 # Compare drafts with target verified outputs
                 # Drafts start from [1, k]
@@ -1214,6 +1253,7 @@ def speculative_generate(self,
                                                     _enable_ipex)
 
             generate_ids[:, step:step+output_ids.size(1)] = output_ids
+            verify_processor.update(output_ids)
             current_input_ids = output_ids[:, -1:]
             if streamer is not None:
                 streamer.put(output_ids.cpu())
@@ -0,0 +1,292 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Load a full precision safetensors checkpoint into a low-bit model one decoder layer at
+# a time, so that the peak extra memory during conversion is about one decoder layer
+# instead of the whole full precision model.
+#
+# The model is first built on the meta device as a template. For every group of weights
+# (each decoder layer, then all non-decoder-layer weights), only the weights of this group
+# are read from the checkpoint into the template, and a shell of the template holding only
+# this group goes through `ggml_convert_low_bit`, so that `_optimize_pre` (qkv merging,
+# padding, ...) and the low-bit replacement behave exactly as in a normal load while only
+# visiting this group. The converted modules are put back into the template, and
+# `_optimize_post` runs once on the assembled model.
+
+import copy
+import gc
+import json
+
+import torch
+from accelerate import init_empty_weights
+from accelerate.utils import set_module_tensor_to_device
+
+from ipex_llm.utils.common import invalidInputError
+from ipex_llm.transformers.utils import logger
+
+SAFE_WEIGHTS_NAME = "model.safetensors"
+# `_optimize_pre` of these models inspects modules outside the decoder layers, or all
+# decoder layers at once, so it cannot run on a shell holding one group of weights
+UNSUPPORTED_MODEL_TYPES = ["rwkv", "minicpmv", "minicpmo", "megrezo"]
+SAFE_WEIGHTS_INDEX_NAME = "model.safetensors.index.json"
+
+
+def check_layerwise_load_support(config):
+    model_type = getattr(config, "model_type", None)
+    invalidInputError(model_type not in UNSUPPORTED_MODEL_TYPES
+                      and not (model_type == "chatglm" and hasattr(config, "vision_config")),
+                      f"`layerwise_load` does not support {model_type} models yet, "
+                      f"please load them without `layerwise_load`.")
+
+
+def get_safetensors_weight_map(pretrained_model_name_or_path, subfolder=""):
+    """
+    Return a dict from checkpoint key to the local safetensors file containing it.
+    """
+    from transformers.utils import cached_file
+
+    index_file = cached_file(pretrained_model_name_or_path, SAFE_WEIGHTS_INDEX_NAME,
+                             subfolder=subfolder,
+                             _raise_exceptions_for_missing_entries=False)
+    if index_file is not None:
+        with open(index_file, "r") as f:
+            index = json.load(f)
+        shard_files = {}
+        for shard in sorted(set(index["weight_map"].values())):
+            shard_files[shard] = cached_file(pretrained_model_name_or_path, shard,
+                                             subfolder=subfolder)
+        return {key: shard_files[shard] for key, shard in index["weight_map"].items()}
+
+    weight_file = cached_file(pretrained_model_name_or_path, SAFE_WEIGHTS_NAME,
+                              subfolder=subfolder,
+                              _raise_exceptions_for_missing_entries=False)
+    invalidInputError(weight_file is not None,
+                      f"`layerwise_load` requires safetensors weights, but neither "
+                      f"{SAFE_WEIGHTS_NAME} nor {SAFE_WEIGHTS_INDEX_NAME} is found in "
+                      f"{pretrained_model_name_or_path}.")
+    from safetensors import safe_open
+    with safe_open(weight_file, framework="pt") as f:
+        return {key: weight_file for key in f.keys()}
+
+
+def get_decoder_layer_names(model):
+    """
+    Return the names of decoder layers, found by `_no_split_modules`, or the children of
+    the largest `nn.ModuleList` if the model does not declare it.
+    """
+    no_split_modules = set(getattr(model, "_no_split_modules", None) or [])
+    names = [name for name, module in model.named_modules()
+             if name and type(module).__name__ in no_split_modules]
+    if names:
+        # keep the outermost ones only, e.g. not the vision layers inside a decoder layer
+        return [name for name in names
+                if not any(name.startswith(other + ".") for other in names)]
+    module_lists = [(name, module) for name, module in model.named_modules()
+                    if isinstance(module, torch.nn.ModuleList)]
+    invalidInputError(len(module_lists) > 0,
+                      f"Cannot find the decoder layers of {type(model).__name__}.")
+    name, module_list = max(module_lists, key=lambda item: len(item[1]))
+    return [f"{name}.{idx}" for idx in range(len(module_list))]
+
+
+def _match_key(key, model_keys, base_model_prefix):
+    # checkpoints of a base model (e.g. `LlamaModel`) may be loaded into
+    # a model with head (e.g. `LlamaForCausalLM`) and vice versa
+    if key in model_keys:
+        return key
+    if base_model_prefix:
+        prefixed = f"{base_model_prefix}.{key}"
+        if prefixed in model_keys:
+            return prefixed
+        if key.startswith(base_model_prefix + "."):
+            stripped = key[len(base_model_prefix) + 1:]
+            if stripped in model_keys:
+                return stripped
+    return None
+
+
+def _load_weights(model, keys, weight_map, key_mapping, torch_dtype):
+    from safetensors import safe_open
+
+    keys_per_file = {}
+    for key in keys:
+        keys_per_file.setdefault(weight_map[key], []).append(key)
+    for weight_file, file_keys in keys_per_file.items():
+        with safe_open(weight_file, framework="pt") as f:
+            for key in file_keys:
+                tensor = f.get_tensor(key)
+                dtype = torch_dtype if tensor.is_floating_point() else None
+                set_module_tensor_to_device(model, key_mapping[key], "cpu",
+                                            value=tensor, dtype=dtype)
+                del tensor
+
+
+def _set_submodule(model, name, module):
+    parent_name, _, child_name = name.rpartition(".")
+    parent = model.get_submodule(parent_name) if parent_name else model
+    setattr(parent, child_name, module)
+
+
+def _shell(module, keep, prefix=""):
+    # a shallow copy of `module` only holding the submodules selected by `keep`, which
+    # returns True to keep a submodule (shared, not copied), False to drop it, or None to
+    # descend into it; the modules on the way are shallow copies as well
+    shell = copy.copy(module)
+    shell._modules = {}
+    for child_name, child in module._modules.items():
+        name = prefix + child_name
+        verdict = keep(name)
+        if verdict is None:
+            shell._modules[child_name] = _shell(child, keep, name + ".")
+        elif verdict:
+            shell._modules[child_name] = child
+    return shell
+
+
+def _keep_only(layer_name):
+    def keep(name):
+        if name == layer_name:
+            return True
+        return None if layer_name.startswith(name + ".") else False
+    return keep
+
+
+def _keep_except(layer_names):
+    def keep(name):
+        if name in layer_names:
+            return False
+        return None if any(layer.startswith(name + ".") for layer in layer_names) else True
+    return keep
+
+
+def _merge_shell(module, shell, keep, prefix=""):
+    # put the submodules replaced during the conversion of `shell` back into `module`
+    for child_name, child in shell._modules.items():
+        name = prefix + child_name
+        if keep(name) is None:
+            _merge_shell(module._modules[child_name], child, keep, name + ".")
+        else:
+            module._modules[child_name] = child
+
+
+def layerwise_load_low_bit(model_class, pretrained_model_name_or_path, qtype,
+                           optimize_model=True, torch_dtype=None, subfolder="",
+                           convert_kwargs=None, **kwargs):
+    """
+    Build the model on the meta device and stream its safetensors weights into it one
+    decoder layer at a time: read a layer, quantize it into `FP4Params`, free it.
+
+    :param model_class: auto model class of transformers, e.g. `AutoModelForCausalLM`.
+    :param pretrained_model_name_or_path: local path or hub id of a safetensors checkpoint.
+    :param qtype: low-bit qtype value of `ggml_tensor_qtype` or `gguf_mixed_qtype`.
+    :param optimize_model: whether to apply `_optimize_pre` and `_optimize_post`.
+    :param torch_dtype: ``torch_dtype`` given to ``from_pretrained``, ``None`` reads the
+           weights in float32 and ``"auto"`` in the dtype of the config. It is passed to
+           `ggml_convert_low_bit` as is, i.e. ``"auto"`` if not given.
+    :param subfolder: subfolder of the checkpoint.
+    :param convert_kwargs: extra keyword arguments passed to `ggml_convert_low_bit`.
+    :param kwargs: keyword arguments passed to `model_class.from_config` and `AutoConfig`.
+
+    :return: a low-bit model instance
+    """
+    from transformers import AutoConfig
+    from .convert import ggml_convert_low_bit, _optimize_post, _convert_qwen_vl_visual
+
+    convert_kwargs = convert_kwargs or {}
+    trust_remote_code = kwargs.pop("trust_remote_code", None)
+    config = kwargs.pop("config", None)
+    if config is None:
+        config, kwargs = AutoConfig.from_pretrained(pretrained_model_name_or_path,
+                                                    return_unused_kwargs=True,
+                                                    trust_remote_code=trust_remote_code,
+                                                    subfolder=subfolder,
+                                                    **kwargs)
+    check_layerwise_load_support(config)
+    # the dtype the weights are read in, as `from_pretrained` does
+    load_dtype = torch_dtype
+    if load_dtype is None:
+        load_dtype = torch.float32
+    elif load_dtype == "auto":
+        load_dtype = getattr(config, "torch_dtype", None) or torch.float32
+    if isinstance(load_dtype, str):
+        load_dtype = getattr(torch, load_dtype)
+    convert_dtype = "auto" if torch_dtype is None else torch_dtype
+
+    weight_map = get_safetensors_weight_map(pretrained_model_name_or_path, subfolder)
+
+    if config.architectures is not None and config.architectures[0] in \
+            ["ChatGLMModel", "ChatGLMForConditionalGeneration"]:
+        # ChatGLM uses skip_init, which places modules on cpu if device is not specified
+        kwargs["device"] = "meta"
+    with init_empty_weights():
+        template = model_class.from_config(config, trust_remote_code=trust_remote_code,
+                                           torch_dtype=load_dtype, **kwargs)
+    template.eval()
+
+    model_keys = set(template.state_dict().keys())
+    base_model_prefix = getattr(template, "base_model_prefix", "")
+    key_mapping = {}
+    for key in weight_map:
+        model_key = _match_key(key, model_keys, base_model_prefix)
+        if model_key is None:
+            logger.warning(f"Unexpected key {key} in checkpoint, ignored.")
+        else:
+            key_mapping[key] = model_key
+
+    layer_names = get_decoder_layer_names(template)
+    layer_keys = {name: [] for name in layer_names}
+    other_keys = []
+    for key, model_key in key_mapping.items():
+        layer_name = next((name for name in layer_names
+                           if model_key.startswith(name + ".")), None)
+        if layer_name is None:
+            other_keys.append(key)
+        else:
+            layer_keys[layer_name].append(key)
+
+    def convert_group(keys, keep):
+        _load_weights(template, keys, weight_map, key_mapping, load_dtype)
+        template.tie_weights()
+        shell = ggml_convert_low_bit(_shell(template, keep), qtype, optimize_model,
+                                     torch_dtype=convert_dtype, disable_optimize_post=True,
+                                     **convert_kwargs)
+        _merge_shell(template, shell, keep)
+        del shell
+        gc.collect()
+
+    for name in layer_names:
+        convert_group(layer_keys[name], _keep_only(name))
+    # embeddings, final norm, lm_head, ... with the decoder layers left out
+    convert_group(other_keys, _keep_except(layer_names))
+
+    model = template
+    if optimize_model:
+        model = _optimize_post(model)
+    _convert_qwen_vl_visual(model)
+
+    missing = [name for name, param in model.named_parameters() if param.device.type == "meta"]
+    invalidInputError(len(missing) == 0,
+                      f"Weights of {missing} are not found in {pretrained_model_name_or_path}.")
+
+    try:
+        from transformers import GenerationConfig
+        if model.can_generate():
+            model.generation_config = GenerationConfig.from_pretrained(
+                pretrained_model_name_or_path, subfolder=subfolder)
+    except (OSError, TypeError):
+        pass
+    model.eval()
+    return model
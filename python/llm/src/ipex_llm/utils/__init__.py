@@ -18,19 +18,32 @@
 # physically located elsewhere.
 # Otherwise there would be module not found error in non-pip's setting as Python would
 # only search the first bigdl package and end up finding only one sub-package.
-import transformers
+from ipex_llm.utils.common.lazyimport import lazy_module_getattr, lazy_module_dir
 
-trans_version = transformers.__version__
 
-if trans_version >= "4.47.0":
-    from .benchmark_util_4_47 import BenchmarkWrapper
-elif trans_version >= "4.45.0":
-    from .benchmark_util_4_45 import BenchmarkWrapper
-elif trans_version >= "4.44.0":
-    from .benchmark_util_4_44 import BenchmarkWrapper
-elif trans_version >= "4.43.0":
-    from .benchmark_util_4_43 import BenchmarkWrapper
-elif trans_version >= "4.42.0":
-    from .benchmark_util_4_42 import BenchmarkWrapper
-else:
-    from .benchmark_util_4_29 import BenchmarkWrapper
+def _benchmark_util_module():
+    # importing transformers is slow, only do it when BenchmarkWrapper is really used
+    import transformers
+    trans_version = transformers.__version__
+
+    if trans_version >= "4.47.0":
+        return "ipex_llm.utils.benchmark_util_4_47"
+    elif trans_version >= "4.45.0":
+        return "ipex_llm.utils.benchmark_util_4_45"
+    elif trans_version >= "4.44.0":
+        return "ipex_llm.utils.benchmark_util_4_44"
+    elif trans_version >= "4.43.0":
+        return "ipex_llm.utils.benchmark_util_4_43"
+    elif trans_version >= "4.42.0":
+        return "ipex_llm.utils.benchmark_util_4_42"
+    else:
+        return "ipex_llm.utils.benchmark_util_4_29"
+
+
+__getattr__ = lazy_module_getattr(__name__, {
+    "BenchmarkWrapper": _benchmark_util_module,
+    "GenerationProfiler": "ipex_llm.utils.generation_profiler",
+})
+
+__all__ = ["BenchmarkWrapper", "GenerationProfiler"]
+__dir__ = lazy_module_dir(__name__, __all__)
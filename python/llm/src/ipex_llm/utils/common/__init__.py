@@ -19,5 +19,6 @@
 # Otherwise there would be module not found error in non-pip's setting as Python would
 # only search the first bigdl package and end up finding only one sub-package.
 
-from .log4Error import invalidInputError, invalidOperationError, MuteHFLogger
-from .lazyimport import LazyImport
+from .log4Error import invalidInputError, invalidOperationError, invalidAttributeError, \
+    MuteHFLogger
+from .lazyimport import LazyImport, lazy_module_getattr, lazy_module_dir
@@ -15,8 +15,11 @@
 #
 
 import importlib
+import importlib.util
 import sys
 
+from .log4Error import invalidAttributeError
+
 
 # code adaptted from https://github.com/intel/neural-compressor/
 #                    blob/master/neural_compressor/utils/utility.py#L88
@@ -36,7 +39,7 @@ class LazyImport:
         self.module_name = module_name
 
     def __getattr__(self, name):
-        absolute_name = importlib.util.resolve_name(self.module_name)
+        absolute_name = importlib.util.resolve_name(self.module_name, None)
         # not reload modules
         try:
             return getattr(sys.modules[absolute_name], name)
@@ -74,3 +77,63 @@ class LazyImport:
         module = importlib.import_module(module_name)
         function = getattr(module, function_name)
         return function(*args, **kwargs)
+
+
+def lazy_module_getattr(package_name: str, lazy_attrs: dict, fallback_modules=()):
+    """
+    Build a PEP 562 module-level ``__getattr__`` which imports the public API
+    of a package on first access instead of at package import time.
+
+    Example:
+        >>> __getattr__ = lazy_module_getattr(__name__, {
+        ...     "llm_convert": "ipex_llm.convert_model",
+        ... })
+
+    :param package_name: Name of the package, i.e. ``__name__`` of its ``__init__``.
+    :param lazy_attrs: Map from attribute name to the module defining it, the module
+           may also be given as a callable returning the module name.
+    :param fallback_modules: Modules searched in order for names not in ``lazy_attrs``,
+           which keeps the names re-exported by a former ``import *`` reachable.
+    :return: A ``__getattr__`` function to be assigned in the package namespace.
+    """
+    def __getattr__(name):
+        if name.startswith("__") and name.endswith("__"):
+            # dunder names such as `__all__` or `__wrapped__` are probed by `import *` and
+            # introspection, they should never import the lazily loaded modules
+            invalidAttributeError(False, f"module '{package_name}' has no attribute '{name}'")
+        if name in lazy_attrs:
+            module_name = lazy_attrs[name]
+            if callable(module_name):
+                module_name = module_name()
+            value = getattr(LazyImport(module_name), name)
+        elif importlib.util.find_spec(f"{package_name}.{name}") is not None:
+            # a submodule which has not been imported yet
+            value = importlib.import_module(f"{package_name}.{name}")
+        else:
+            value = None
+            for module_name in fallback_modules:
+                value = getattr(LazyImport(module_name), name, None)
+                if value is not None:
+                    break
+            invalidAttributeError(value is not None,
+                                  f"module '{package_name}' has no attribute '{name}'")
+        # cache it so that later access won't go through `__getattr__` again
+        setattr(sys.modules[package_name], name, value)
+        return value
+
+    return __getattr__
+
+
+def lazy_module_dir(package_name: str, names):
+    """
+    Build a PEP 562 module-level ``__dir__`` which also lists the lazily imported
+    names, so that they are visible to ``dir()`` and completion before first access.
+
+    :param package_name: Name of the package, i.e. ``__name__`` of its ``__init__``.
+    :param names: The lazily imported public names, usually ``__all__`` of the package.
+    :return: A ``__dir__`` function to be assigned in the package namespace.
+    """
+    def __dir__():
+        return sorted(set(vars(sys.modules[package_name])) | set(names))
+
+    return __dir__
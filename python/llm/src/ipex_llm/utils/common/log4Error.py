@@ -32,6 +32,13 @@ def invalidInputError(condition, errMsg, fixMsg=None):
         raise RuntimeError(errMsg)
 
 
+def invalidAttributeError(condition, errMsg):
+    # `hasattr` and `getattr` with a default expect a plain AttributeError,
+    # so no usage message is logged for it
+    if not condition:
+        raise AttributeError(errMsg)
+
+
 def invalidOperationError(condition, errMsg, fixMsg=None, cause=None):
     if not condition:
         outputUserMessage(errMsg, fixMsg)
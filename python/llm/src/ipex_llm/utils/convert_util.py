@@ -66,6 +66,7 @@ from typing import (IO, TYPE_CHECKING, Any, Callable, Dict, Iterable, List,
 import numpy as np
 from sentencepiece import SentencePieceProcessor
 from ipex_llm.utils.common import invalidInputError
+from ipex_llm.utils.utils import zip_member_offset
 import os
 from pathlib import Path
 
@@ -133,6 +134,13 @@ DATA_TYPE_TO_NUMPY = {DT_BF16: np.dtype(np.uint16),
 NUMPY_TYPE_TO_DATA_TYPE = Dict['np.dtype[Any]', DataType]
 NUMPY_TYPE_TO_DATA_TYPE = {dtype: data_type for (data_type, dtype) in DATA_TYPE_TO_NUMPY.items()}
 
+# file type of llama ggjt files and tensor type of the ggml tensors in them
+LLAMA_QUANTIZED_FTYPE = {"q4_0": (2, 2),
+                         "q8_0": (7, 8)}
+# as in the quantize tool, output.weight is kept in q6_k if its dims are multiples of QK_K
+GGML_TYPE_Q6_K = 14
+QK_K = 256
+
 
 class GGMLFileType(enum.Enum):
     AllF32 = 0
@@ -939,10 +947,12 @@ class LazyStorage:
 
 
 class LazyUnpickler(pickle.Unpickler):
-    def __init__(self, fp: IO[bytes], data_base_path: str, zip_file: zipfile.ZipFile):
+    def __init__(self, fp: IO[bytes], data_base_path: str, zip_file: zipfile.ZipFile,
+                 mapped: Optional[mmap.mmap] = None):
         super().__init__(fp)
         self.data_base_path = data_base_path
         self.zip_file = zip_file
+        self.mapped = mapped
 
     def persistent_load(self, pid: Any) -> Any:
         invalidInputError(pid[0] == 'storage' and isinstance(pid[1], LazyStorageKind),
@@ -951,10 +961,18 @@ class LazyUnpickler(pickle.Unpickler):
         filename_stem = pid[2]
         filename = self.data_base_path + '/' + filename_stem
         info = self.zip_file.getinfo(filename)
+        start = zip_member_offset(info, self.mapped)
+        mapped = self.mapped
 
         def load(offset: int, elm_count: int) -> NDArray:
             dtype = DATA_TYPE_TO_NUMPY.get(data_type)
             invalidInputError(dtype is not None, "Tensor stored in unsupported format.")
+            if start is not None:
+                # zero-copy view of the mapped file
+                invalidInputError((offset + elm_count) * dtype.itemsize <= info.file_size,
+                                  "Fail to load.")
+                return np.frombuffer(mapped, dtype, count=elm_count,
+                                     offset=start + offset * dtype.itemsize)
             fp = self.zip_file.open(info)
             fp.seek(offset * dtype.itemsize)
             size = elm_count * dtype.itemsize
@@ -1002,10 +1020,15 @@ def lazy_load_torch_file(outer_fp: IO[bytes], path: Path) -> ModelPlus:
     pickle_paths = [name for name in zf.namelist() if name.endswith('.pkl')]
     invalidInputError(len(pickle_paths) == 1 and pickle_paths is not None,
                       "Fail to load torch files.")
+    try:
+        mapped = mmap.mmap(outer_fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        mapped = None
     pickle_fp = zf.open(pickle_paths[0], 'r')
     unpickler = LazyUnpickler(pickle_fp,
                               data_base_path=pickle_paths[0][:-4],
-                              zip_file=zf)
+                              zip_file=zf,
+                              mapped=mapped)
     model = unpickler.load()
     as_dict = dict(model.items())
     return ModelPlus(model=as_dict, paths=[path], format='torch', vocab=None)
@@ -1196,23 +1219,28 @@ class OutputFile:
     def __init__(self, fname_out: Path) -> None:
         self.fout = open(fname_out, "wb")
 
-    def write_file_header(self, params: Params, file_type: GGMLFileType) -> None:
+    def write_file_header(self, params: Params, file_type: Union[GGMLFileType, int],
+                          version: int = 1) -> None:
+        if isinstance(file_type, GGMLFileType):
+            file_type = file_type.value
         self.fout.write(b"ggjt"[::-1])  # magic
         values = [
-            1,  # file version
+            version,  # file version
             params.n_vocab,
             params.n_embd,
             params.n_mult,
             params.n_head,
             params.n_layer,
             params.n_embd // params.n_head,  # rot (obsolete)
-            file_type.value,
+            file_type,
         ]
         self.fout.write(struct.pack("i" * len(values), *values))
 
-    def write_tensor_header(self, name: str, shape: Sequence[int], data_type: DataType) -> None:
+    def write_tensor_header(self, name: str, shape: Sequence[int],
+                            data_type: Union[DataType, int]) -> None:
         sname = name.encode('utf-8')
-        self.fout.write(struct.pack("iii", len(shape), len(sname), DATA_TYPE_TO_FTYPE[data_type]))
+        ftype = data_type if isinstance(data_type, int) else DATA_TYPE_TO_FTYPE[data_type]
+        self.fout.write(struct.pack("iii", len(shape), len(sname), ftype))
         self.fout.write(struct.pack("i" * len(shape), *shape[::-1]))
         self.fout.write(sname)
         self.fout.seek((self.fout.tell() + 31) & -32)
@@ -1255,6 +1283,67 @@ class OutputFile:
             ndarray.tofile(of.fout)
         of.fout.close()
 
+    @staticmethod
+    def write_all_quantized(fname_out: Path, params: Params, qtype: str, model: LazyModel,
+                            vocab: Vocab, concurrency: int = 8) -> None:
+        """
+        Write a `qtype` quantized ggjt v3 file in a single pass: each tensor is loaded
+        lazily, quantized in-process on `concurrency` threads and written to `fname_out`,
+        without an intermediate fp16 file.
+        """
+        file_type, tensor_type = LLAMA_QUANTIZED_FTYPE[qtype]
+        check_vocab_size(params, vocab)
+        of = OutputFile(fname_out)
+        of.write_file_header(params, file_type, version=3)
+        print("Writing vocab...")
+        of.write_vocab(vocab)
+
+        def do_item(item: Tuple[str, LazyTensor]) -> Tuple[int, NDArray]:
+            name, lazy_tensor = item
+            ndarray = lazy_tensor.astype(DT_F32).load().to_ggml().ndarray
+            if len(lazy_tensor.shape) == 1:
+                # 1D tensors are always F32
+                return DATA_TYPE_TO_FTYPE[DT_F32], ndarray
+            if name == "output.weight" and all(dim % QK_K == 0 for dim in lazy_tensor.shape):
+                return GGML_TYPE_Q6_K, ggml_quantize_ndarray(ndarray, GGML_TYPE_Q6_K)
+            if lazy_tensor.shape[-1] % 32 != 0:
+                return DATA_TYPE_TO_FTYPE[DT_F16], ndarray.astype(np.float16)
+            return tensor_type, ggml_quantize_ndarray(ndarray, tensor_type)
+
+        results = bounded_parallel_map(do_item, model.items(), concurrency=concurrency)
+        for i, ((name, lazy_tensor), (ftype, ndarray)) in enumerate(zip(model.items(),
+                                                                        results)):
+            size = ' x '.join(f"{dim:6d}" for dim in lazy_tensor.shape)
+            padi = len(str(len(model)))
+            print(f"[{i+1:{padi}d}/{len(model)}] Writing tensor {name:38s} | size {size:16}"
+                  f"| type {ftype}")
+            of.write_tensor_header(name, lazy_tensor.shape, ftype)
+            ndarray.tofile(of.fout)
+        of.fout.close()
+
+
+def ggml_quantize_ndarray(ndarray: NDArray, tensor_type: int) -> NDArray:
+    # ctypes releases the GIL during quantization, so tensors are quantized in parallel
+    import ctypes
+    from ipex_llm.ggml.model.llama import llama_cpp
+    from ipex_llm.ggml.quantize import ggml_tensor_qtype
+    # q4_0 and q8_0 have the same id in ggml and in ipex-llm, q6_k does not
+    qtype = ggml_tensor_qtype["q6_k"] if tensor_type == GGML_TYPE_Q6_K else tensor_type
+    src = np.ascontiguousarray(ndarray, dtype=np.float32)
+    qk = llama_cpp.ggml_qk_size(qtype)
+    dst = np.empty(src.size // qk * llama_cpp.ggml_type_size(qtype), dtype=np.uint8)
+    src_ptr = src.ctypes.data_as(ctypes.POINTER(ctypes.c_float))
+    hist = (ctypes.c_int64 * 16)()
+    if tensor_type == GGML_TYPE_Q6_K:
+        # k-quants are quantized row by row, without importance matrix
+        llama_cpp.ggml_quantize_tensor_with_weights(src_ptr, ctypes.c_void_p(dst.ctypes.data),
+                                                    qtype, src.size // src.shape[-1],
+                                                    src.shape[-1], hist, None)
+    else:
+        llama_cpp.ggml_quantize_tensor(src_ptr, ctypes.c_void_p(dst.ctypes.data), qtype,
+                                       src.size, src.shape[-1], hist, False)
+    return dst
+
 
 def pick_output_type(model: LazyModel, output_type_str: Optional[str]) -> GGMLFileType:
     wq_type = model["layers.0.attention.wq.weight"].data_type
@@ -0,0 +1,297 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import csv
+import json
+import os
+import time
+
+import numpy as np
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
+
+
+def _current_rss_gb():
+    try:
+        import psutil
+        return psutil.Process(os.getpid()).memory_info().rss / (1024 ** 3)
+    except ImportError:
+        import resource
+        # ru_maxrss is the peak rather than the current RSS, in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 ** 2)
+
+
+def _synchronize(device):
+    if device.type == "xpu":
+        torch.xpu.synchronize()
+
+
+class _StepEndCriteria(StoppingCriteria):
+    """
+    Never stops generation, only marks the end of a decoding step, which is right after
+    the new tokens of this step have been selected.
+    """
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.profiler._on_step_end()
+        return False
+
+
+class _CountingStreamer(BaseStreamer):
+    """
+    Counts the tokens emitted by `generate` while forwarding them to the user's streamer.
+    """
+    def __init__(self, profiler, streamer):
+        self.profiler = profiler
+        self.streamer = streamer
+        self.prompt_seen = False
+
+    def put(self, value):
+        if self.prompt_seen:
+            self.profiler._on_token(value)
+        else:
+            # the first `put` of `generate` is the prompt
+            self.prompt_seen = True
+        self.streamer.put(value)
+
+    def end(self):
+        self.streamer.end()
+
+
+class GenerationProfiler:
+    """
+    Collect generation performance of any `generate` call through forward hooks and a
+    stopping criteria, instead of re-implementing `generate` with timers like
+    `BenchmarkWrapper`, so that it keeps working across transformers versions.
+
+    It exposes the same `first_cost`, `rest_cost_mean`, `encoder_time` and `peak_memory`
+    attributes as `BenchmarkWrapper` for the last `generate` call, and keeps a record of
+    every call in `records`, which can be exported by `to_json` and `to_csv`.
+
+    Example:
+        >>> from ipex_llm.utils import GenerationProfiler
+        >>> model = GenerationProfiler(model)
+        >>> output = model.generate(input_ids, max_new_tokens=32)
+        >>> print(model.first_cost, model.rest_cost_mean)
+        >>> model.to_csv("results.csv")
+    """
+
+    def __init__(self, model, do_print=False, verbose=False):
+        self.model = model
+        self.do_print = do_print
+        self.verbose = verbose
+        self.encoder_time = 0.0
+        self.first_cost = 0.0
+        self.rest_cost_mean = 0.0
+        self.peak_memory = 0.0
+        self.records = []
+        self._reset_step_state()
+
+        self._hooks = [
+            model.register_forward_pre_hook(self._on_forward_start),
+            model.register_forward_hook(self._on_forward_end),
+        ]
+        if getattr(model.config, "is_encoder_decoder", False):
+            encoder = model.get_encoder()
+            self._hooks += [
+                encoder.register_forward_pre_hook(self._on_encoder_start),
+                encoder.register_forward_hook(self._on_encoder_end),
+            ]
+
+    def __getattr__(self, attr):
+        # only called when `attr` is not found on the profiler itself
+        return getattr(self.__dict__["model"], attr)
+
+    def __call__(self, *args, **kwargs):
+        return self.model(*args, **kwargs)
+
+    def remove_hooks(self):
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+
+    def _reset_step_state(self):
+        self._active = False
+        self._step_start = None
+        self._step_ends = []
+        self._forward_ends = []
+        self._first_step_start = None
+        self._encoder_start = None
+        self._encoder_time = 0.0
+        self._streamed_tokens = 0
+        self._device_memory = []
+        self._peak_rss = 0.0
+
+    def _device(self):
+        try:
+            return self.model.device
+        except AttributeError:
+            return next(self.model.parameters()).device
+
+    def _sample_memory(self):
+        device = self._device()
+        if device.type == "xpu":
+            self._device_memory.append(torch.xpu.memory.memory_reserved(device) / (1024 ** 3))
+        self._peak_rss = max(self._peak_rss, _current_rss_gb())
+
+    def _on_forward_start(self, module, args):
+        if not self._active:
+            return
+        self._step_start = time.perf_counter()
+        if self._first_step_start is None:
+            self._first_step_start = self._step_start
+
+    def _on_forward_end(self, module, args, output):
+        if not self._active:
+            return
+        _synchronize(self._device())
+        self._forward_ends.append(time.perf_counter())
+
+    def _on_encoder_start(self, module, args):
+        if self._active:
+            self._encoder_start = time.perf_counter()
+
+    def _on_encoder_end(self, module, args, output):
+        if self._active and self._encoder_start is not None:
+            _synchronize(self._device())
+            self._encoder_time += time.perf_counter() - self._encoder_start
+            self._encoder_start = None
+
+    def _on_step_end(self):
+        if not self._active:
+            return
+        _synchronize(self._device())
+        self._sample_memory()
+        self._step_ends.append(time.perf_counter())
+
+    def _on_token(self, value):
+        self._streamed_tokens += 1
+
+    def _wrap_generate_kwargs(self, kwargs):
+        stopping_criteria = kwargs.get("stopping_criteria", None)
+        stopping_criteria = StoppingCriteriaList(list(stopping_criteria or []))
+        stopping_criteria.append(_StepEndCriteria(self))
+        kwargs["stopping_criteria"] = stopping_criteria
+
+        # only chain a streamer given by the caller, as some `generate` paths (beam search,
+        # speculative and lookup decoding) don't support streamer at all
+        streamer = kwargs.get("streamer", None)
+        if streamer is not None:
+            kwargs["streamer"] = _CountingStreamer(self, streamer)
+        return kwargs
+
+    @staticmethod
+    def _input_length(args, kwargs):
+        inputs = kwargs.get("input_ids", kwargs.get("inputs", args[0] if args else None))
+        if isinstance(inputs, torch.Tensor) and inputs.dim() == 2:
+            return inputs.shape[0], inputs.shape[1]
+        return 1, 0
+
+    def generate(self, *args, **kwargs):
+        kwargs = self._wrap_generate_kwargs(kwargs)
+        batch_size, input_len = self._input_length(args, kwargs)
+
+        self._reset_step_state()
+        self._active = True
+        st = time.perf_counter()
+        try:
+            output = self.model.generate(*args, **kwargs)
+            _synchronize(self._device())
+        finally:
+            self._active = False
+        end = time.perf_counter()
+
+        sequences = output if isinstance(output, torch.Tensor) else \
+            getattr(output, "sequences", None)
+        record = self._make_record(st, end, batch_size, input_len, sequences)
+        self.records.append(record)
+        self._print_record(record)
+        return output
+
+    def _make_record(self, st, end, batch_size, input_len, sequences):
+        # prefer the step boundaries given by stopping criteria, which also covers
+        # token selection, and fall back to forward boundaries for custom decoding loops
+        step_ends = self._step_ends or self._forward_ends
+        first_step_start = self._first_step_start if self._first_step_start is not None else st
+        if step_ends:
+            first_cost = step_ends[0] - first_step_start
+            rest_costs = np.diff(np.array(step_ends))
+        else:
+            first_cost, rest_costs = end - st, np.array([])
+
+        if self._streamed_tokens > 0:
+            output_len = self._streamed_tokens
+        elif sequences is not None:
+            if getattr(self.model.config, "is_encoder_decoder", False):
+                # the decoder output starts with `decoder_start_token_id`
+                output_len = sequences.shape[-1] - 1
+            else:
+                output_len = sequences.shape[-1] - input_len
+        else:
+            output_len = len(step_ends)
+
+        self.encoder_time = self._encoder_time
+        self.first_cost = first_cost
+        self.rest_cost_mean = float(np.mean(rest_costs)) if len(rest_costs) > 0 else 0.0
+        self.peak_memory = float(np.max(self._device_memory)) if self._device_memory else 0.0
+
+        def percentile(q):
+            return float(np.percentile(rest_costs, q)) if len(rest_costs) > 0 else 0.0
+
+        return {
+            "batch_size": batch_size,
+            "input_tokens": input_len,
+            "output_tokens": output_len,
+            "encoder_time": self.encoder_time,
+            "first_token_latency": self.first_cost,
+            "rest_token_latency_mean": self.rest_cost_mean,
+            "rest_token_latency_p50": percentile(50),
+            "rest_token_latency_p90": percentile(90),
+            "rest_token_latency_p99": percentile(99),
+            "end_to_end_time": end - st,
+            "tokens_per_second": batch_size * output_len / (end - st),
+            "peak_rss_gb": self._peak_rss,
+            "peak_device_memory_gb": self.peak_memory,
+        }
+
+    def _print_record(self, record):
+        if not self.do_print:
+            return
+        print(f"=========First token cost {record['first_token_latency']:.4f} s=========")
+        if record["output_tokens"] > 1:
+            print(f"=========Rest tokens cost average {record['rest_token_latency_mean']:.4f} s "
+                  f"(p50 {record['rest_token_latency_p50']:.4f} s, "
+                  f"p90 {record['rest_token_latency_p90']:.4f} s, "
+                  f"p99 {record['rest_token_latency_p99']:.4f} s)=========")
+        if self.verbose:
+            print(json.dumps(record, indent=2))
+
+    def to_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.records, f, indent=2)
+
+    def to_csv(self, path):
+        if not self.records:
+            return
+        write_header = not os.path.exists(path) or os.path.getsize(path) == 0
+        with open(path, "a", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(self.records[0].keys()))
+            if write_header:
+                writer.writeheader()
+            writer.writerows(self.records)
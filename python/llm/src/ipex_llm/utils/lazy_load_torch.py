@@ -46,9 +46,13 @@ from torch.serialization import StorageType
 import pickle
 import zipfile
 import io
-from typing import Dict, IO, Any, Callable, List
+import mmap
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, IO, Any, Callable, List, Optional
 from dataclasses import dataclass
 from .common import invalidInputError
+from .utils import zip_member_offset
 
 
 item_size = {torch.bfloat16: 2,
@@ -64,6 +68,7 @@ class LazyStorage:
     load: Callable[[int, int], torch.Tensor]
     kind: StorageType
     description: str
+    prefetch: Optional[Callable[[int, int], None]] = None
 
 
 @dataclass
@@ -72,11 +77,17 @@ class LazyTensor:
     shape: List[int]
     data_type: torch.dtype
     description: str
+    _prefetch: Optional[Callable[[], None]] = None
 
     def load(self) -> torch.Tensor:
         ret = self._load()
         return ret
 
+    def prefetch(self):
+        # start reading the data of a memory-mapped tensor in the background
+        if self._prefetch is not None:
+            self._prefetch()
+
     def to(self, data_type):
         # self.validate_conversion_to(data_type)
 
@@ -86,34 +97,54 @@ class LazyTensor:
         return LazyTensor(load, self.shape, data_type, f'convert({data_type}) {self.description}')
 
 
-def _load(pickle_fp, map_location, picklemoudle, pickle_file='data.pkl', zip_file=None):
+def _load(pickle_fp, map_location, picklemoudle, pickle_file='data.pkl', zip_file=None,
+          mapped=None):
 
     load_module_mapping: Dict[str, str] = {
         'torch.tensor': 'torch._tensor'
     }
 
     class LazyUnpickler(picklemoudle.Unpickler):
-        def __init__(self, fp: IO[bytes], data_base_path: str, zip_file: zipfile.ZipFile):
+        def __init__(self, fp: IO[bytes], data_base_path: str, zip_file: zipfile.ZipFile,
+                     mapped: mmap.mmap = None):
             super().__init__(fp)
             self.data_base_path = data_base_path
             self.zip_file = zip_file
+            self.mapped = mapped
 
         def persistent_load(self, pid):
             data_type = pid[1].dtype
             filename_stem = pid[2]
             filename = f'{self.data_base_path}/{filename_stem}'
             info = self.zip_file.getinfo(filename)
+            start = zip_member_offset(info, self.mapped)
+            mapped = self.mapped
+            zip_path = self.zip_file.filename
 
             def load(offset: int, elm_count: int):
                 dtype = data_type
-                fp = self.zip_file.open(info)
-                fp.seek(offset * item_size[dtype])
-                size = elm_count * item_size[dtype]
-                data = fp.read(size)
+                if start is not None and elm_count > 0:
+                    # a view of the mapped file, pages are read when the tensor is used
+                    return torch.frombuffer(mapped, dtype=dtype, count=elm_count,
+                                            offset=start + offset * item_size[dtype])
+                # `lazyload` closes the file after unpickling, reopen it to read the member
+                with zipfile.ZipFile(zip_path) as zf, zf.open(info.filename) as fp:
+                    fp.seek(offset * item_size[dtype])
+                    size = elm_count * item_size[dtype]
+                    data = fp.read(size)
                 return torch.frombuffer(bytearray(data), dtype=dtype)
+
+            def prefetch(offset: int, elm_count: int):
+                if start is None or elm_count == 0 or not hasattr(mapped, "madvise"):
+                    return
+                begin = start + offset * item_size[data_type]
+                end = begin + elm_count * item_size[data_type]
+                begin -= begin % mmap.PAGESIZE
+                mapped.madvise(mmap.MADV_WILLNEED, begin, end - begin)
             description = f'storage data_type={data_type} ' \
                           f'path-in-zip={filename} path={self.zip_file.filename}'
-            return LazyStorage(load=load, kind=pid[1], description=description)
+            return LazyStorage(load=load, kind=pid[1], description=description,
+                               prefetch=prefetch)
 
         @staticmethod
         def lazy_rebuild_tensor_v2(storage: Any,
@@ -130,8 +161,12 @@ def _load(pickle_fp, map_location, picklemoudle, pickle_file='data.pkl', zip_fil
             def load() -> torch.Tensor:
                 elm_count = stride[0] * size[0]
                 return storage.load(storage_offset, elm_count).reshape(size)
+
+            def prefetch():
+                if storage.prefetch is not None:
+                    storage.prefetch(storage_offset, stride[0] * size[0])
             description = f'pickled storage_offset={storage_offset} in {storage.description}'
-            return LazyTensor(load, list(size), storage.kind.dtype, description)
+            return LazyTensor(load, list(size), storage.kind.dtype, description, prefetch)
 
         @staticmethod
         def rebuild_from_type_v2(func, new_type, args, state):
@@ -156,7 +191,8 @@ def _load(pickle_fp, map_location, picklemoudle, pickle_file='data.pkl', zip_fil
 
     unpickler = LazyUnpickler(pickle_fp,
                               data_base_path=pickle_file,
-                              zip_file=zip_file)
+                              zip_file=zip_file,
+                              mapped=mapped)
     result = unpickler.load()
 
     return result
@@ -177,12 +213,45 @@ def lazyload(
     invalidInputError(len(pickle_paths) == 1,
                       "There should be only one pickle_paths found, "
                       f"but get {pickle_paths}. ")
+    try:
+        # copy-on-write mapping, so that tensors viewing it are writable
+        mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_COPY)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        mapped = None
     pickle_fp = zf.open(pickle_paths[0], 'r')
-    state_dict = _load(pickle_fp, None, pickle, pickle_file=pickle_paths[0][:-4], zip_file=zf)
+    state_dict = _load(pickle_fp, None, pickle, pickle_file=pickle_paths[0][:-4], zip_file=zf,
+                       mapped=mapped)
     fp.close()  # Otherwise on windows this may be marked as reading
     return state_dict
 
 
+def prefetch_tensors(state_dict: Dict[str, Any], num_workers: int = 4):
+    """
+    Iterate over the (name, tensor) of the `LazyTensor` in `state_dict`, the next
+    `num_workers` tensors are read in background threads while the current one is
+    processed, e.g. quantized.
+    """
+    def load(lazy_tensor):
+        lazy_tensor.prefetch()
+        return lazy_tensor.load()
+
+    items = iter((name, value) for name, value in state_dict.items()
+                 if isinstance(value, LazyTensor))
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = deque()
+        for name, lazy_tensor in items:
+            futures.append((name, executor.submit(load, lazy_tensor)))
+            if len(futures) >= num_workers:
+                break
+        while futures:
+            name, future = futures.popleft()
+            tensor = future.result()
+            for next_name, lazy_tensor in items:
+                futures.append((next_name, executor.submit(load, lazy_tensor)))
+                break
+            yield name, tensor
+
+
 class LazyLoadTensors:
     def __init__(self):
         self.torch_load = torch.load
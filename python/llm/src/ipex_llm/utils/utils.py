@@ -15,9 +15,16 @@
 #
 
 import sys
+import mmap
 import pathlib
+import struct
+import zipfile
+from typing import Optional
 from ipex_llm.utils.common import invalidInputError, invalidOperationError
 
+# torch.save stores the storages uncompressed and aligned to 64 bytes in the zip file
+ZIP_ALIGNMENT = 64
+
 
 def get_shared_lib_info(lib_base_name: str):
     # Determine the file extension based on the platform
@@ -39,3 +46,21 @@ def get_shared_lib_info(lib_base_name: str):
     ]
 
     return _base_path, _lib_paths
+
+
+def zip_member_offset(info: zipfile.ZipInfo, mapped: Optional[mmap.mmap]) -> Optional[int]:
+    """
+    Offset of the data of `info` in the memory-mapped zip file, or None if the member
+    is compressed or not aligned, so that it cannot be viewed without copying.
+    """
+    if mapped is None or info.compress_type != zipfile.ZIP_STORED:
+        return None
+    header_offset = info.header_offset
+    # local file header: signature, ..., name length at 26, extra field length at 28
+    if mapped[header_offset:header_offset + 4] != b"PK\x03\x04":
+        return None
+    name_length, extra_length = struct.unpack_from("<HH", mapped, header_offset + 26)
+    start = header_offset + 30 + name_length + extra_length
+    if start % ZIP_ALIGNMENT != 0 or start + info.file_size > len(mapped):
+        return None
+    return start
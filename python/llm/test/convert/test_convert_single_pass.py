@@ -0,0 +1,144 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+import struct
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+
+import numpy as np
+import pytest
+
+from ipex_llm.ggml.convert import _convert_to_ggml
+from ipex_llm.ggml.convert_model import convert_model
+from ipex_llm.ggml.quantize import quantize
+
+
+llama_model_path = os.environ.get('LLAMA_ORIGIN_PATH')
+output_dir = os.environ.get('INT4_CKPT_DIR')
+
+# ggml type -> (block size, bytes per block)
+GGML_TYPE_SIZES = {0: (1, 4), 1: (1, 2), 2: (32, 18), 8: (32, 34), 14: (256, 210)}
+
+
+def read_ggjt(path):
+    """
+    Return {name: (ggml type, shape, data)} of the tensors in a ggjt file.
+    """
+    tensors = {}
+    with open(path, "rb") as f:
+        assert f.read(4) == b"ggjt"[::-1]
+        _, n_vocab = struct.unpack("ii", f.read(8))
+        f.read(4 * 6)
+        for _ in range(n_vocab):
+            length, = struct.unpack("i", f.read(4))
+            f.read(length + 4)
+        while header := f.read(12):
+            n_dims, name_length, ggml_type = struct.unpack("iii", header)
+            shape = struct.unpack("i" * n_dims, f.read(4 * n_dims))[::-1]
+            name = f.read(name_length).decode("utf-8")
+            f.seek((f.tell() + 31) & -32)
+            block_size, block_bytes = GGML_TYPE_SIZES[ggml_type]
+            data = f.read(int(np.prod(shape)) // block_size * block_bytes)
+            tensors[name] = (ggml_type, shape, data)
+    return tensors
+
+
+def dequantize(ggml_type, data):
+    if ggml_type == 0:
+        return np.frombuffer(data, dtype=np.float32)
+    if ggml_type == 1:
+        return np.frombuffer(data, dtype=np.float16).astype(np.float32)
+    if ggml_type == 2:
+        # q4_0: fp16 scale, then 32 4-bit values, low nibbles first
+        blocks = np.frombuffer(data, dtype=np.uint8).reshape(-1, 18)
+        scales = blocks[:, :2].copy().view(np.float16).astype(np.float32)
+        qs = blocks[:, 2:]
+        values = np.concatenate([qs & 0x0F, qs >> 4], axis=1).astype(np.float32) - 8
+        return (values * scales).reshape(-1)
+    if ggml_type == 8:
+        # q8_0: fp16 scale, then 32 int8 values
+        blocks = np.frombuffer(data, dtype=np.uint8).reshape(-1, 34)
+        scales = blocks[:, :2].copy().view(np.float16).astype(np.float32)
+        values = blocks[:, 2:].copy().view(np.int8).astype(np.float32)
+        return (values * scales).reshape(-1)
+    if ggml_type == 14:
+        # q6_k: 128 low nibbles, 64 bytes of high 2 bits, 16 int8 scales and a fp16 scale
+        # per 256 values, each half of 128 values is 4 interleaved groups of 32
+        blocks = np.frombuffer(data, dtype=np.uint8).reshape(-1, 210)
+        scales = blocks[:, 192:208].copy().view(np.int8).astype(np.float32)
+        d = blocks[:, 208:].copy().view(np.float16).astype(np.float32)
+        halves = []
+        for h in range(2):
+            ql = blocks[:, 64 * h:64 * (h + 1)]
+            qh = blocks[:, 128 + 32 * h:128 + 32 * (h + 1)]
+            values = np.concatenate([(ql[:, :32] & 0x0F) | ((qh & 3) << 4),
+                                     (ql[:, 32:] & 0x0F) | (((qh >> 2) & 3) << 4),
+                                     (ql[:, :32] >> 4) | (((qh >> 4) & 3) << 4),
+                                     (ql[:, 32:] >> 4) | (((qh >> 6) & 3) << 4)], axis=1)
+            sub_scales = np.repeat(scales[:, 8 * h:8 * (h + 1)], 16, axis=1)
+            halves.append((values.astype(np.float32) - 32) * sub_scales * d)
+        return np.concatenate(halves, axis=1).reshape(-1)
+    return None
+
+
+# largest quantized magnitude of each ggml type, for the size of a quantization step
+GGML_TYPE_MAX_Q = {2: 7, 8: 127, 14: 31}
+
+
+class TestConvertSinglePass(TestCase):
+
+    def test_single_pass_equivalence(self):
+        for dtype, qtype in [("int4", "q4_0"), ("int8", "q8_0")]:
+            with tempfile.TemporaryDirectory(dir=output_dir) as tempdir:
+                single_pass_dir = os.path.join(tempdir, "single_pass")
+                single_pass = convert_model(llama_model_path, single_pass_dir, "llama", dtype)
+                fp16_dir = os.path.join(tempdir, "fp16")
+                _convert_to_ggml(llama_model_path, fp16_dir, "llama", "fp16")
+                two_pass_dir = os.path.join(tempdir, "two_pass")
+                os.makedirs(two_pass_dir)
+                two_pass = quantize(str(next(Path(fp16_dir).iterdir())), two_pass_dir,
+                                    "llama", qtype)
+                expected = read_ggjt(two_pass)
+                tensors = read_ggjt(single_pass)
+
+            assert list(tensors.keys()) == list(expected.keys())
+            compared = 0
+            for name, (ggml_type, shape, data) in tensors.items():
+                expected_type, expected_shape, expected_data = expected[name]
+                assert shape == expected_shape, name
+                # including output.weight kept in q6_k by the quantize tool
+                assert ggml_type == expected_type, name
+                values = dequantize(ggml_type, data)
+                expected_values = dequantize(expected_type, expected_data)
+                if ggml_type in (0, 1):
+                    np.testing.assert_array_equal(values, expected_values, err_msg=name)
+                    compared += 1
+                    continue
+                # within one quantization step, and close on average
+                step = np.abs(expected_values).max() / GGML_TYPE_MAX_Q[ggml_type]
+                np.testing.assert_allclose(values, expected_values, rtol=0, atol=step + 1e-6,
+                                           err_msg=name)
+                assert np.abs(values - expected_values).mean() \
+                    <= 0.05 * np.abs(expected_values).mean() + 1e-6, name
+                compared += 1
+            assert compared == len(tensors)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
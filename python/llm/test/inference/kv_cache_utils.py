@@ -0,0 +1,27 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+from ipex_llm.transformers.kv import DynamicNormalCache
+
+
+def make_cache(token_ids, num_layers=2):
+    # the key of each position is its token id, to check the kept positions
+    past_key_values = DynamicNormalCache()
+    key = token_ids.float().view(1, 1, -1, 1).expand(1, 2, -1, 4).contiguous()
+    for layer_idx in range(num_layers):
+        past_key_values.update(key, key.clone(), layer_idx)
+    return past_key_values
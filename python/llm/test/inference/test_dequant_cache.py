@@ -0,0 +1,90 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import gc
+import types
+import pytest
+import torch
+from unittest import TestCase
+
+import ipex_llm.transformers.dequant_cache as dequant_cache
+from ipex_llm.transformers.dequant_cache import DequantizedWeightCache, get_dequantized_weight
+from ipex_llm.transformers.low_bit_linear import SYM_INT8
+
+
+class Test_Dequant_Cache(TestCase):
+
+    def test_lru_eviction(self):
+        layers = [torch.nn.Linear(16, 16, bias=False) for _ in range(3)]
+        weights = [layer.weight.data.clone() for layer in layers]
+        nbytes = weights[0].numel() * weights[0].element_size()
+        cache = DequantizedWeightCache(2 * nbytes, torch.float32)
+
+        self.assertTrue(cache.put(layers[0], weights[0]))
+        self.assertTrue(cache.put(layers[1], weights[1]))
+        # touch layer 0 so that layer 1 is the least recently used one
+        self.assertIs(cache.get(layers[0]), weights[0])
+        self.assertFalse(cache.put(layers[2], weights[2], evict=False))
+        self.assertTrue(cache.put(layers[2], weights[2]))
+        self.assertIsNone(cache.get(layers[1]))
+        self.assertIs(cache.get(layers[0]), weights[0])
+        self.assertEqual(cache.used_bytes, 2 * nbytes)
+
+    def test_invalidate(self):
+        layer = torch.nn.Linear(16, 16, bias=False)
+        cache = DequantizedWeightCache(1 << 20, torch.float32)
+        cache.put(layer, layer.weight.data.clone())
+        layer.weight.data = torch.zeros(16, 16)
+        self.assertIsNone(cache.get(layer))
+
+        other = torch.nn.Linear(16, 16, bias=False)
+        cache.put(other, other.weight.data.clone())
+        del other
+        gc.collect()
+        self.assertEqual(len(cache.entries), 1)
+
+    def test_finalize_once(self):
+        layer = torch.nn.Linear(16, 16, bias=False)
+        cache = DequantizedWeightCache(1 << 20, torch.float32)
+        for _ in range(3):
+            cache.put(layer, layer.weight.data.clone())
+        self.assertEqual(len(cache.finalizers), 1)
+        del layer
+        gc.collect()
+        self.assertEqual(len(cache.entries), 0)
+        self.assertEqual(len(cache.finalizers), 0)
+
+    def test_no_calibration_in_request(self):
+        saved_cache, saved_thresholds = dequant_cache._cache, dict(dequant_cache._thresholds)
+        layer = types.SimpleNamespace(qtype=SYM_INT8)
+        try:
+            # disabled by default, only the former SYM_INT4 path is taken
+            dequant_cache._cache = DequantizedWeightCache(0, torch.float32)
+            self.assertIsNone(get_dequantized_weight(layer, 4096))
+            # enabled but not calibrated at load
+            dequant_cache._cache = DequantizedWeightCache(1 << 20, torch.float32)
+            dequant_cache._thresholds.pop(SYM_INT8, None)
+            self.assertIsNone(get_dequantized_weight(layer, 4096))
+            self.assertNotIn(SYM_INT8, dequant_cache._thresholds)
+        finally:
+            dequant_cache._cache = saved_cache
+            dequant_cache._thresholds.clear()
+            dequant_cache._thresholds.update(saved_thresholds)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
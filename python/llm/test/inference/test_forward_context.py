@@ -0,0 +1,104 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import pytest
+import torch
+from unittest import TestCase
+
+from ipex_llm.transformers.models.common import ForwardContext, forward_context, \
+    clear_forward_context
+
+
+class RotaryEmbedding(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.register_buffer("inv_freq", 1.0 / (10000 ** (torch.arange(0, 8, 2) / 8)))
+        self.calls = 0
+
+    def forward(self, x, position_ids):
+        self.calls += 1
+        freqs = position_ids[:, :, None].float() * self.inv_freq[None, None, :]
+        emb = torch.cat((freqs, freqs), dim=-1)
+        return emb.cos().to(x.dtype), emb.sin().to(x.dtype)
+
+
+class Test_Forward_Context(TestCase):
+
+    def test_padding_mask(self):
+        context = ForwardContext()
+        min_value = torch.finfo(torch.float).min
+        for kv_length in [1, 100, 128, 129, 300, 20]:
+            padding_kv_length = (kv_length + 127) // 128 * 128
+            mask = context.padding_mask(kv_length, padding_kv_length, torch.float, "cpu")
+            expected = torch.zeros([1, 1, 1, padding_kv_length])
+            expected[..., kv_length:] = min_value
+            self.assertTrue(torch.equal(mask, expected))
+        # one ramp buffer grown by blocks
+        self.assertEqual(len(context.ramps), 1)
+
+    def test_causal_mask(self):
+        context = ForwardContext()
+        for seq_length, kv_length in [(5, 5), (3, 7)]:
+            mask = context.causal_mask(seq_length, kv_length, 128, torch.float, "cpu")
+            visible = mask[0, 0] == 0
+            for i in range(seq_length):
+                self.assertEqual(visible[i].nonzero().flatten().tolist(),
+                                 list(range(kv_length - seq_length + i + 1)))
+            self.assertIs(context.causal_mask(seq_length, kv_length, 128, torch.float, "cpu"),
+                          mask)
+
+    def test_causal_mask_bytes_bounded(self):
+        context = ForwardContext()
+        # prefill-size masks are not cached
+        mask = context.causal_mask(1024, 1024, 1024, torch.float, "cpu")
+        self.assertIsNot(context.causal_mask(1024, 1024, 1024, torch.float, "cpu"), mask)
+        self.assertEqual(len(context.causal_masks), 0)
+        # 64 KiB each, the least recently used are evicted
+        for kv_length in range(16, 116):
+            context.causal_mask(16, kv_length, 1024, torch.float, "cpu")
+        self.assertEqual(context.causal_mask_bytes, context.max_causal_mask_bytes)
+        self.assertEqual(len(context.causal_masks),
+                         context.max_causal_mask_bytes // (16 * 1024 * 4))
+        self.assertNotIn((16, 16, 1024, torch.float, "cpu"), context.causal_masks)
+        context.clear()
+        self.assertEqual(context.causal_mask_bytes, 0)
+
+    def test_cleared_after_generate(self):
+        @clear_forward_context
+        def generate():
+            forward_context.causal_mask(1, 1, 128, torch.float, "cpu")
+            self.assertEqual(len(forward_context.causal_masks), 1)
+            return "done"
+
+        self.assertEqual(generate(), "done")
+        self.assertEqual(len(forward_context.causal_masks), 0)
+
+    def test_rotary_shared_by_layers(self):
+        context = ForwardContext()
+        layers = [RotaryEmbedding() for _ in range(3)]
+        x = torch.randn(1, 2, 4, 8)
+        position_ids = torch.arange(4).unsqueeze(0)
+        outputs = [context.rotary(layer, x, position_ids) for layer in layers]
+        self.assertEqual(sum(layer.calls for layer in layers), 1)
+        self.assertIs(outputs[1][0], outputs[0][0])
+        # new positions are recomputed
+        context.rotary(layers[0], x, torch.arange(4, 8).unsqueeze(0))
+        self.assertEqual(layers[0].calls, 2)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
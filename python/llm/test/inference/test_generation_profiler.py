@@ -0,0 +1,100 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import json
+import pytest
+import torch
+from unittest import TestCase
+from transformers import LlamaConfig, LlamaForCausalLM
+from transformers.generation.streamers import BaseStreamer
+
+from ipex_llm.utils import GenerationProfiler
+
+
+class RecordingStreamer(BaseStreamer):
+    def __init__(self):
+        self.values = []
+        self.ended = False
+
+    def put(self, value):
+        self.values.append(value)
+
+    def end(self):
+        self.ended = True
+
+
+class Test_Generation_Profiler(TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        config = LlamaConfig(vocab_size=128, hidden_size=64, intermediate_size=128,
+                             num_hidden_layers=2, num_attention_heads=4,
+                             max_position_embeddings=256)
+        self.model = LlamaForCausalLM(config).eval()
+        self.input_ids = torch.randint(0, 128, (1, 8))
+
+    def test_record(self):
+        profiler = GenerationProfiler(self.model)
+        with torch.inference_mode():
+            expected = self.model.generate(self.input_ids, max_new_tokens=6, min_new_tokens=6,
+                                           do_sample=False)
+            output = profiler.generate(self.input_ids, max_new_tokens=6, min_new_tokens=6,
+                                       do_sample=False)
+        assert torch.equal(output, expected)
+
+        assert len(profiler.records) == 1
+        record = profiler.records[0]
+        assert record["batch_size"] == 1
+        assert record["input_tokens"] == 8
+        assert record["output_tokens"] == 6
+        assert record["first_token_latency"] > 0
+        assert record["rest_token_latency_mean"] > 0
+        assert profiler.first_cost == record["first_token_latency"]
+        json.dumps(profiler.records)
+
+    def test_user_streamer(self):
+        profiler = GenerationProfiler(self.model)
+        streamer = RecordingStreamer()
+        with torch.inference_mode():
+            output = profiler.generate(self.input_ids, max_new_tokens=5, min_new_tokens=5,
+                                       do_sample=False, streamer=streamer)
+        # the user's streamer still gets the prompt and every new token
+        assert streamer.ended
+        assert len(streamer.values) == 6
+        assert torch.equal(streamer.values[0].view(-1), self.input_ids.view(-1))
+        streamed = torch.cat([value.view(-1) for value in streamer.values[1:]])
+        assert torch.equal(streamed, output[0, 8:])
+        assert profiler.records[0]["output_tokens"] == 5
+
+    def test_beam_search(self):
+        # beam search doesn't support streamer, the step timing comes from stopping criteria
+        profiler = GenerationProfiler(self.model)
+        with torch.inference_mode():
+            output = profiler.generate(self.input_ids, max_new_tokens=4, min_new_tokens=4,
+                                       num_beams=2, do_sample=False)
+        assert output.shape[-1] == 12
+        assert profiler.records[0]["output_tokens"] == 4
+
+    def test_remove_hooks(self):
+        profiler = GenerationProfiler(self.model)
+        profiler.remove_hooks()
+        assert len(self.model._forward_pre_hooks) == 0
+        assert len(self.model._forward_hooks) == 0
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,77 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+import struct
+import tempfile
+import numpy
+import pytest
+from unittest import TestCase
+
+from ipex_llm.transformers.gguf.gguf import GGUFFileLoader
+
+
+def gguf_str(value):
+    data = value.encode()
+    return struct.pack("<Q", len(data)) + data
+
+
+def write_gguf(path, tokens, scores, token_types):
+    kv = [
+        gguf_str("general.architecture") + struct.pack("<i", 8) + gguf_str("llama"),
+        gguf_str("tokenizer.ggml.tokens") + struct.pack("<iiQ", 9, 8, len(tokens))
+        + b"".join(gguf_str(token) for token in tokens),
+        gguf_str("tokenizer.ggml.scores") + struct.pack("<iiQ", 9, 6, len(scores))
+        + numpy.array(scores, dtype="<f4").tobytes(),
+        gguf_str("tokenizer.ggml.token_type") + struct.pack("<iiQ", 9, 5, len(token_types))
+        + numpy.array(token_types, dtype="<i4").tobytes(),
+        gguf_str("general.alignment") + struct.pack("<i", 4) + struct.pack("<I", 32),
+    ]
+    with open(path, "wb") as f:
+        f.write(b"GGUF" + struct.pack("<IQQ", 3, 0, len(kv)) + b"".join(kv))
+
+
+class Test_GGUF_Reader(TestCase):
+
+    def test_vocab(self):
+        tokens = ["<unk>", "a", "▁hé", "x" * 200]
+        scores = [0.0, -1.0, -2.5, 3.0]
+        token_types = [2, 1, 1, 1]
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, "model.gguf")
+            write_gguf(path, tokens, scores, token_types)
+            protos = []
+            # parsed from the file, then from the cache written by the first load
+            for _ in range(2):
+                loader = GGUFFileLoader(path, vocab_cache=True)
+                self.assertEqual(loader.config["tokenizer.ggml.tokens"], tokens)
+                self.assertEqual(loader.config["tokenizer.ggml.scores"].tolist(), scores)
+                self.assertEqual(loader.config["tokenizer.ggml.token_type"].tolist(),
+                                 token_types)
+                self.assertEqual(loader.config["general.alignment"], 32)
+                protos.append(loader.tokenizer_pieces_proto())
+                self.assertTrue(os.path.exists(path + ".vocab.npz"))
+            self.assertEqual(protos[0], protos[1])
+
+            pieces = loader.tokenizer_pieces()
+            self.assertEqual([piece.piece for piece in pieces], tokens)
+            self.assertEqual([piece.score for piece in pieces], scores)
+            self.assertEqual([piece.type for piece in pieces], token_types)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
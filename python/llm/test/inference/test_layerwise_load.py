@@ -0,0 +1,84 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import tempfile
+import pytest
+import torch
+from unittest import TestCase
+from transformers import LlamaConfig, LlamaForCausalLM, Qwen2Config, Qwen2ForCausalLM, \
+    RwkvConfig, RwkvForCausalLM
+
+from ipex_llm.transformers import AutoModelForCausalLM
+
+
+class Test_Layerwise_Load(TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        config = LlamaConfig(vocab_size=128, hidden_size=64, intermediate_size=128,
+                             num_hidden_layers=2, num_attention_heads=4,
+                             max_position_embeddings=256)
+        self.model = LlamaForCausalLM(config).eval()
+        self.input_ids = torch.randint(0, 128, (1, 16))
+
+    def assert_same_logits(self, model_path, **kwargs):
+        model = AutoModelForCausalLM.from_pretrained(model_path, load_in_4bit=True, **kwargs)
+        layerwise_model = AutoModelForCausalLM.from_pretrained(model_path, load_in_4bit=True,
+                                                               layerwise_load=True, **kwargs)
+        # same module structure after `_optimize_pre`, e.g. merged qkv_proj
+        self.assertEqual({name: type(module) for name, module in model.named_modules()},
+                         {name: type(module) for name, module in
+                          layerwise_model.named_modules()})
+        self.assertEqual(model.lm_head.weight.dtype, layerwise_model.lm_head.weight.dtype)
+        self.assertEqual(model.model.norm.weight.dtype, layerwise_model.model.norm.weight.dtype)
+        with torch.inference_mode():
+            logits = model(self.input_ids).logits
+            layerwise_logits = layerwise_model(self.input_ids).logits
+        assert torch.allclose(logits, layerwise_logits, atol=1e-5)
+
+    def test_layerwise_load(self):
+        with tempfile.TemporaryDirectory() as model_path:
+            self.model.save_pretrained(model_path, safe_serialization=True)
+            self.assert_same_logits(model_path)
+
+    def test_layerwise_load_qwen2(self):
+        torch.manual_seed(0)
+        config = Qwen2Config(vocab_size=128, hidden_size=64, intermediate_size=128,
+                             num_hidden_layers=2, num_attention_heads=4,
+                             num_key_value_heads=2, max_position_embeddings=256)
+        with tempfile.TemporaryDirectory() as model_path:
+            Qwen2ForCausalLM(config).eval().save_pretrained(model_path,
+                                                            safe_serialization=True)
+            self.assert_same_logits(model_path)
+
+    def test_layerwise_load_unsupported(self):
+        config = RwkvConfig(vocab_size=128, hidden_size=64, num_hidden_layers=2,
+                            context_length=256)
+        with tempfile.TemporaryDirectory() as model_path:
+            RwkvForCausalLM(config).save_pretrained(model_path, safe_serialization=True)
+            with self.assertRaisesRegex(RuntimeError, "does not support rwkv"):
+                AutoModelForCausalLM.from_pretrained(model_path, load_in_4bit=True,
+                                                     layerwise_load=True)
+
+    def test_layerwise_load_auto_dtype(self):
+        with tempfile.TemporaryDirectory() as model_path:
+            self.model.to(torch.bfloat16).save_pretrained(model_path, safe_serialization=True)
+            self.assert_same_logits(model_path, torch_dtype="auto")
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
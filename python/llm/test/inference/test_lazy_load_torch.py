@@ -0,0 +1,72 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+import tempfile
+import zipfile
+import pytest
+import torch
+from unittest import TestCase
+
+from ipex_llm.utils.lazy_load_torch import lazyload, prefetch_tensors
+
+
+class Test_Lazy_Load_Torch(TestCase):
+
+    def setUp(self):
+        self.state_dict = {
+            "embed.weight": torch.randn(32, 16, dtype=torch.float16),
+            "layer.weight": torch.randn(16, 16),
+            "layer.bias": torch.randn(16, dtype=torch.bfloat16),
+        }
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, "pytorch_model.bin")
+        torch.save(self.state_dict, self.path)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def check(self, lazy_state_dict):
+        names = []
+        for name, tensor in prefetch_tensors(lazy_state_dict, num_workers=2):
+            names.append(name)
+            self.assertTrue(torch.equal(tensor, self.state_dict[name]))
+        # tensors are yielded in the order of the checkpoint
+        self.assertEqual(names, list(self.state_dict.keys()))
+
+    def test_mmap(self):
+        lazy_state_dict = lazyload(self.path)
+        self.check(lazy_state_dict)
+        # tensors viewing the copy-on-write mapping are writable
+        tensor = lazy_state_dict["layer.weight"].load()
+        tensor.zero_()
+        self.assertTrue(torch.equal(lazyload(self.path)["layer.weight"].load(),
+                                    self.state_dict["layer.weight"]))
+
+    def test_compressed(self):
+        compressed_path = os.path.join(self.tempdir.name, "compressed.bin")
+        with zipfile.ZipFile(self.path) as src, \
+                zipfile.ZipFile(compressed_path, "w", zipfile.ZIP_DEFLATED) as dst:
+            for info in src.infolist():
+                dst.writestr(info.filename, src.read(info))
+        # compressed members are read and copied
+        with open(compressed_path, "rb") as f:
+            self.check(lazyload(f))
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,86 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import pytest
+import torch
+from transformers import LogitsProcessorList
+from transformers.generation.logits_process import RepetitionPenaltyLogitsProcessor, \
+    NoRepeatNGramLogitsProcessor, MinLengthLogitsProcessor, TemperatureLogitsWarper, \
+    TopKLogitsWarper, TopPLogitsWarper
+
+from ipex_llm.transformers.logits_process import BatchedLogitsProcessor, \
+    VerifyLogitsProcessor, token_counts
+
+vocab_size = 32
+
+
+def per_position(logits_processor, input_ids, scores, draft_ids):
+    expected = scores.clone()
+    for i in range(scores.size(1)):
+        expected[:, i] = logits_processor(torch.cat((input_ids, draft_ids[:, :i]), dim=-1),
+                                          scores[:, i].clone())
+    return expected
+
+
+@pytest.mark.parametrize("processors", [
+    [RepetitionPenaltyLogitsProcessor(1.3)],
+    [NoRepeatNGramLogitsProcessor(2)],
+    [NoRepeatNGramLogitsProcessor(3)],
+    [MinLengthLogitsProcessor(22, eos_token_id=[0, 1])],
+    [RepetitionPenaltyLogitsProcessor(1.1), TemperatureLogitsWarper(0.7),
+     TopKLogitsWarper(8), TopPLogitsWarper(0.8)],
+])
+def test_batched_logits_processor_matches_transformers(processors):
+    torch.manual_seed(0)
+    logits_processor = LogitsProcessorList(processors)
+    # a small vocabulary makes repeated tokens and ngrams likely
+    input_ids = torch.randint(0, vocab_size, (3, 20))
+    draft_ids = torch.randint(0, vocab_size, (3, 5))
+    scores = torch.randn(3, 6, vocab_size)
+
+    batched = BatchedLogitsProcessor.from_logits_processor(logits_processor)
+    assert batched is not None
+    expected = per_position(logits_processor, input_ids, scores, draft_ids)
+    torch.testing.assert_close(batched(input_ids, scores.clone(), draft_ids), expected)
+    # also works as a normal logits processor
+    torch.testing.assert_close(batched(input_ids, scores[:, 0].clone()), expected[:, 0])
+
+
+def test_verify_logits_processor_incremental_counts():
+    torch.manual_seed(0)
+    logits_processor = LogitsProcessorList([RepetitionPenaltyLogitsProcessor(1.5)])
+    verify_processor = VerifyLogitsProcessor(logits_processor)
+    input_ids = torch.randint(0, vocab_size, (2, 10))
+    for _ in range(3):
+        draft_ids = torch.randint(0, vocab_size, (2, 4))
+        scores = torch.randn(2, 5, vocab_size)
+        expected = per_position(logits_processor, input_ids, scores, draft_ids)
+        torch.testing.assert_close(verify_processor(input_ids, scores, draft_ids), expected)
+        accepted = draft_ids[:, :2]
+        input_ids = torch.cat((input_ids, accepted), dim=-1)
+        verify_processor.update(accepted)
+        assert torch.equal(verify_processor.counts, token_counts(input_ids, vocab_size))
+
+
+def test_frequency_presence_penalty():
+    input_ids = torch.tensor([[3, 3, 5]])
+    scores = torch.zeros(1, 2, 8)
+    processor = BatchedLogitsProcessor(frequency_penalty=0.5, presence_penalty=1.0)
+    processed = processor(input_ids, scores, torch.tensor([[5]]))
+    assert processed[0, 0, 3] == -2.0 and processed[0, 0, 5] == -1.5
+    # the second position also sees the draft token 5
+    assert processed[0, 1, 5] == -2.0 and processed[0, 1, 4] == 0.0
@@ -0,0 +1,79 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import types
+import pytest
+import torch
+from unittest import TestCase
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from ipex_llm import optimize_model
+from ipex_llm.transformers.lookup import lookup_generate
+
+
+class Test_Lookup_Batch(TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        config = LlamaConfig(vocab_size=128, hidden_size=64, intermediate_size=128,
+                             num_hidden_layers=2, num_attention_heads=4,
+                             max_position_embeddings=256, pad_token_id=0)
+        model = LlamaForCausalLM(config).eval()
+        self.model = optimize_model(model, low_bit="sym_int8")
+        self.model.lookup_generate = types.MethodType(lookup_generate, self.model)
+        # repeated patterns so that prompt lookup finds drafts
+        pattern = torch.randint(1, 128, (12,))
+        self.prompts = [pattern.repeat(3), pattern[:7].repeat(2), pattern[3:].repeat(4)]
+
+    def generate_single(self, prompt, **kwargs):
+        with torch.inference_mode():
+            output = self.model.generate(prompt.unsqueeze(0), lookahead=2, do_sample=False,
+                                         **kwargs)
+        return output[0, len(prompt):].tolist()
+
+    def generate_batch(self, **kwargs):
+        max_len = max(len(prompt) for prompt in self.prompts)
+        input_ids = torch.zeros(len(self.prompts), max_len, dtype=torch.long)
+        attention_mask = torch.zeros(len(self.prompts), max_len, dtype=torch.long)
+        for idx, prompt in enumerate(self.prompts):
+            input_ids[idx, max_len - len(prompt):] = prompt
+            attention_mask[idx, max_len - len(prompt):] = 1
+        with torch.inference_mode():
+            output = self.model.generate(input_ids, attention_mask=attention_mask,
+                                         lookahead=2, do_sample=False, **kwargs)
+        return [row[max_len:].tolist() for row in output]
+
+    def assert_batch_equals_single(self, **kwargs):
+        batch_outputs = self.generate_batch(**kwargs)
+        for prompt, batch_output in zip(self.prompts, batch_outputs):
+            single_output = self.generate_single(prompt, **kwargs)
+            self.assertEqual(batch_output[:len(single_output)], single_output)
+            # finished rows are padded
+            self.assertTrue(all(token == 0 for token in batch_output[len(single_output):]))
+
+    def test_greedy(self):
+        self.assert_batch_equals_single(max_new_tokens=24)
+
+    def test_logits_processor(self):
+        # processed with the unpadded history of each row
+        self.assert_batch_equals_single(max_new_tokens=24, repetition_penalty=1.3,
+                                        no_repeat_ngram_size=3, min_length=40,
+                                        eos_token_id=5)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
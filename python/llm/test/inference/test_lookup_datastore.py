@@ -0,0 +1,106 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import tempfile
+import threading
+import pytest
+import numpy as np
+import torch
+from unittest import TestCase
+
+from ipex_llm.transformers.lookup_datastore import SuffixArrayDatastore, \
+    RetrievalCandidateGenerator, build_suffix_array
+
+
+class Test_Lookup_Datastore(TestCase):
+
+    def test_suffix_array(self):
+        rng = np.random.default_rng(0)
+        tokens = rng.integers(0, 4, size=300).astype(np.int32)
+        tokens[::37] = -1
+        suffix_array = build_suffix_array(tokens)
+        expected = sorted(range(len(tokens)), key=lambda pos: tokens[pos:].tolist())
+        self.assertEqual(suffix_array.tolist(), expected)
+
+    def test_draft_most_frequent_continuation(self):
+        datastore = SuffixArrayDatastore.build([[1, 2, 3, 4, 5],
+                                                [9, 2, 3, 4, 6],
+                                                [7, 2, 3, 4, 6, 8]],
+                                               max_suffix_len=4, min_suffix_len=2)
+        self.assertEqual(datastore.draft([0, 2, 3], 3), [4, 6, 8])
+        # the longest matched suffix wins over more frequent shorter ones
+        self.assertEqual(datastore.draft([1, 2, 3, 4], 3), [5])
+        self.assertEqual(datastore.draft([5, 5], 3), [])
+
+    def test_online_and_mmap(self):
+        datastore = SuffixArrayDatastore.build([[1, 2, 3, 4]], max_suffix_len=3,
+                                               min_suffix_len=2)
+        datastore.add([8, 9, 10, 11])
+        self.assertEqual(datastore.draft([8, 9], 2), [10, 11])
+        with tempfile.TemporaryDirectory() as path:
+            datastore.save(path)
+            loaded = SuffixArrayDatastore.load(path)
+            self.assertIsInstance(loaded.tokens, np.memmap)
+            self.assertEqual(loaded.draft([8, 9], 2), [10, 11])
+            self.assertEqual(loaded.draft([1, 2], 2), [3, 4])
+
+    def test_online_index_bounded(self):
+        datastore = SuffixArrayDatastore.build([[1, 2, 3, 4]], max_suffix_len=3,
+                                               min_suffix_len=2, max_online_tokens=12)
+        datastore.add([8, 9, 10, 11])
+        self.assertEqual(len(datastore.online_tokens), 5)
+        datastore.add([20, 21, 22, 23, 24, 25])
+        # merged into the suffix array
+        self.assertEqual(len(datastore.online_tokens), 0)
+        self.assertEqual(len(datastore.online_index), 0)
+        self.assertEqual(len(datastore), 17)
+        self.assertEqual(datastore.draft([8, 9], 2), [10, 11])
+        self.assertEqual(datastore.draft([21, 22], 3), [23, 24, 25])
+
+    def test_concurrent_add_and_draft(self):
+        datastore = SuffixArrayDatastore.build([[1, 2, 3, 4]], max_suffix_len=3,
+                                               min_suffix_len=2, max_online_tokens=1000)
+        errors = []
+
+        def worker(idx):
+            base = 100 * (idx + 1)
+            try:
+                for _ in range(50):
+                    datastore.add([base, base + 1, base + 2, base + 3])
+                    self.assertEqual(datastore.draft([base, base + 1], 2),
+                                     [base + 2, base + 3])
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(idx,)) for idx in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(datastore), 5 + 4 * 50 * 5)
+
+    def test_candidate_generator(self):
+        datastore = SuffixArrayDatastore.build([[1, 2, 3, 4, 5]], min_suffix_len=2)
+        generator = RetrievalCandidateGenerator(datastore, num_output_tokens=2,
+                                                device="cpu")
+        candidates, _ = generator.get_candidates(torch.tensor([[7, 2, 3]]))
+        self.assertEqual(candidates.tolist(), [[7, 2, 3, 4, 5]])
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,137 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import copy
+import os
+import pytest
+import tempfile
+import torch
+from unittest import TestCase, mock
+from peft import LoraConfig, get_peft_model
+from transformers import LlamaConfig, LlamaForCausalLM
+
+import ipex_llm
+from ipex_llm.transformers.lora_pool import LoraAdapterPool
+from ipex_llm.transformers.qlora import PeftModel, lora_adapters
+
+
+class Test_Lora_Adapter_Pool(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        torch.manual_seed(0)
+        config = LlamaConfig(vocab_size=128, hidden_size=64, intermediate_size=128,
+                             num_hidden_layers=2, num_attention_heads=4,
+                             num_key_value_heads=2, max_position_embeddings=256)
+        cls.base = LlamaForCausalLM(config).eval()
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.adapters = {}
+        for i, target_modules in enumerate([["q_proj", "v_proj"],
+                                            ["q_proj", "k_proj", "v_proj", "o_proj"]]):
+            torch.manual_seed(i + 1)
+            lora_config = LoraConfig(r=4, lora_alpha=8, target_modules=target_modules,
+                                     init_lora_weights=False)
+            peft_model = get_peft_model(copy.deepcopy(cls.base), lora_config)
+            path = os.path.join(cls.tmp_dir.name, f"adapter{i}")
+            peft_model.save_pretrained(path)
+            cls.adapters[f"adapter{i}"] = path
+        cls.input_ids = torch.randint(0, 128, (3, 6))
+        # q/k/v_proj are not merged without `optimize_llm`
+        cls.expected = {}
+        for name in [None] + list(cls.adapters.keys()):
+            model = ipex_llm.optimize_model(copy.deepcopy(cls.base), low_bit="sym_int8",
+                                            optimize_llm=False)
+            if name is not None:
+                model = PeftModel.from_pretrained(model, cls.adapters[name])
+            with torch.no_grad():
+                cls.expected[name] = model(cls.input_ids).logits
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def make_pool(self, max_loaded_adapters):
+        model = ipex_llm.optimize_model(copy.deepcopy(self.base), low_bit="sym_int8")
+        self.assertTrue(hasattr(model.model.layers[0].self_attn, "qkv_proj"))
+        return model, LoraAdapterPool(model, self.adapters, max_loaded_adapters)
+
+    def check_rows(self, model, adapter_names):
+        with torch.no_grad(), lora_adapters(adapter_names):
+            logits = model(self.input_ids).logits
+        for i, name in enumerate(adapter_names):
+            expected = self.expected[None if name == "__base__" else name][i]
+            torch.testing.assert_close(logits[i], expected, atol=1e-4, rtol=1e-4)
+
+    def test_per_row_adapters(self):
+        model, pool = self.make_pool(max_loaded_adapters=2)
+        adapter_names = ["adapter0", "__base__", "adapter1"]
+        names = pool.acquire(adapter_names)
+        try:
+            self.check_rows(model, adapter_names)
+        finally:
+            pool.release(names)
+        output = pool.generate(model, self.input_ids, adapter_names=adapter_names,
+                               max_new_tokens=2, do_sample=False)
+        self.assertEqual(output.shape, (3, 8))
+        self.assertEqual(pool.stats()["loads"], 2)
+        self.assertEqual(pool.stats()["hits"], 2)
+
+    def test_swap_and_evict(self):
+        model, pool = self.make_pool(max_loaded_adapters=1)
+        names = pool.acquire(["adapter0", "adapter1"])
+        # adapters in use are never evicted
+        self.assertEqual(len(pool.loaded), 2)
+        pool.release(names)
+        self.assertEqual(list(pool.loaded.keys()), ["adapter1"])
+        self.assertEqual(pool.evictions, 1)
+        # adapter0 is reloaded when used again
+        names = pool.acquire(["adapter0"])
+        self.check_rows(model, ["adapter0", "adapter0", "__base__"])
+        pool.release(names)
+        self.assertEqual(list(pool.loaded.keys()), ["adapter0"])
+        self.assertEqual(pool.loads, 3)
+        # registered again with the weights of adapter1
+        pool.register("adapter0", self.adapters["adapter1"])
+        self.assertNotIn("adapter0", pool.loaded)
+        names = pool.acquire(["adapter0"])
+        with torch.no_grad(), lora_adapters(["adapter0"] * 3):
+            logits = model(self.input_ids).logits
+        pool.release(names)
+        torch.testing.assert_close(logits, self.expected["adapter1"], atol=1e-4, rtol=1e-4)
+
+    def test_base_rows_while_loading(self):
+        import peft.utils
+        model, pool = self.make_pool(max_loaded_adapters=2)
+        names = pool.acquire(["adapter0"])
+        set_peft_model_state_dict = peft.utils.set_peft_model_state_dict
+
+        def check_and_load(*args, **kwargs):
+            # requests running while adapter1 is injected are not affected by it
+            self.check_rows(model, ["__base__", "adapter0", "__base__"])
+            with torch.no_grad():
+                logits = model(self.input_ids).logits
+            torch.testing.assert_close(logits, self.expected[None], atol=1e-4, rtol=1e-4)
+            return set_peft_model_state_dict(*args, **kwargs)
+
+        with mock.patch.object(peft.utils, "set_peft_model_state_dict", check_and_load):
+            names += pool.acquire(["adapter1"])
+        self.check_rows(model, ["adapter1", "adapter0", "__base__"])
+        pool.release(names)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,83 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import pytest
+import torch
+from unittest import TestCase
+
+from ipex_llm.ggml.quantize import ggml_tensor_qtype
+from ipex_llm.transformers.low_bit_linear import LowBitLinear, ggml_matmul_cpu, \
+    ggml_matmul_src1_x_src0_t, _workspace
+
+
+class Test_Low_Bit_Matmul(TestCase):
+
+    def setUp(self):
+        self.linear = LowBitLinear(256, 96, ggml_tensor_qtype["sym_int8"], bias=True)
+        self.linear.weight = self.linear.weight.to("cpu")
+        self.bias = torch.randn(96)
+
+    def matmul(self, x, dtype, bias=None):
+        return ggml_matmul_cpu(self.linear.weight.data, x, self.linear.weight_shape,
+                               self.linear.qtype, dtype, bias)
+
+    def expected(self, x, dtype, bias=None):
+        result = ggml_matmul_src1_x_src0_t(self.linear.weight.data, x.float().contiguous(),
+                                           self.linear.weight_shape, self.linear.qtype)
+        if bias is not None:
+            result = result + bias
+        return result.to(dtype)
+
+    def test_fused_bias_and_dtype(self):
+        for dtype in [torch.float32, torch.bfloat16, torch.float16]:
+            for bias in [None, self.bias]:
+                x = torch.randn(4, 256).to(dtype)
+                result = self.matmul(x, dtype, bias)
+                self.assertEqual(result.dtype, dtype)
+                torch.testing.assert_close(result, self.expected(x, dtype, bias))
+
+    def test_result_not_shared(self):
+        # the result is a new tensor even though the fp32 output is a reused buffer
+        x = torch.randn(2, 256, dtype=torch.bfloat16)
+        first = self.matmul(x, torch.bfloat16, self.bias)
+        expected = first.clone()
+        self.matmul(torch.randn(2, 256, dtype=torch.bfloat16), torch.bfloat16, self.bias)
+        torch.testing.assert_close(first, expected)
+
+    def test_workspace_cap(self):
+        _workspace.clear()
+        max_bytes = _workspace.max_bytes
+        try:
+            _workspace.max_bytes = 4 * 96 * 4
+            # decode size inputs reuse buffers
+            self.matmul(torch.randn(4, 256, dtype=torch.bfloat16), torch.bfloat16)
+            buffer = _workspace.buffers[("result", torch.float32)]
+            self.matmul(torch.randn(2, 256, dtype=torch.bfloat16), torch.bfloat16)
+            self.assertIs(_workspace.buffers[("result", torch.float32)], buffer)
+            # prefill size inputs are allocated normally, and the buffer does not grow
+            x = torch.randn(64, 256, dtype=torch.bfloat16)
+            result = self.matmul(x, torch.bfloat16, self.bias)
+            torch.testing.assert_close(result, self.expected(x, torch.bfloat16, self.bias))
+            self.assertIs(_workspace.buffers[("result", torch.float32)], buffer)
+            self.assertEqual(buffer.numel(), 4 * 96)
+        finally:
+            _workspace.max_bytes = max_bytes
+            _workspace.clear()
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
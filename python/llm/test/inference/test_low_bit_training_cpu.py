@@ -0,0 +1,55 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import pytest
+import torch
+from unittest import TestCase
+
+import ipex_llm.transformers.low_bit_linear as low_bit_linear
+from ipex_llm.ggml.quantize import ggml_tensor_qtype
+from ipex_llm.transformers.low_bit_linear import LowBitLinear, MatMulLowBitCPU, \
+    ggml_convert_fp32
+
+
+class Test_Low_Bit_Training_CPU(TestCase):
+
+    def test_tiled_matmul(self):
+        tile_rows = low_bit_linear.CPU_TRAINING_TILE_ROWS
+        # tiles of 64 rows, the last one is partial
+        low_bit_linear.CPU_TRAINING_TILE_ROWS = 64
+        try:
+            for qtype in ["sym_int4", "asym_int4", "sym_int8", "q4_k", "q6_k"]:
+                linear = LowBitLinear(256, 160, ggml_tensor_qtype[qtype], bias=False)
+                linear.weight = linear.weight.to("cpu")
+                weight = linear.weight
+                dense = ggml_convert_fp32(weight.data, weight._shape,
+                                          weight._shape[0] * weight._shape[1], weight.qtype)
+
+                x = torch.randn(2, 3, 256, requires_grad=True)
+                result = MatMulLowBitCPU.apply(x, weight)
+                self.assertEqual(result.shape, (2, 3, 160))
+                torch.testing.assert_close(result, x @ dense.T, rtol=0.05, atol=0.5)
+
+                grad_output = torch.randn(2, 3, 160)
+                result.backward(grad_output)
+                torch.testing.assert_close(x.grad, grad_output @ dense, rtol=0.05, atol=0.5)
+        finally:
+            low_bit_linear.CPU_TRAINING_TILE_ROWS = tile_rows
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,88 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+import pytest
+import tempfile
+import torch
+from pathlib import Path
+from unittest import TestCase
+
+from ipex_llm.ggml.quantize import ggml_tensor_qtype
+from ipex_llm.transformers.mixed_precision import measure_sensitivity, solve_plan, \
+    get_plan_qtype, load_plan, save_plan, PLAN_FORMAT, PLAN_VERSION
+from ipex_llm.transformers.low_bit_cache import LowBitModelCache
+
+
+class Test_Mixed_Precision(TestCase):
+
+    def test_measure_sensitivity(self):
+        weight = torch.randn(64, 256)
+        inputs = torch.randn(16, 256)
+        result = measure_sensitivity(weight, inputs, ["sym_int4", "q6_k", "sym_int8"])
+        self.assertEqual(set(result.keys()), {"sym_int4", "q6_k", "sym_int8"})
+        self.assertLess(result["sym_int8"][1], result["sym_int4"][1])
+        self.assertLess(result["sym_int4"][0], result["sym_int8"][0])
+        # q6_k falls back to sym_int8 if in_features is not a multiple of 256
+        result = measure_sensitivity(torch.randn(64, 128), torch.randn(16, 128),
+                                     ["sym_int4", "q6_k"])
+        self.assertEqual(set(result.keys()), {"sym_int4", "sym_int8"})
+
+    def test_solve_plan(self):
+        units = [
+            {"sym_int4": (100, 1.0), "sym_int8": (200, 0.1)},
+            {"sym_int4": (100, 0.2), "sym_int8": (200, 0.1)},
+        ]
+        self.assertEqual(solve_plan(units, 300), (["sym_int8", "sym_int4"], 300))
+        self.assertEqual(solve_plan(units, 400), (["sym_int8", "sym_int8"], 400))
+        self.assertEqual(solve_plan(units, 200), (["sym_int4", "sym_int4"], 200))
+        with self.assertRaises(RuntimeError):
+            solve_plan(units, 100)
+
+    def test_plan_qtype(self):
+        plan = load_plan({
+            "format": PLAN_FORMAT,
+            "version": PLAN_VERSION,
+            "modules": {
+                "model.layers.0.self_attn.q_proj": "q6_k",
+                "model.layers.0.mlp.gate_proj": "sym_int8",
+                "model.layers.0.mlp.up_proj": "sym_int8",
+                "lm_head": "q6_k",
+            },
+        })
+        default_qtype = ggml_tensor_qtype["sym_int4"]
+        for name, qtype in [("model.layers.0.self_attn.q_proj", "q6_k"),
+                            ("model.layers.0.self_attn.qkv_proj", "q6_k"),
+                            ("model.layers.0.mlp.gate_proj", "sym_int8"),
+                            ("model.layers.0.mlp.gate_up_proj", "sym_int8"),
+                            ("lm_head", "q6_k"),
+                            ("model.layers.0.mlp.down_proj", "sym_int4")]:
+            self.assertEqual(get_plan_qtype(plan, name, default_qtype), ggml_tensor_qtype[qtype])
+
+    def test_plan_path_in_cache_key(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            plan_path = os.path.join(tmp_dir, "plan.json")
+            save_plan({"format": PLAN_FORMAT, "version": PLAN_VERSION,
+                       "modules": {"lm_head": "q6_k"}}, plan_path)
+            keys = [LowBitModelCache.make_key(tmp_dir, "AutoModelForCausalLM", "sym_int4",
+                                              mixed_precision=plan)[0]
+                    for plan in [plan_path, Path(plan_path)]]
+            self.assertEqual(keys[0], keys[1])
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
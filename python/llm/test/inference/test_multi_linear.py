@@ -0,0 +1,133 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import gc
+import threading
+import pytest
+import torch
+from unittest import TestCase
+
+from ipex_llm.ggml.quantize import ggml_tensor_qtype
+from ipex_llm.transformers.low_bit_linear import LowBitLinear, MultiLowBitLinear
+from ipex_llm.transformers.models.common import mark_multi_linear
+
+
+class Test_Multi_Low_Bit_Linear(TestCase):
+
+    def make_linear(self, out_features, bias):
+        linear = LowBitLinear(256, out_features, ggml_tensor_qtype["sym_int8"], bias=bias)
+        linear.weight = linear.weight.to("cpu")
+        linear.eval()
+        return linear
+
+    def test_fused_outputs(self):
+        for bias in [False, True]:
+            linears = [self.make_linear(out_features, bias) for out_features in [256, 64, 64]]
+            x = torch.randn(2, 3, 256)
+            with torch.inference_mode():
+                expected = [linear(x) for linear in linears]
+                multi_linear = MultiLowBitLinear(linears)
+                for linear in linears:
+                    linear.multi_linear = multi_linear
+                outputs = [linear(x) for linear in linears]
+            self.assertTrue(multi_linear.is_fused())
+            self.assertEqual(len(multi_linear.pending_outputs()), 0)
+            for output, target in zip(outputs, expected):
+                self.assertEqual(output.shape, target.shape)
+                torch.testing.assert_close(output, target)
+            # split views of one result
+            self.assertEqual(outputs[0].untyped_storage().data_ptr(),
+                             outputs[1].untyped_storage().data_ptr())
+
+    def test_different_inputs(self):
+        linears = [self.make_linear(64, False) for _ in range(2)]
+        multi_linear = MultiLowBitLinear(linears)
+        for linear in linears:
+            linear.multi_linear = multi_linear
+        x, y = torch.randn(1, 1, 256), torch.randn(1, 1, 256)
+        with torch.inference_mode():
+            linears[0](x)
+            output = linears[1](y)
+            linears[1].multi_linear = None
+            expected = linears[1](y)
+        torch.testing.assert_close(output, expected)
+
+    def test_input_not_kept_alive(self):
+        linears = [self.make_linear(64, False) for _ in range(3)]
+        multi_linear = MultiLowBitLinear(linears)
+        for linear in linears:
+            linear.multi_linear = multi_linear
+        x = torch.randn(1, 1, 256)
+        with torch.inference_mode():
+            linears[0](x)
+        pending = multi_linear.pending_outputs()
+        self.assertEqual(len(pending), 2)
+        del x
+        gc.collect()
+        self.assertEqual(len(pending), 0)
+
+    def test_concurrent_threads(self):
+        linears = [self.make_linear(64, False) for _ in range(2)]
+        inputs = [torch.randn(1, 1, 256) for _ in range(2)]
+        with torch.inference_mode():
+            expected = [[linear(x) for linear in linears] for x in inputs]
+        multi_linear = MultiLowBitLinear(linears)
+        for linear in linears:
+            linear.multi_linear = multi_linear
+        first_called, second_finished = threading.Event(), threading.Event()
+        outputs = [None, None]
+
+        def interrupted():
+            with torch.inference_mode():
+                first = linears[0](inputs[0])
+                first_called.set()
+                second_finished.wait(timeout=10)
+                outputs[0] = [first, linears[1](inputs[0])]
+
+        def interrupting():
+            first_called.wait(timeout=10)
+            with torch.inference_mode():
+                outputs[1] = [linear(inputs[1]) for linear in linears[::-1]][::-1]
+            second_finished.set()
+
+        # the second thread runs its whole group between the two calls of the first one
+        threads = [threading.Thread(target=interrupted), threading.Thread(target=interrupting)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for output, target in zip(outputs, expected):
+            for value, expected_value in zip(output, target):
+                torch.testing.assert_close(value, expected_value)
+
+    def test_cross_attention_not_grouped(self):
+        attention = torch.nn.Module()
+        for name in ["q_proj", "k_proj", "v_proj"]:
+            setattr(attention, name, torch.nn.Linear(64, 64))
+        mark_multi_linear(attention)
+        self.assertEqual(attention.multi_linear_groups, [["q_proj", "k_proj", "v_proj"]])
+        del attention.multi_linear_groups
+        attention.is_cross_attention = True
+        mark_multi_linear(attention)
+        self.assertFalse(hasattr(attention, "multi_linear_groups"))
+        del attention.is_cross_attention
+        mark_multi_linear(attention, groups=[["gate_proj", "up_proj"]])
+        self.assertFalse(hasattr(attention, "multi_linear_groups"))
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
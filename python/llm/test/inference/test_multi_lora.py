@@ -0,0 +1,75 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import pytest
+import torch
+from unittest import TestCase
+
+from ipex_llm.ggml.quantize import ggml_tensor_qtype
+from ipex_llm.transformers.low_bit_linear import LowBitLinear
+from ipex_llm.transformers.qlora import LoraLowBitLinear, lora_adapters
+
+
+class Test_Multi_Lora(TestCase):
+
+    def make_lora_linear(self):
+        qtype = ggml_tensor_qtype["sym_int8"]
+        base_layer = LowBitLinear(256, 128, qtype, bias=False)
+        base_layer.weight = base_layer.weight.to("cpu")
+        lora_linear = LoraLowBitLinear(base_layer, "a", r=8, lora_alpha=16, qa_lora=False,
+                                       qtype=qtype)
+        lora_linear.update_layer("b", 4, lora_alpha=4, lora_dropout=0.0,
+                                 init_lora_weights=True, use_rslora=False)
+        for name in ["a", "b"]:
+            torch.nn.init.normal_(lora_linear.lora_B[name].weight)
+        lora_linear.eval()
+        return lora_linear
+
+    def adapter_delta(self, lora_linear, name, x):
+        lora_A, lora_B = lora_linear.lora_A[name], lora_linear.lora_B[name]
+        return lora_B(lora_A(x)) * lora_linear.scaling[name]
+
+    def test_active_adapters(self):
+        lora_linear = self.make_lora_linear()
+        lora_linear.set_adapter(["a", "b"])
+        x = torch.randn(2, 3, 256)
+        with torch.no_grad():
+            base = lora_linear.base_layer(x)
+            expected = base + self.adapter_delta(lora_linear, "a", x) \
+                + self.adapter_delta(lora_linear, "b", x)
+            torch.testing.assert_close(lora_linear(x), expected)
+            # the concatenated weights are reused
+            cached = lora_linear.lora_weights_cache
+            lora_linear(x)
+            self.assertIs(lora_linear.lora_weights_cache, cached)
+
+    def test_per_row_adapters(self):
+        lora_linear = self.make_lora_linear()
+        x = torch.randn(3, 2, 256)
+        with torch.no_grad():
+            base = lora_linear.base_layer(x)
+            expected = torch.stack([base[0] + self.adapter_delta(lora_linear, "b", x[0]),
+                                    base[1],
+                                    base[2] + self.adapter_delta(lora_linear, "a", x[2])])
+            torch.testing.assert_close(lora_linear(x, adapter_names=["b", "__base__", "a"]),
+                                       expected)
+            with lora_adapters(["b", "__base__", "a"]):
+                torch.testing.assert_close(lora_linear(x), expected)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,89 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+import sys
+import math
+import pytest
+import torch
+import torch.nn.functional as F
+from unittest import TestCase
+from transformers import LlamaConfig, LlamaForCausalLM
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "..", "dev", "benchmark", "perplexity"))
+from ppl import BigDLPPL, chunked_nll, final_hidden_states, split_lm_head
+
+
+def full_logits_nll(model, input_ids, labels):
+    # reference: nll sum and token count from the full [batch, seq, vocab] logits
+    logits = model(input_ids, use_cache=False).logits[:, :-1].float()
+    labels = labels[:, 1:]
+    loss = F.cross_entropy(logits.transpose(1, 2), labels, ignore_index=-100,
+                           reduction="none")
+    return loss.sum(dim=1).double(), (labels != -100).sum(dim=1)
+
+
+class Test_Perplexity(TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        config = LlamaConfig(vocab_size=128, hidden_size=64, intermediate_size=128,
+                             num_hidden_layers=2, num_attention_heads=4,
+                             max_position_embeddings=256)
+        self.model = LlamaForCausalLM(config).eval()
+
+    def test_chunked_nll(self):
+        input_ids = torch.randint(0, 128, (3, 50))
+        labels = input_ids.clone()
+        labels[1, :20] = -100
+        with torch.no_grad():
+            expected_nll, expected_tokens = full_logits_nll(self.model, input_ids, labels)
+            body, lm_head = split_lm_head(self.model)
+            hidden_states = final_hidden_states(body, input_ids)
+            # the last chunk is partial
+            nll_sum, n_tokens = chunked_nll(hidden_states[:, :-1], lm_head, labels[:, 1:],
+                                            chunk_size=16)
+        torch.testing.assert_close(nll_sum, expected_nll, rtol=1e-4, atol=1e-3)
+        self.assertEqual(n_tokens.tolist(), expected_tokens.tolist())
+
+    def test_sliding_window(self):
+        input_ids = torch.randint(0, 128, (1, 100))
+        max_length, stride = 40, 30
+        evaluator = BigDLPPL.__new__(BigDLPPL)
+        evaluator.model = self.model
+        evaluator.device = "cpu"
+        ppl = evaluator.perplexity_sliding_window(input_ids, max_length, stride, chunk_size=16)
+
+        total_nll, total_tokens, prev_end_loc = 0.0, 0, 0
+        with torch.no_grad():
+            for begin_loc in range(0, 100, stride):
+                end_loc = min(begin_loc + max_length, 100)
+                window = input_ids[:, begin_loc:end_loc]
+                labels = window.clone()
+                labels[:, :-(end_loc - prev_end_loc)] = -100
+                nll, tokens = full_logits_nll(self.model, window, labels)
+                total_nll += nll.sum().item()
+                total_tokens += tokens.sum().item()
+                prev_end_loc = end_loc
+                if end_loc == 100:
+                    break
+        self.assertAlmostEqual(ppl, math.exp(total_nll / total_tokens), places=3)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,129 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import threading
+
+import pytest
+import torch
+from unittest import TestCase
+
+from ipex_llm.transformers.prefix_cache import PrefixCache
+from kv_cache_utils import make_cache
+
+
+def cached_keys(past_key_values, layer_idx=0):
+    return past_key_values.key_cache[layer_idx][0, 0, :, 0].long().tolist()
+
+
+class Test_Prefix_Cache(TestCase):
+
+    def test_longest_prefix(self):
+        prefix_cache = PrefixCache()
+        system_prompt = torch.arange(100, 120)
+        prompt_1 = torch.cat([system_prompt, torch.arange(0, 5)])
+        prompt_2 = torch.cat([system_prompt, torch.arange(5, 10)])
+        prefix_cache.insert(prompt_1, make_cache(prompt_1))
+        prefix_cache.insert(prompt_2, make_cache(prompt_2))
+        # the edge of the first prompt is split at the end of the system prompt
+        self.assertEqual(prefix_cache.num_tokens, 30)
+        self.assertEqual(len(prefix_cache.root.children), 1)
+
+        prompt_3 = torch.cat([system_prompt, torch.arange(5, 8), torch.arange(50, 60)])
+        node, length = prefix_cache.match(prompt_3)
+        self.assertEqual(length, 23)
+        past_key_values = prefix_cache.build_cache(node, length, batch_size=2)
+        self.assertEqual(past_key_values.get_seq_length(), 23)
+        self.assertEqual(cached_keys(past_key_values), prompt_3[:23].tolist())
+        self.assertEqual(cached_keys(past_key_values, 1), prompt_3[:23].tolist())
+        # the last token of a fully cached prompt is left to prefill
+        self.assertEqual(prefix_cache.match(prompt_1)[1], prompt_1.size(0) - 1)
+
+    def test_padded_positions(self):
+        prefix_cache = PrefixCache()
+        prompt = torch.arange(10)
+        # [prefix][padding][rest] layout of a batch reusing the first 4 tokens
+        padded = torch.cat([prompt[:4], torch.full([3], -1), prompt[4:]])
+        positions = torch.cat([torch.arange(4), torch.arange(7, 13)])
+        prefix_cache.insert(prompt, make_cache(padded), positions=positions)
+        node, length = prefix_cache.match(prompt, max_length=10)
+        self.assertEqual(cached_keys(prefix_cache.build_cache(node, length)), prompt.tolist())
+
+    def test_eviction(self):
+        prompt = torch.arange(10)
+        prefix_cache = PrefixCache(max_tokens=25)
+        prompts = [torch.cat([torch.tensor([i]), prompt]) for i in range(3)]
+        prefix_cache.insert(prompts[0], make_cache(prompts[0]))
+        prefix_cache.insert(prompts[1], make_cache(prompts[1]))
+        # referenced prefixes are not evicted, the least recently used one is
+        node, _ = prefix_cache.match(prompts[0])
+        prefix_cache.insert(prompts[2], make_cache(prompts[2]))
+        self.assertEqual(prefix_cache.longest_prefix(prompts[0]), 11)
+        self.assertEqual(prefix_cache.longest_prefix(prompts[1]), 0)
+        self.assertEqual(prefix_cache.longest_prefix(prompts[2]), 11)
+        self.assertEqual(prefix_cache.num_tokens, 22)
+        self.assertEqual(prefix_cache.nbytes, 22 * 2 * 2 * 2 * 4 * 4)
+        # nothing can be evicted while all prefixes are referenced
+        other, _ = prefix_cache.match(prompts[2])
+        prompt_4 = torch.arange(50, 60)
+        prefix_cache.insert(prompt_4, make_cache(prompt_4))
+        self.assertEqual(prefix_cache.longest_prefix(prompt_4), 0)
+        prefix_cache.release(node)
+        prefix_cache.release(other)
+        prefix_cache.insert(prompt_4, make_cache(prompt_4))
+        self.assertEqual(prefix_cache.longest_prefix(prompt_4), 10)
+
+    def test_build_cache_while_inserting(self):
+        prefix_cache = PrefixCache()
+        prompt = torch.arange(100, 200)
+        prefix_cache.insert(prompt, make_cache(prompt))
+        node, length = prefix_cache.match(prompt)
+        errors = []
+
+        def insert():
+            # every prompt splits the edge of the matched node at a new position
+            for i in range(99, 0, -1):
+                diverged = torch.cat([prompt[:i], torch.tensor([i])])
+                prefix_cache.insert(diverged, make_cache(diverged))
+
+        def build():
+            for _ in range(100):
+                keys = cached_keys(prefix_cache.build_cache(node, length))
+                if keys != prompt[:length].tolist():
+                    errors.append(keys)
+
+        threads = [threading.Thread(target=insert), threading.Thread(target=build)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        prefix_cache.release(node)
+        self.assertEqual(errors, [])
+        self.assertEqual(cached_keys(prefix_cache.build_cache(node, length)),
+                         prompt[:length].tolist())
+
+    def test_stats(self):
+        prefix_cache = PrefixCache()
+        prefix_cache.record(100, 0)
+        prefix_cache.record(100, 50)
+        stats = prefix_cache.stats()
+        self.assertEqual(stats["requests"], 2)
+        self.assertEqual(stats["hit_requests"], 1)
+        self.assertEqual(stats["hit_rate"], 0.25)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
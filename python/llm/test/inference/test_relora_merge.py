@@ -0,0 +1,115 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import copy
+import json
+import os
+import tempfile
+import pytest
+import torch
+import safetensors.torch as st
+from unittest import TestCase
+from transformers import LlamaConfig, LlamaForCausalLM
+
+import ipex_llm
+from ipex_llm.transformers.qlora import LoraConfig, get_peft_model
+from ipex_llm.transformers.relora import find_lora_modules, merge_and_save, merge_shard
+
+
+class Test_Relora_Merge(TestCase):
+
+    def test_copy_shard(self):
+        tensors = {
+            "embed.weight": torch.randn(16, 8, dtype=torch.bfloat16),
+            "norm.weight": torch.randn(8),
+            "position_ids": torch.arange(16),
+            "mask": torch.rand(4, 4) > 0.5,
+        }
+        with tempfile.TemporaryDirectory() as model_src, \
+                tempfile.TemporaryDirectory() as model_dst:
+            for shard_path in ["model.safetensors", "pytorch_model.bin"]:
+                if shard_path.endswith(".safetensors"):
+                    st.save_file(tensors, os.path.join(model_src, shard_path))
+                else:
+                    torch.save(tensors, os.path.join(model_src, shard_path))
+                out_shard_name, names = merge_shard(shard_path, model_src, model_dst, {},
+                                                    reinit=False, cpu_offload=True,
+                                                    actually_save=True)
+                self.assertEqual(out_shard_name, "model.safetensors")
+                self.assertEqual(sorted(names), sorted(tensors.keys()))
+                # tensors without LoRA keep their dtype and values
+                out_tensors = st.load_file(os.path.join(model_dst, out_shard_name))
+                for name, tensor in tensors.items():
+                    self.assertEqual(out_tensors[name].dtype, tensor.dtype)
+                    self.assertTrue(torch.equal(out_tensors[name], tensor))
+
+    def test_merge_lora_shards(self):
+        torch.manual_seed(0)
+        config = LlamaConfig(vocab_size=128, hidden_size=64, intermediate_size=128,
+                             num_hidden_layers=2, num_attention_heads=4,
+                             max_position_embeddings=256)
+        base = LlamaForCausalLM(config).eval()
+        # bf16 weights and fp32 norms, merged k/q_proj are between copied tensors in file
+        # order, e.g. k_proj, o_proj, q_proj, v_proj
+        state_dict = {name: tensor.clone() if "norm" in name else tensor.to(torch.bfloat16)
+                      for name, tensor in base.state_dict().items()}
+        shards = {"model-00001-of-00002.safetensors": {}, "model-00002-of-00002.safetensors": {}}
+        for name, tensor in state_dict.items():
+            shard_name = sorted(shards)[0 if "layers.0." in name or "embed" in name else 1]
+            shards[shard_name][name] = tensor
+        model = ipex_llm.optimize_model(copy.deepcopy(base), low_bit="nf4",
+                                        optimize_llm=False)
+        lora_config = LoraConfig(r=4, lora_alpha=8, target_modules=["k_proj", "q_proj"],
+                                 init_lora_weights=False, training_mode="qlora")
+        peft_model = get_peft_model(model, lora_config)
+        targets = find_lora_modules(peft_model.base_model)
+        self.assertEqual(len(targets), 4)
+        expected = {}
+        for module_name, target in targets.items():
+            delta = target.lora_B["default"].weight @ target.lora_A["default"].weight
+            key = module_name + ".weight"
+            expected[key] = (state_dict[key].float()
+                             + delta.detach() * target.scaling["default"]).to(torch.bfloat16)
+
+        with tempfile.TemporaryDirectory() as model_src, \
+                tempfile.TemporaryDirectory() as model_dst:
+            weight_map = {}
+            for shard_name, tensors in shards.items():
+                st.save_file(tensors, os.path.join(model_src, shard_name))
+                weight_map.update({name: shard_name for name in tensors})
+            with open(os.path.join(model_src, "model.safetensors.index.json"), "w") as file:
+                json.dump({"metadata": {}, "weight_map": weight_map}, file)
+
+            merge_and_save(peft_model.base_model, model_src, model_dst, cpu_offload=True,
+                           max_workers=2)
+
+            with open(os.path.join(model_dst, "model.safetensors.index.json")) as file:
+                self.assertEqual(json.load(file)["weight_map"], weight_map)
+            for shard_name, tensors in shards.items():
+                out_tensors = st.load_file(os.path.join(model_dst, shard_name))
+                self.assertEqual(sorted(out_tensors.keys()), sorted(tensors.keys()))
+                for name, tensor in tensors.items():
+                    self.assertEqual(out_tensors[name].dtype, tensor.dtype)
+                    # merged weights are W + B @ A * scaling cast to the dtype of W
+                    torch.testing.assert_close(out_tensors[name],
+                                               expected.get(name, tensor), atol=0, rtol=0)
+        self.assertTrue(any(name in expected for name in shards[sorted(shards)[0]]))
+        self.assertTrue(any(name in expected for name in shards[sorted(shards)[1]]))
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
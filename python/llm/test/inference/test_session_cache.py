@@ -0,0 +1,82 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import pytest
+import torch
+from unittest import TestCase
+
+from ipex_llm.transformers.session_cache import SessionKVCache, cache_nbytes
+from kv_cache_utils import make_cache
+
+
+class Test_Session_Cache(TestCase):
+
+    def test_session_id(self):
+        session_cache = SessionKVCache()
+        turn_1 = torch.arange(10)
+        session_cache.release("id:a", turn_1, make_cache(turn_1))
+        turn_2 = torch.cat([turn_1, torch.arange(100, 105)]).unsqueeze(0)
+        key, past_key_values = session_cache.acquire(turn_2, session_id="a")
+        self.assertEqual(key, "id:a")
+        self.assertEqual(past_key_values.get_seq_length(), 10)
+        # taken out of the store while generating
+        self.assertEqual(len(session_cache.sessions), 0)
+
+    def test_edited_history(self):
+        session_cache = SessionKVCache()
+        turn_1 = torch.arange(10)
+        session_cache.release("id:a", turn_1, make_cache(turn_1))
+        edited = torch.cat([turn_1[:6], torch.arange(100, 110)]).unsqueeze(0)
+        _, past_key_values = session_cache.acquire(edited, session_id="a")
+        self.assertEqual(past_key_values.get_seq_length(), 6)
+        self.assertEqual(past_key_values.key_cache[0][0, 0, :, 0].tolist(), list(range(6)))
+        # new tokens are appended after the cropped prefix
+        past_key_values.update(*[torch.full([1, 2, 1, 4], 100.0)] * 2, 0)
+        self.assertEqual(past_key_values.key_cache[0][0, 0, :, 0].tolist(),
+                         list(range(6)) + [100])
+
+    def test_prefix_match(self):
+        session_cache = SessionKVCache(match_tolerance=2)
+        conversation_1, conversation_2 = torch.arange(20), torch.arange(50, 70)
+        session_cache.release(None, conversation_1, make_cache(conversation_1))
+        session_cache.release(None, conversation_2, make_cache(conversation_2))
+        # the last response token is tokenized differently in the next turn
+        next_turn = torch.cat([conversation_1[:19], torch.arange(200, 210)]).unsqueeze(0)
+        key, past_key_values = session_cache.acquire(next_turn)
+        self.assertIsNone(key)
+        self.assertEqual(past_key_values.get_seq_length(), 19)
+        self.assertEqual(len(session_cache.sessions), 1)
+        # only a shared system prompt does not take over another conversation
+        other = torch.cat([conversation_2[:5], torch.arange(300, 320)]).unsqueeze(0)
+        self.assertIsNone(session_cache.acquire(other)[1])
+        self.assertEqual(len(session_cache.sessions), 1)
+
+    def test_eviction(self):
+        turn = torch.arange(10)
+        nbytes = cache_nbytes(make_cache(turn))
+        session_cache = SessionKVCache(max_memory_gb=2.5 * nbytes / (1024 ** 3))
+        for session_id in ["a", "b", "c"]:
+            session_cache.release("id:" + session_id, turn, make_cache(turn))
+        self.assertEqual(list(session_cache.sessions.keys()), ["id:b", "id:c"])
+        session_cache.idle_timeout = -1
+        session_cache.evict()
+        self.assertEqual(len(session_cache.sessions), 0)
+        self.assertEqual(session_cache.nbytes, 0)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
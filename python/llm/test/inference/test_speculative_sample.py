@@ -0,0 +1,74 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import pytest
+import torch
+
+from ipex_llm.transformers.speculative import speculative_sample
+
+# each test draws this many samples at once, through the batch dimension
+num_samples = 200000
+vocab_size = 8
+
+
+def random_probs(*shape, temperature=1.0):
+    return torch.softmax(torch.randn(*shape, vocab_size) / temperature, dim=-1)
+
+
+def assert_same_distribution(samples, probs):
+    # total variation distance between the empirical and expected distributions,
+    # its standard deviation is about sqrt(vocab_size / num_samples) / 2
+    empirical = torch.bincount(samples, minlength=vocab_size).double() / samples.numel()
+    tv = (empirical - probs.double()).abs().sum() / 2
+    assert tv < 0.01, f"empirical {empirical.tolist()} vs expected {probs.tolist()}"
+
+
+@pytest.mark.parametrize("k", [1, 4])
+def test_speculative_sample_with_draft_model(k):
+    torch.manual_seed(0)
+    target = random_probs(k + 1)
+    draft = random_probs(k, temperature=0.5)
+    draft_tokens = torch.multinomial(draft, num_samples, replacement=True).t()
+
+    output_ids, n_matches = speculative_sample(target.expand(num_samples, -1, -1),
+                                               draft_tokens,
+                                               draft.expand(num_samples, -1, -1))
+    assert output_ids.shape == (num_samples, k + 1)
+    assert ((n_matches >= 0) & (n_matches <= k)).all()
+    # the first output token is always valid, and must follow the target distribution
+    assert_same_distribution(output_ids[:, 0], target[0])
+    # the second one is valid if the first draft is accepted,
+    # which follows the target distribution at the next position
+    if k > 1:
+        accepted = n_matches >= 1
+        assert_same_distribution(output_ids[accepted, 1], target[1])
+
+
+def test_speculative_sample_with_deterministic_drafts():
+    torch.manual_seed(0)
+    target = random_probs(3)
+    # prompt lookup drafts do not depend on the target, and the second row has no valid draft
+    draft_tokens = torch.tensor([[2, 5], [2, 5]]).repeat(num_samples // 2, 1)
+    draft_lens = torch.tensor([2, 0]).repeat(num_samples // 2)
+
+    output_ids, n_matches = speculative_sample(target.expand(num_samples, -1, -1),
+                                               draft_tokens, draft_lens=draft_lens)
+    assert (n_matches[1::2] == 0).all()
+    assert_same_distribution(output_ids[:, 0], target[0])
+    # the draft is accepted with probability q(draft)
+    accept_rate = (n_matches[0::2] >= 1).double().mean()
+    assert abs(accept_rate - target[0, 2]) < 0.01
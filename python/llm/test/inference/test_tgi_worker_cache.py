@@ -0,0 +1,72 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import pytest
+from unittest import TestCase, mock
+
+pytest.importorskip("fastchat")
+
+from ipex_llm.serving.fastchat import tgi_api_server
+from ipex_llm.serving.fastchat.tgi_api_server import WorkerCache
+
+
+class Test_Worker_Cache(TestCase):
+
+    def test_expiry(self):
+        cache = WorkerCache(ttl=10)
+        with mock.patch.object(tgi_api_server.time, "monotonic", return_value=100):
+            cache.put(("context_length", "http://worker:1", "llama"), 4096)
+            cache.put(("address", "llama"), "http://worker:1")
+            cache.put(("address", "qwen"), "http://worker:2", ttl=20)
+        with mock.patch.object(tgi_api_server.time, "monotonic", return_value=105):
+            self.assertEqual(cache.get(("context_length", "http://worker:1", "llama")), 4096)
+        with mock.patch.object(tgi_api_server.time, "monotonic", return_value=111):
+            self.assertIsNone(cache.get(("context_length", "http://worker:1", "llama")))
+            self.assertEqual(cache.get(("address", "qwen")), "http://worker:2")
+        self.assertNotIn(("context_length", "http://worker:1", "llama"), cache.entries)
+        # ttl 0 disables caching
+        cache.put(("address", "llama"), "http://worker:1", cache.address_ttl)
+        self.assertIsNone(cache.get(("address", "llama")))
+        cache.ttl = 0
+        cache.put(("models",), ["llama"])
+        self.assertIsNone(cache.get(("models",)))
+
+    def test_invalidate_worker(self):
+        cache = WorkerCache(ttl=10, address_ttl=10)
+        cache.put(("address", "llama"), "http://worker:1")
+        cache.put(("address", "qwen"), "http://worker:2")
+        cache.put(("context_length", "http://worker:1", "llama"), 4096)
+        cache.put(("context_length", "http://worker:2", "qwen"), 8192)
+        cache.invalidate_worker("http://worker:1/worker_generate_stream")
+        self.assertIsNone(cache.get(("address", "llama")))
+        self.assertIsNone(cache.get(("context_length", "http://worker:1", "llama")))
+        self.assertEqual(cache.get(("address", "qwen")), "http://worker:2")
+        self.assertEqual(cache.get(("context_length", "http://worker:2", "qwen")), 8192)
+
+    def test_models_changed(self):
+        cache = WorkerCache(ttl=10)
+        cache.update_models(["llama", "qwen"])
+        cache.put(("context_length", "http://worker:1", "llama"), 4096)
+        cache.update_models(["qwen", "llama"])
+        self.assertEqual(cache.get(("context_length", "http://worker:1", "llama")), 4096)
+        cache.update_models(["llama"])
+        self.assertIsNone(cache.get(("context_length", "http://worker:1", "llama")))
+        self.assertEqual(cache.get(("models",)), ["llama"])
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -138,6 +138,59 @@ def test_load_low_bit_completion(Model, Tokenizer, model_path, prompt, answer):
 
             assert answer in output_str
 
+@pytest.mark.parametrize('Model, Tokenizer, model_path',[
+    (AutoModelForCausalLM, AutoTokenizer, os.environ.get('MISTRAL_ORIGIN_PATH')),
+    ])
+def test_low_bit_cache(Model, Tokenizer, model_path):
+    from ipex_llm.transformers.low_bit_cache import LowBitModelCache
+    tokenizer = Tokenizer.from_pretrained(model_path, trust_remote_code=True)
+    input_ids = tokenizer.encode("What is the capital of France?\n\n", return_tensors="pt")
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        outputs = []
+        for _ in range(2):
+            # the first load converts and stores the model, the second one hits the cache
+            model = Model.from_pretrained(model_path,
+                                          load_in_4bit=True,
+                                          trust_remote_code=True,
+                                          low_bit_cache_dir=cache_dir)
+            with torch.inference_mode():
+                outputs.append(model.generate(input_ids, do_sample=False, max_new_tokens=16))
+            assert len(LowBitModelCache(cache_dir).entries()) == 1
+        assert torch.equal(outputs[0], outputs[1])
+
+        # a different qtype is a different entry
+        Model.from_pretrained(model_path, load_in_low_bit="sym_int8",
+                              trust_remote_code=True, low_bit_cache_dir=cache_dir)
+        cache = LowBitModelCache(cache_dir)
+        assert len(cache.entries()) == 2
+
+        # other from_pretrained kwargs are part of the key as well
+        Model.from_pretrained(model_path, load_in_4bit=True, trust_remote_code=True,
+                              attn_implementation="eager", low_bit_cache_dir=cache_dir)
+        assert len(cache.entries()) == 3
+
+        # not passed to transformers when the model is not converted to low-bit
+        Model.from_pretrained(model_path, trust_remote_code=True, low_bit_cache_dir=cache_dir)
+        assert len(cache.entries()) == 3
+        cache.evict(max_size_gb=0)
+        assert len(cache.entries()) == 0
+
+@pytest.mark.parametrize('Model, Tokenizer, model_path',[
+    (AutoModelForCausalLM, AutoTokenizer, os.environ.get('MISTRAL_ORIGIN_PATH')),
+    ])
+def test_chunked_prefill(Model, Tokenizer, model_path):
+    tokenizer = Tokenizer.from_pretrained(model_path, trust_remote_code=True)
+    model = Model.from_pretrained(model_path, load_in_4bit=True, trust_remote_code=True)
+    input_ids = tokenizer.encode("What is AI? " * 40, return_tensors="pt")
+
+    with torch.inference_mode():
+        output = model.generate(input_ids, do_sample=False, max_new_tokens=16)
+        # all but the last chunk of 32 tokens is prefilled before the original generate
+        chunked_output = model.generate(input_ids, do_sample=False, max_new_tokens=16,
+                                        prefill_chunk_size=32)
+    assert torch.equal(output, chunked_output)
+
 prompt = "Once upon a time, there existed a little girl who liked to have adventures. She wanted to go to places and meet new people, and have fun"
 
 @pytest.mark.parametrize("Model, Tokenizer, model_path, prompt", [
@@ -0,0 +1,88 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+import subprocess
+import sys
+import pytest
+from unittest import TestCase
+
+
+def import_time(statement):
+    """
+    Run `statement` in a fresh interpreter with `python -X importtime`,
+    return a dict from module name to its cumulative import time in us.
+    """
+    env = dict(os.environ)
+    # auto importing ipex would pull in torch, which is not what is measured here
+    env["BIGDL_IMPORT_IPEX"] = "False"
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", statement],
+                          env=env, capture_output=True, text=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+class Test_Import_Time(TestCase):
+
+    def report(self, statement, times, top=10):
+        print(f"\n`{statement}` imported {len(times)} modules:")
+        for name, cost in sorted(times.items(), key=lambda item: -item[1])[:top]:
+            print(f"{cost / 1000:10.2f} ms  {name}")
+
+    def test_import_ipex_llm_is_lazy(self):
+        statement = "import ipex_llm"
+        times = import_time(statement)
+        self.report(statement, times)
+        for heavy in ["torch", "transformers", "ipex_llm.transformers.model",
+                      "ipex_llm.optimize", "ipex_llm.llm_patching"]:
+            self.assertNotIn(heavy, times)
+
+    def test_import_subpackages_is_lazy(self):
+        statement = "import ipex_llm.transformers, ipex_llm.utils; " \
+                    "from ipex_llm.utils.common import invalidInputError; " \
+                    "assert not hasattr(ipex_llm.transformers, '__wrapped__'); " \
+                    "assert 'AutoModelForCausalLM' in dir(ipex_llm.transformers); " \
+                    "assert 'LlamaForCausalLM' in ipex_llm.transformers.__all__"
+        times = import_time(statement)
+        self.report(statement, times)
+        for heavy in ["transformers", "pydantic", "ipex_llm.transformers.pipeline_parallel",
+                      "ipex_llm.transformers.modelling_bigdl"]:
+            self.assertNotIn(heavy, times)
+
+    def test_lazy_attributes(self):
+        import ipex_llm
+        from ipex_llm import llm_convert, optimize_model
+        from ipex_llm.transformers import AutoModelForCausalLM, BigdlNativeForCausalLM
+        from ipex_llm.utils import BenchmarkWrapper
+        self.assertIs(ipex_llm.transformers.AutoModelForCausalLM, AutoModelForCausalLM)
+        with self.assertRaises(AttributeError):
+            ipex_llm.transformers.NotAModel
+
+    def test_import_star(self):
+        namespace = {}
+        exec("from ipex_llm.transformers import *", namespace)
+        for name in ["AutoModelForCausalLM", "LlamaForCausalLM", "ggml_convert_low_bit"]:
+            self.assertIn(name, namespace)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -12,6 +12,7 @@ start=$(date "+%s")
 # separate convert process to save disk space
 if [[ $1 == "llama" ]]; then
   python -m pytest -s ${LLM_CONVERT_TEST_DIR}/test_convert_model.py -k "test_convert_llama"
+  python -m pytest -s ${LLM_CONVERT_TEST_DIR}/test_convert_single_pass.py
 elif [[ $1 == "gptneox" ]]; then
   python -m pytest -s ${LLM_CONVERT_TEST_DIR}/test_convert_model.py -k "test_convert_gptneox"
 elif [[ $1 == "bloom" ]]; then
@@ -17,6 +17,27 @@ fi
 export OMP_NUM_THREADS=$THREAD_NUM
 python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_transformers_api.py -v
 python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_optimize_model_api.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_perplexity.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_generation_profiler.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_layerwise_load.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_lookup_batch.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_speculative_sample.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_logits_process.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_lookup_datastore.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_dequant_cache.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_low_bit_matmul.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_multi_linear.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_forward_context.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_mixed_precision.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_tgi_worker_cache.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_session_cache.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_prefix_cache.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_low_bit_training_cpu.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_multi_lora.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_lora_pool.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_relora_merge.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_gguf_reader.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_lazy_load_torch.py -v
 
 now=$(date "+%s")
 time=$((now-start))